@@ -1,8 +1,17 @@
 """Module info"""
 
-import importlib.metadata
 
-try:
-    __version__ = importlib.metadata.version(__package__ or __name__)
-except importlib.metadata.PackageNotFoundError:
-    __version__ = "0.0.0"
+def __getattr__(name: str) -> str:
+    # Resolved on demand, as importlib.metadata is slow to import
+    if name != "__version__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    import importlib.metadata  # noqa: PLC0415
+
+    try:
+        version = importlib.metadata.version(__package__ or __name__)
+    except importlib.metadata.PackageNotFoundError:
+        version = "0.0.0"
+
+    globals()["__version__"] = version
+    return version
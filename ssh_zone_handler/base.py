@@ -1,13 +1,91 @@
 """Base classes"""
 
 import logging
+import os
+import re
 import sys
-from collections.abc import Iterator, Sequence
+import time
+from codecs import getincrementaldecoder
+from collections import deque
+from collections.abc import (
+    Callable,
+    Container,
+    Generator,
+    Iterable,
+    Iterator,
+    Sequence,
+)
+from contextlib import contextmanager, redirect_stdout
+from itertools import islice
 from pathlib import Path
-from subprocess import CalledProcessError, CompletedProcess, run
-from typing import Final
+from selectors import EVENT_READ, DefaultSelector
+from subprocess import CalledProcessError, CompletedProcess, Popen, run
+from typing import IO, Final, NamedTuple, TypeVar
 
-from .types import UserConf, ZoneHandlerConf
+from .snapshot import ConfigSnapshot, UserSnapshot
+from .zones import ZoneGrants
+
+STREAM_CHUNK_SIZE: Final[int] = 64 * 1024
+STDERR_TAIL_SIZE: Final[int] = 8 * 1024
+
+
+class ZoneStatus(NamedTuple):
+    """The zone details output by status, as reported by the server"""
+
+    serial: str = "-"
+    loaded: str = "-"
+    refresh: str = "-"
+    expires: str = "-"
+
+
+class LogWindow(NamedTuple):
+    """A logs time window, both in seconds and in journalctl syntax"""
+
+    seconds: int
+    journal: str
+
+
+LOG_WINDOWS: Final[dict[str, LogWindow]] = {
+    "1h": LogWindow(60 * 60, "-1h"),
+    "6h": LogWindow(6 * 60 * 60, "-6h"),
+    "1d": LogWindow(24 * 60 * 60, "-1day"),
+    "2d": LogWindow(2 * 24 * 60 * 60, "-2days"),
+    # As far back as logindex's INDEX_WINDOW
+    "5d": LogWindow(5 * 24 * 60 * 60, "-5days"),
+}
+DEFAULT_LOG_WINDOW: Final[str] = "5d"
+MAX_LOG_LINES: Final[int] = 10000
+
+COMMANDS: Final[tuple[str, ...]] = (
+    "help",
+    "list",
+    "status",
+    "dump",
+    "logs",
+    "retransfer",
+    "batch",
+)
+
+# The --name=value options each command accepts, and the plain --name flags
+COMMAND_OPTIONS: Final[dict[str, tuple[str, ...]]] = {
+    "dump": ("gzip", "since-serial"),
+    "logs": ("since", "until", "lines", "gzip"),
+}
+FLAG_OPTIONS: Final[frozenset[str]] = frozenset({"gzip"})
+GZIP_LEVEL: Final[int] = 6
+
+# Frame each command's output within a batch, for scripts to split it apart
+BATCH_BEGIN: Final[str] = "@@ szh-begin"
+BATCH_END: Final[str] = "@@ szh-end"
+
+# Multi-zone dumps get spooled to disk beyond this size, awaiting their turn
+DUMP_SPOOL_SIZE: Final[int] = 1024 * 1024
+
+
+# Characters sudoers would otherwise take as either syntax or wildcards
+SUDOERS_SPECIAL: Final[re.Pattern[str]] = re.compile(r"[\\,:*?\[\]]")
+
+_T = TypeVar("_T")
 
 
 class InvokeError(Exception):
@@ -17,44 +95,126 @@ class InvokeError(Exception):
 class SshZoneHandler:
     """Parse shared config, define constants, etc"""
 
-    def __init__(self, config: ZoneHandlerConf) -> None:
-        self.config: ZoneHandlerConf = config
+    def __init__(self, config: ConfigSnapshot) -> None:
+        self.config: ConfigSnapshot = config
         self.journal_user: Final[str] = config.system.journalctl_user
         self.login_user: Final[str] = config.system.login_user
         self.service_user: Final[str] = config.system.server_user
-        service_unit: Final[str] = config.system.systemd_unit
+        self.journal_grep: Final[bool] = config.system.journalctl_grep
+        self.service_unit: Final[str] = config.system.systemd_unit
+
+    @staticmethod
+    def _journal_grep() -> str:
+        """
+        A fixed pattern, pinned by sudoers, matching any zone related line
 
-        self.journal_cmd: Final[tuple[str, str, str, str]] = (
+        Which of those lines concern the requested zones only gets
+        decided by _filter_logs().
+        """
+        raise NotImplementedError("Gets defined in each daemon specific subclass")
+
+    def _journal_cmd(
+        self,
+        since: str = DEFAULT_LOG_WINDOW,
+        until: str | None = None,
+        reverse: bool = False,
+    ) -> tuple[str, ...]:
+        """
+        The journalctl command for a time window, as also allowed by sudoers
+
+        :param since: LOG_WINDOWS key of how far back to start
+        :param until: LOG_WINDOWS key of how far back to stop, if not now
+        :param reverse: Newest entries first
+        """
+
+        command: tuple[str, ...] = (
             "/usr/bin/journalctl",
-            f"--unit={service_unit}",
-            "--since=-5days",
-            "--utc",
+            f"--unit={self.service_unit}",
+            f"--since={LOG_WINDOWS[since].journal}",
         )
+        if until:
+            command += (f"--until={LOG_WINDOWS[until].journal}",)
+        command += ("--utc",)
+        if reverse:
+            command += ("--reverse",)
+        if self.journal_grep:
+            command += (f"--grep={self._journal_grep()}",)
+
+        return command
 
 
 class SshZoneAuthorizedKeys(SshZoneHandler):
     """Common class to output authorized_keys entries"""
 
+    def __init__(self, config: ConfigSnapshot) -> None:
+        super().__init__(config)
+
+        self.wrapper: Final[Path] = Path(sys.argv[0]).absolute().parent / "szh-wrapper"
+
+    def __entry(self, user: str, ssh_key: str) -> str:
+        return f'command="{self.wrapper} {user}",restrict {ssh_key}'
+
     def output(self) -> None:
         """Outputs all the configured ssh keys"""
 
-        wrapper = Path(sys.argv[0]).absolute().parent / "szh-wrapper"
-
         user: str
-        conf: UserConf
+        conf: UserSnapshot
         for user, conf in self.config.users.items():
             ssh_key: str
             for ssh_key in conf.ssh_keys:
-                print(f'command="{wrapper} {user}",restrict {ssh_key}')
+                print(self.__entry(user, ssh_key))
+
+    def output_matching(
+        self, login_user: str, fingerprint: str, key_type: str | None = None
+    ) -> None:
+        """
+        Outputs the single ssh key matching what the client offered, if any
+
+        :param login_user: The user being logged in as, sshd's %u token
+        :param fingerprint: The offered key's fingerprint, sshd's %f token
+        :param key_type: The offered key's type, sshd's %t token
+        """
+
+        if login_user != self.login_user:
+            return
+
+        try:
+            user, ssh_key = self.config.key_index[fingerprint]
+        except KeyError:
+            return
+
+        if key_type and ssh_key.split()[0] != key_type:
+            return
+
+        print(self.__entry(user, ssh_key))
 
 
 class SshZoneSudoers(SshZoneHandler):
     """Common class to pre-generate needed sudoers rules"""
 
-    def __log_rule(self) -> list[str]:
-        command = " ".join(self.journal_cmd)
-        rule = f"{self.login_user}\tALL=({self.journal_user}) NOPASSWD: {command}"
-        return [rule]
+    @staticmethod
+    def __log_windows() -> Iterator[tuple[str, str | None]]:
+        # Widest window first, making the default the very first rule
+        by_width = sorted(LOG_WINDOWS, key=lambda w: LOG_WINDOWS[w].seconds)
+        for since in reversed(by_width):
+            yield since, None
+            for until in by_width:
+                if LOG_WINDOWS[until].seconds < LOG_WINDOWS[since].seconds:
+                    yield since, until
+
+    def __log_rules(self) -> list[str]:
+        # One rule per possible invocation, rather than any wildcards
+        rules: list[str] = []
+        for reverse in (False, True):
+            for since, until in self.__log_windows():
+                command = " ".join(
+                    SUDOERS_SPECIAL.sub(r"\\\g<0>", arg)
+                    for arg in self._journal_cmd(since, until, reverse)
+                )
+                rules.append(
+                    f"{self.login_user}\tALL=({self.journal_user}) NOPASSWD: {command}"
+                )
+        return rules
 
     def _server_command_rules(self) -> list[str]:
         raise NotImplementedError("Gets defined in each daemon specific subclass")
@@ -63,7 +223,7 @@ class SshZoneSudoers(SshZoneHandler):
         """Outputs all the needed sudoers rules."""
 
         all_rules: list[str] = []
-        all_rules += self.__log_rule()
+        all_rules += self.__log_rules()
         all_rules += self._server_command_rules()
 
         for rule in all_rules:
@@ -73,77 +233,551 @@ class SshZoneSudoers(SshZoneHandler):
 class SshZoneCommand(SshZoneHandler):
     """Command class to runs the actual commands"""
 
-    def __init__(self, config: ZoneHandlerConf) -> None:
+    def __init__(self, config: ConfigSnapshot) -> None:
         super().__init__(config)
 
         self.sudo_prefix: Final[tuple[str, str]] = (
             "/usr/bin/sudo",
             f"--user={self.service_user}",
         )
+        self.max_workers: Final[int] = config.system.max_workers
+
+        # Kept local, sparing szh-sshkeys and szh-sudoers these imports
+        from .cache import DumpCache, MetaCache  # noqa: PLC0415
+        from .limits import CommandLimiter, RetransferCooldown  # noqa: PLC0415
+        from .logindex import LogIndex  # noqa: PLC0415
+
+        self.log_index: LogIndex | None = None
+        if config.system.log_index_dir:
+            self.log_index = LogIndex(
+                Path(config.system.log_index_dir),
+                config.system.log_index_max_bytes,
+            )
+
+        self.dump_cache: DumpCache | None = None
+        if config.system.dump_cache_dir:
+            self.dump_cache = DumpCache(
+                Path(config.system.dump_cache_dir),
+                config.system.dump_cache_max_bytes,
+            )
+
+        self.meta_cache: MetaCache | None = None
+        self.retransfer_cooldown: RetransferCooldown | None = None
+        self.limiter: CommandLimiter | None = None
+        if config.system.runtime_dir:
+            runtime_dir = Path(config.system.runtime_dir)
+            self.meta_cache = MetaCache(runtime_dir / "meta")
+            self.limiter = CommandLimiter(runtime_dir / "limits")
+            if config.system.retransfer_cooldown:
+                self.retransfer_cooldown = RetransferCooldown(
+                    runtime_dir / "retransfer", config.system.retransfer_cooldown
+                )
 
     @staticmethod
     def __parse(
         ssh_command: str,
-        user_zones: Sequence[str],
-    ) -> tuple[str | None, list[str]]:
+        user_zones: Container[str],
+    ) -> tuple[str | None, list[str], dict[str, str]]:
         args: list[str] = ssh_command.split()
         command: str | None = None
         zones: list[str] = []
+        options: dict[str, str] = {}
 
-        if args[0] in ["help", "list", "dump", "logs", "retransfer"]:
+        if args[0] in COMMANDS:
             command = args[0]
         args.pop(0)
 
         for arg in args:
-            if arg in user_zones:
+            if arg.startswith("--") and command:
+                name, sep, value = arg[2:].partition("=")
+                if name not in COMMAND_OPTIONS.get(command, ()) or (
+                    bool(sep) == (name in FLAG_OPTIONS)
+                ):
+                    raise InvokeError(f'Invalid option "{arg}", try "help"')
+                options[name] = value
+            elif arg in user_zones:
                 zones.append(arg)
 
-        return command, zones
+        return command, zones, options
 
     @staticmethod
     def _runner(command: Sequence[str], failure: str) -> CompletedProcess[str]:
+        from .metrics import Invocation  # noqa: PLC0415
+
+        started = time.perf_counter()
+        returncode = 0
         try:
             result = run(command, capture_output=True, check=True, text=True)
         except (FileNotFoundError, CalledProcessError) as err:
+            returncode = err.returncode if isinstance(err, CalledProcessError) else 127
             logging.debug("%s: %s", type(err).__name__, str(err))
             if isinstance(err, CalledProcessError):
                 logging.debug(err.stderr)
             raise InvokeError(failure) from err
+        finally:
+            if Invocation.active:
+                Invocation.active.subprocess(
+                    command, time.perf_counter() - started, returncode
+                )
 
         return result
 
+    @staticmethod
+    def _streamer(
+        command: Sequence[str], failure: str, success: Container[int] = (0,)
+    ) -> Generator[str, None, None]:
+        """
+        Like _runner(), but yields the standard output as it arrives
+
+        Only the tail end of the standard error is retained, for debug
+        logging. Should the generator get closed early the command gets
+        killed.
+
+        :param success: Exit codes not to be considered a failure
+        """
+
+        from .metrics import Invocation  # noqa: PLC0415
+
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        started = time.perf_counter()
+        try:
+            process = Popen(command, stdout=stdout_w, stderr=stderr_w)
+        except FileNotFoundError as err:
+            logging.debug("%s: %s", type(err).__name__, str(err))
+            for fd in (stdout_r, stdout_w, stderr_r, stderr_w):
+                os.close(fd)
+            raise InvokeError(failure) from err
+        os.close(stdout_w)
+        os.close(stderr_w)
+
+        decoder = getincrementaldecoder("utf-8")(errors="replace")
+        stderr = b""
+        try:
+            with DefaultSelector() as selector:
+                selector.register(stdout_r, EVENT_READ)
+                selector.register(stderr_r, EVENT_READ)
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        data = os.read(key.fd, STREAM_CHUNK_SIZE)
+                        if not data:
+                            selector.unregister(key.fd)
+                        elif key.fd == stderr_r:
+                            stderr = (stderr + data)[-STDERR_TAIL_SIZE:]
+                        elif chunk := decoder.decode(data):
+                            yield chunk
+            if tail := decoder.decode(b"", final=True):
+                yield tail
+            returncode = process.wait()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            os.close(stdout_r)
+            os.close(stderr_r)
+            if Invocation.active:
+                Invocation.active.subprocess(
+                    command, time.perf_counter() - started, process.returncode
+                )
+
+        if returncode not in success:
+            logging.debug(
+                "Command '%s' returned non-zero exit status %d.", command, returncode
+            )
+            logging.debug(stderr.decode(errors="replace"))
+            raise InvokeError(failure)
+
+    @staticmethod
+    def _lines(chunks: Iterable[str]) -> Iterator[str]:
+        """Regroup streamed output chunks into lines, without line endings"""
+
+        pending = ""
+        for chunk in chunks:
+            *lines, pending = (pending + chunk).split("\n")
+            yield from lines
+        if pending:
+            yield pending
+
+    def _cached(self, key: str, ttl: int, lookup: Callable[[], _T]) -> _T:
+        """
+        Query results shared across sessions, through the metadata cache
+
+        :param key: Identifies the query, and its arguments
+        :param ttl: For how many seconds the result may be reused
+        :param lookup: Performs the actual query, on a cache miss
+        """
+
+        if self.meta_cache:
+            cached: _T | None = self.meta_cache.get(key)
+            if cached is not None:
+                return cached
+
+        value = lookup()
+        if self.meta_cache:
+            self.meta_cache.put(key, value, ttl)
+        return value
+
+    def _invalidate(self, key: str) -> None:
+        """Drop a metadata cache entry known to be outdated"""
+
+        if self.meta_cache:
+            self.meta_cache.delete(key)
+
+    @staticmethod
+    def _write_chunks(chunks: Iterable[str]) -> None:
+        """
+        Pass streamed output on as it arrives, minus any trailing whitespace
+
+        Only whitespace is ever held back, until either more content or
+        the end of the output shows whether it trails.
+        """
+
+        held = ""
+        for chunk in chunks:
+            pending = held + chunk
+            content = pending.rstrip()
+            if content:
+                sys.stdout.write(content)
+            held = pending[len(content) :]
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
     @staticmethod
     def __usage() -> None:
         print("usage: command [ZONE]")
         print()
         print("help\t\t\tDisplay this help message")
         print("list\t\t\tList available zones")
-        print("dump ZONE\t\tOutput full content of ZONE")
+        print("status [ZONE1 ...]\tOutput serial, refresh and expiry of ZONE(s)")
+        print("dump ZONE1 [ZONE2]\tOutput full content of ZONE(s)")
+        print("  --since-serial=N\tOnly the records added (+) or removed (-) since N")
+        print("  --gzip\t\tgzip compressed output")
         print("logs ZONE1 [ZONE2]\tOutput the last five days' log entries for ZONE(s)")
-        print("retransfer ZONE\t\tTrigger a full (AXFR) retransfer of ZONE")
+        print("  --since=WINDOW\tOnly entries from within 1h, 6h, 1d, 2d or 5d")
+        print("  --until=WINDOW\tOnly entries older than 1h, 6h, 1d or 2d")
+        print("  --lines=N\t\tOnly the last N matching entries")
+        print("  --gzip\t\tgzip compressed output")
+        print("retransfer ZONE1 [ZONE2]\tTrigger full (AXFR) retransfers of ZONE(s)")
+        print("batch\t\t\tRun the commands read from stdin, one per line")
 
     @staticmethod
-    def _filter_logs(log_lines: list[str], zones: list[str]) -> Iterator[str]:
+    def _log_zones(line: str) -> Iterator[str]:
         raise NotImplementedError("Gets defined in each daemon specific subclass")
 
-    def __logs(self, zones: list[str]) -> None:
+    @classmethod
+    def _filter_logs(cls, log_lines: Iterable[str], zones: list[str]) -> Iterator[str]:
+        """
+        Single pass log filter
+
+        Each line gets scanned once for any zone name it refers to, which
+        then only needs to be looked up among the requested zones.
+        """
+
+        from .metrics import Invocation  # noqa: PLC0415
+
+        wanted = frozenset(zones)
+        scanned = matched = 0
+        try:
+            for line in log_lines:
+                scanned += 1
+                if not wanted.isdisjoint(cls._log_zones(line)):
+                    matched += 1
+                    yield line
+        finally:
+            if Invocation.active:
+                Invocation.active.count("log_lines_scanned", scanned)
+                Invocation.active.count("log_lines_matched", matched)
+
+    @staticmethod
+    def __log_options(options: dict[str, str]) -> tuple[str, str | None, int | None]:
+        windows = ", ".join(LOG_WINDOWS)
+
+        since = options.get("since", DEFAULT_LOG_WINDOW)
+        if since not in LOG_WINDOWS:
+            raise InvokeError(f"Invalid --since window, pick one of {windows}")
+
+        until = options.get("until")
+        if until is not None:
+            if until not in LOG_WINDOWS:
+                raise InvokeError(f"Invalid --until window, pick one of {windows}")
+            if LOG_WINDOWS[until].seconds >= LOG_WINDOWS[since].seconds:
+                raise InvokeError("The --until window must be shorter than --since")
+
+        lines: int | None = None
+        if "lines" in options:
+            value = options["lines"]
+            if not value.isdigit() or not 0 < int(value) <= MAX_LOG_LINES:
+                raise InvokeError(f"--lines must be between 1 and {MAX_LOG_LINES}")
+            lines = int(value)
+
+        return since, until, lines
+
+    def __logs(
+        self,
+        zones: list[str],
+        since: str = DEFAULT_LOG_WINDOW,
+        until: str | None = None,
+        lines: int | None = None,
+        flush: bool = True,
+    ) -> None:
+        now = time.time()
+        since_us = int((now - LOG_WINDOWS[since].seconds) * 1_000_000)
+        until_us: int | None = None
+        if until:
+            until_us = int((now - LOG_WINDOWS[until].seconds) * 1_000_000)
+
+        if self.log_index and self.log_index.covers(zones, since_us):
+            indexed: Iterable[str] = self.log_index.read(zones, since_us, until_us)
+            if lines:
+                indexed = deque(indexed, maxlen=lines)
+            for indexed_line in indexed:
+                print(indexed_line, flush=flush)
+            return
+
         zones_str = ", ".join(zones)
         failure = f"Failed to output log lines for the following zone(s): {zones_str}"
-        command = ("/usr/bin/sudo", f"--user={self.journal_user}") + self.journal_cmd
+        command: tuple[str, ...] = (
+            "/usr/bin/sudo",
+            f"--user={self.journal_user}",
+        ) + self._journal_cmd(since, until, reverse=bool(lines))
+
+        # Have journald skip the lines not about any zone, before they reach us
+        success: tuple[int, ...] = (0, 1) if self.journal_grep else (0,)
 
-        result: CompletedProcess[str] = self._runner(command, failure)
-        log_lines = result.stdout.split("\n")
+        # Stream, rather than buffer, what might be several days' worth of logs
+        chunks = self._streamer(command, failure, success)
+        matched: Iterable[str] = self._filter_logs(self._lines(chunks), zones)
+
+        if lines:
+            # Read newest first, and stop journalctl once enough got matched
+            try:
+                newest = list(islice(matched, lines))
+            finally:
+                chunks.close()
+            matched = reversed(newest)
 
         line: str
-        for line in self._filter_logs(log_lines, zones):
-            print(line)
+        for line in matched:
+            print(line, flush=flush)
+
+    def _zone_serial(self, zone: str) -> int:
+        raise NotImplementedError("Gets defined in each daemon specific subclass")
+
+    def _render(self, zone: str) -> Iterator[str]:
+        raise NotImplementedError("Gets defined in each daemon specific subclass")
+
+    def _dump(self, zone: str, since_serial: int | None = None) -> Iterator[str]:
+        if not self.dump_cache:
+            if since_serial is not None:
+                raise InvokeError("Delta dumps are not available")
+            return self._render(zone)
+
+        # Only render the zone again once its serial has changed, storing
+        # the result under the serial it was actually rendered at
+        cached = self.dump_cache.lookup(zone, self._zone_serial(zone))
+        if cached is None:
+            cached = self.dump_cache.store(zone, self._render(zone))
+
+        if since_serial is None:
+            return cached
+
+        delta = self.dump_cache.delta(zone, since_serial, self._lines(cached))
+        if delta is None:
+            raise InvokeError(
+                f'Serial {since_serial} of zone "{zone}" is not available, '
+                + "dump the full zone instead"
+            )
+        return delta
+
+    def _each_zone(
+        self, zones: list[str], work: Callable[[str], _T]
+    ) -> Iterator[tuple[str, _T | InvokeError]]:
+        """
+        Run the work for every zone on a bounded worker pool
+
+        Results, or failures, get yielded in zone order, as they complete.
+        Patterns matching none of the server's zones leave nothing to run.
+        """
 
-    def _dump(self, zone: str) -> None:
+        if not zones:
+            return
+
+        from concurrent.futures import ThreadPoolExecutor  # noqa: PLC0415
+
+        workers = min(self.max_workers, len(zones))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(zone, executor.submit(work, zone)) for zone in zones]
+            for zone, future in futures:
+                try:
+                    yield zone, future.result()
+                except InvokeError as err:
+                    yield zone, err
+
+    def __spool(self, zone: str) -> IO[str]:
+        from tempfile import SpooledTemporaryFile  # noqa: PLC0415
+
+        spooled = SpooledTemporaryFile(  # noqa: SIM115
+            max_size=DUMP_SPOOL_SIZE, mode="w+", encoding="utf-8"
+        )
+        try:
+            for chunk in self._dump(zone):
+                spooled.write(chunk)
+        except BaseException:
+            spooled.close()
+            raise
+        spooled.seek(0)
+        return spooled
+
+    @staticmethod
+    def __read_chunks(fin: IO[str]) -> Iterator[str]:
+        while chunk := fin.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+    def __dumps(self, zones: list[str], since_serial: int | None) -> None:
+        if len(zones) == 1:
+            self._write_chunks(self._dump(zones[0], since_serial))
+            return
+        if since_serial is not None:
+            raise InvokeError("--since-serial only applies to a single zone")
+
+        failed: list[str] = []
+        for zone, spooled in self._each_zone(zones, self.__spool):
+            print(f"; BEGIN zone {zone}")
+            if isinstance(spooled, InvokeError):
+                print(f"; ERROR {spooled}")
+                failed.append(zone)
+            else:
+                with spooled:
+                    self._write_chunks(self.__read_chunks(spooled))
+            print(f"; END zone {zone}", flush=True)
+
+        if failed:
+            raise InvokeError(
+                f"Failed to dump the following zone(s): {', '.join(failed)}"
+            )
+
+    def _server_zones(self) -> Iterator[str]:
         raise NotImplementedError("Gets defined in each daemon specific subclass")
 
+    def __granted_zones(self, grants: ZoneGrants) -> list[str]:
+        """Every zone of the user, patterns expanded against the server's zones"""
+
+        if not grants.patterns:
+            return list(grants.zones)
+
+        from .cache import ZONE_LIST_TTL  # noqa: PLC0415
+
+        server_zones: tuple[str, ...] = self._cached(
+            "zones", ZONE_LIST_TTL, lambda: tuple(self._server_zones())
+        )
+        return grants.expand(server_zones)
+
+    def _zone_status(self, zone: str) -> ZoneStatus:
+        raise NotImplementedError("Gets defined in each daemon specific subclass")
+
+    def _zone_statuses(
+        self, zones: list[str]
+    ) -> Iterator[tuple[str, ZoneStatus | InvokeError]]:
+        """Status of every zone, by default through parallel per-zone lookups"""
+        return self._each_zone(zones, self._zone_status)
+
+    def __statuses(self, zones: list[str]) -> None:
+        failed: list[str] = []
+        print("\t".join(("zone",) + ZoneStatus._fields))
+        for zone, status in self._zone_statuses(zones):
+            if isinstance(status, InvokeError):
+                failed.append(zone)
+            else:
+                print("\t".join((zone,) + status))
+
+        if failed:
+            raise InvokeError(
+                f"Failed to lookup status of the following zone(s): {', '.join(failed)}"
+            )
+
+    def __coalesced_retransfer(self, zone: str) -> float | None:
+        if not self.retransfer_cooldown:
+            self._retransfer(zone)
+            return None
+        return self.retransfer_cooldown.trigger(zone, self._retransfer)
+
+    def __retransfers(self, zones: list[str]) -> None:
+        failed: list[str] = []
+        for zone, result in self._each_zone(zones, self.__coalesced_retransfer):
+            if isinstance(result, InvokeError):
+                if len(zones) == 1:
+                    raise result
+                failed.append(zone)
+            elif result is not None:
+                elapsed = max(0, int(time.time() - result))
+                print(
+                    f'Retransfer of zone "{zone}" already pending, '
+                    + f"triggered {elapsed} seconds ago",
+                    flush=True,
+                )
+            else:
+                print(f'Triggering retransfer of zone "{zone}"', flush=True)
+
+        if failed:
+            raise InvokeError(
+                "Failed to trigger retransfer of the following zone(s): "
+                + ", ".join(failed)
+            )
+
+    @staticmethod
+    def __since_serial(options: dict[str, str]) -> int | None:
+        if "since-serial" not in options:
+            return None
+        value = options["since-serial"]
+        if not value.isdigit():
+            raise InvokeError("--since-serial must be a zone serial number")
+        return int(value)
+
+    @staticmethod
+    @contextmanager
+    def __output(options: dict[str, str]) -> Generator[None, None, None]:
+        """Optionally gzip compress whatever gets output to stdout"""
+
+        if "gzip" not in options:
+            yield
+            return
+
+        import gzip  # noqa: PLC0415
+
+        sys.stdout.flush()
+        with (
+            gzip.open(
+                sys.stdout.buffer, "wt", encoding="utf-8", compresslevel=GZIP_LEVEL
+            ) as compressed,
+            redirect_stdout(compressed),
+        ):
+            yield
+        sys.stdout.flush()
+
     def _retransfer(self, zone: str) -> None:
         raise NotImplementedError("Gets defined in each daemon specific subclass")
 
+    @contextmanager
+    def __limited(self, username: str, command: str) -> Generator[None, None, None]:
+        """Enforce the user's limits of the command, if any"""
+
+        from .limits import CommandLimit, LimitError  # noqa: PLC0415
+
+        limit = CommandLimit.merge(
+            self.config.system.limits.get(command, {}),
+            self.config.users[username].limits.get(command, {}),
+        )
+        if not self.limiter or limit == CommandLimit():
+            yield
+            return
+
+        try:
+            with self.limiter.acquire(username, command, limit):
+                yield
+        except LimitError as err:
+            logging.info("'%s' got limited: %s", username, str(err))
+            raise InvokeError(str(err)) from err
+
     def invoke(self, ssh_command: str, username: str) -> None:
         """
         Pick what, if any, command to invoke.
@@ -152,44 +786,127 @@ class SshZoneCommand(SshZoneHandler):
         :param username: Current user, executing the program
         """
 
-        user_zones: Sequence[str] = tuple(self.config.users[username].zones)
-        if not user_zones:
+        user_zones = ZoneGrants(self.config.users[username].zones)
+        if not user_zones.zones and not user_zones.patterns:
             raise InvokeError(f'No zones configured for user "{username}"')
 
+        from .metrics import Invocation  # noqa: PLC0415
+
+        invocation = Invocation.active
+        if not invocation:
+            self.__run(ssh_command, username, user_zones)
+            return
+
+        args = ssh_command.split()
+        invocation.command = args[0] if args and args[0] in COMMANDS else "invalid"
+        with invocation.phase("command"), invocation.counted_output():
+            self.__run(ssh_command, username, user_zones)
+
+    def __batch(self, username: str, user_zones: ZoneGrants) -> None:
+        """
+        Run every command read from stdin, one per line
+
+        Each command's output gets framed by a BATCH_BEGIN line, repeating
+        the command, and a BATCH_END line, followed by either "ok" or
+        "error" and the error message.
+        """
+
+        logging.info("'%s' starts a batch of commands", username)
+        total = failed = 0
+        for line in sys.stdin:
+            ssh_command = line.strip()
+            if not ssh_command or ssh_command.startswith("#"):
+                continue
+
+            total += 1
+            print(f"{BATCH_BEGIN} {ssh_command}", flush=True)
+            try:
+                self.__run(ssh_command, username, user_zones, batched=True)
+            except InvokeError as error:
+                failed += 1
+                logging.info("'%s' batch command failed: %s", username, str(error))
+                print(f"{BATCH_END} error {error}", flush=True)
+            else:
+                print(f"{BATCH_END} ok", flush=True)
+
+        if failed:
+            raise InvokeError(f"{failed} of {total} batch command(s) failed")
+
+    def __status_command(
+        self,
+        ssh_command: str,
+        username: str,
+        user_zones: ZoneGrants,
+        zones: list[str],
+    ) -> None:
+        # All of the user's zones, only when not asked for any
+        if len(ssh_command.split()) == 1:
+            zones = self.__granted_zones(user_zones)
+        elif not zones:
+            raise InvokeError("No valid zone provided")
+
+        logging.info(
+            "'%s' requests status of the following zone(s): %s",
+            username,
+            ", ".join(zones),
+        )
+        self.__statuses(zones)
+
+    def __run(
+        self,
+        ssh_command: str,
+        username: str,
+        user_zones: ZoneGrants,
+        batched: bool = False,
+    ) -> None:
         command: str | None
         zones: list[str]
-        command, zones = self.__parse(ssh_command, user_zones)
+        options: dict[str, str]
+        command, zones, options = self.__parse(ssh_command, user_zones)
+        zones = list(dict.fromkeys(zones))
 
         if not command:
             raise InvokeError('Invalid command, try "help"')
-
-        if command == "help":
-            logging.info("'%s' runs help command", username)
-            self.__usage()
-        elif command == "list":
-            logging.info("'%s' lists available zones", username)
-            for uzn in user_zones:
-                print(uzn)
-        elif not zones:
-            raise InvokeError("No valid zone provided")
-        elif command == "dump":
-            logging.info(
-                "'%s' requests dump of '%s' zone content",
-                username,
-                zones[0],
-            )
-            self._dump(zones[0])
-        elif command == "logs":
-            logging.info(
-                "'%s' requests log output for the following zone(s): %s",
-                username,
-                ", ".join(zones),
-            )
-            self.__logs(zones)
-        elif command == "retransfer":
-            logging.info(
-                "'%s' requests '%s' AXFR zone retransfer",
-                username,
-                zones[0],
-            )
-            self._retransfer(zones[0])
+        if batched and (command == "batch" or "gzip" in options):
+            raise InvokeError(f'"{ssh_command}" is not available within a batch')
+
+        with self.__limited(username, command):
+            if command == "help":
+                logging.info("'%s' runs help command", username)
+                self.__usage()
+            elif command == "list":
+                logging.info("'%s' lists available zones", username)
+                for uzn in self.__granted_zones(user_zones):
+                    print(uzn)
+            elif command == "status":
+                self.__status_command(ssh_command, username, user_zones, zones)
+            elif command == "batch":
+                self.__batch(username, user_zones)
+            elif not zones:
+                raise InvokeError("No valid zone provided")
+            elif command == "dump":
+                logging.info(
+                    "'%s' requests dump of the following zone(s): %s",
+                    username,
+                    ", ".join(zones),
+                )
+                since_serial = self.__since_serial(options)
+                with self.__output(options):
+                    self.__dumps(zones, since_serial)
+            elif command == "logs":
+                logging.info(
+                    "'%s' requests log output for the following zone(s): %s",
+                    username,
+                    ", ".join(zones),
+                )
+                log_options = self.__log_options(options)
+                with self.__output(options):
+                    # Flushing every line would defeat the compression
+                    self.__logs(zones, *log_options, flush="gzip" not in options)
+            elif command == "retransfer":
+                logging.info(
+                    "'%s' requests AXFR retransfer of the following zone(s): %s",
+                    username,
+                    ", ".join(zones),
+                )
+                self.__retransfers(zones)
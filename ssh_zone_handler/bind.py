@@ -1,17 +1,43 @@
 """BIND specific subclasses"""
 
+import logging
 import re
+import time
 from collections.abc import Iterator
+from pathlib import Path
 from subprocess import CompletedProcess
-from typing import Final
+from typing import TYPE_CHECKING, Final
 
-from .base import InvokeError, SshZoneCommand, SshZoneSudoers
-from .types import ZoneHandlerConf
+from .base import InvokeError, SshZoneCommand, SshZoneSudoers, ZoneStatus
+from .cache import SERIAL_TTL, ZONE_FILE_TTL
+from .metrics import phase
+from .snapshot import ConfigSnapshot
+
+if TYPE_CHECKING:
+    from .rndc import RndcClient
+
+# The zone name, as it appears in each kind of zone related log line,
+# anchored on the trailing class as classless reverse zones contain "/"
+LOG_ZONE_PATTERN: Final[re.Pattern[str]] = re.compile(
+    r"zone (\S+?)/IN\b"
+    + r"|'retransfer ([^'\s]+)'"
+    + r"|'([^'\s]+?)(?:/AXFR)?/IN'"
+    + r"|'([^'\s]+)'"
+)
+
+# For journalctl --grep, matching at least every line LOG_ZONE_PATTERN does
+JOURNAL_GREP: Final[str] = "'|/IN"
+
+ZONESTATUS_PATTERN: Final[re.Pattern[str]] = re.compile(r"^([^:]+): (.+)$")
 
 
 class BindSudoers(SshZoneSudoers):
     """Pre-generate needed BIND sudoers rules"""
 
+    @staticmethod
+    def _journal_grep() -> str:
+        return JOURNAL_GREP
+
     def _server_command_rules(self) -> list[str]:
         rules: list[str] = []
         for cmd in ["retransfer", "zonestatus"]:
@@ -20,39 +46,107 @@ class BindSudoers(SshZoneSudoers):
                 + f"/usr/sbin/rndc {cmd} *"
             )
             rules.append(rule)
+        rules.append(
+            f"{self.login_user}\tALL=({self.service_user}) NOPASSWD: "
+            + "/usr/bin/named-checkconf -l"
+        )
         return rules
 
 
 class BindCommand(SshZoneCommand):
     """Runs the actual commands, for BIND"""
 
-    def __init__(self, config: ZoneHandlerConf) -> None:
+    def __init__(self, config: ConfigSnapshot) -> None:
         super().__init__(config)
 
         self.rndc_prefix: Final[tuple[str, ...]] = self.sudo_prefix + (
             "/usr/sbin/rndc",
         )
+        self.rndc_control: Final[str | None] = config.system.rndc_control
+        self.rndc_key_file: Final[Path] = Path(config.system.rndc_key_file)
+        self.__rndc_client: RndcClient | None = None
+        self.__status: dict[str, tuple[float, dict[str, str]]] = {}
+
+    def __rndc(self, args: tuple[str, ...], failure: str) -> str:
+        """
+        Run an rndc command, returning its output
+
+        With rndc_control configured, over one reused control channel
+        session, rather than through sudo rndc.
+        """
+
+        if not self.rndc_control:
+            result: CompletedProcess[str] = self._runner(
+                self.rndc_prefix + args, failure
+            )
+            return result.stdout
+
+        from .rndc import RndcClient, RndcError, read_rndc_key  # noqa: PLC0415
+
+        try:
+            if self.__rndc_client is None:
+                key = read_rndc_key(self.rndc_key_file)
+                self.__rndc_client = RndcClient(self.rndc_control, key)
+            with phase("rndc_control"):
+                return self.__rndc_client.command(" ".join(args))
+        except RndcError as err:
+            logging.debug("RndcError: %s", str(err))
+            raise InvokeError(failure) from err
+
+    def __zonestatus_fields(self, zone: str) -> dict[str, str]:
+        # Both the serial and the zone file come from the same zonestatus call,
+        # reused no longer than the serial would be, for the sake of batches
+        fetched, _ = self.__status.get(zone, (0.0, {}))
+        if time.monotonic() - fetched >= SERIAL_TTL:
+            failure = f'Failed to lookup status of zone "{zone}"'
+            output = self.__rndc(("zonestatus", zone), failure)
+
+            status: dict[str, str] = {}
+            for line in output.split("\n"):
+                matched = ZONESTATUS_PATTERN.match(line)
+                if matched:
+                    status.setdefault(matched.group(1), matched.group(2))
+            self.__status[zone] = (time.monotonic(), status)
+
+        return self.__status[zone][1]
+
+    def __zonestatus(self, zone: str, field: str) -> str:
+        try:
+            return self.__zonestatus_fields(zone)[field]
+        except KeyError as err:
+            raise InvokeError(f'Failed to lookup {field} of zone "{zone}"') from err
+
+    def __lookup(self, zone: str, field: str, ttl: int) -> str:
+        return self._cached(
+            f"{field}:{zone}", ttl, lambda: self.__zonestatus(zone, field)
+        )
 
-    def __lookup(self, zone: str, failure: str) -> str | None:
-        zone_file: str | None = None
-        command = self.rndc_prefix + ("zonestatus", zone)
-
+    def _server_zones(self) -> Iterator[str]:
+        # One "name class view type" line per zone, of every view
+        failure = "Failed to list the zones of the server"
+        command = self.sudo_prefix + ("/usr/bin/named-checkconf", "-l")
         result: CompletedProcess[str] = self._runner(command, failure)
-
-        pattern = re.compile(r"^([^:]+): (.+)$")
         for line in result.stdout.split("\n"):
-            matched = pattern.match(line)
-            if matched and matched.group(1) == "files":
-                zone_file = matched.group(2)
-                break
-
-        return zone_file
+            if line.strip():
+                yield line.split()[0].rstrip(".").lower()
+
+    def _zone_serial(self, zone: str) -> int:
+        serial = self.__lookup(zone, "serial", SERIAL_TTL)
+        if not serial.isdigit():
+            raise InvokeError(f'Failed to lookup serial of zone "{zone}"')
+        return int(serial)
+
+    def _zone_status(self, zone: str) -> ZoneStatus:
+        status = self.__zonestatus_fields(zone)
+        return ZoneStatus(
+            serial=status.get("serial", "-"),
+            loaded=status.get("last loaded", "-"),
+            refresh=status.get("next refresh", "-"),
+            expires=status.get("expires", "-"),
+        )
 
-    def _dump(self, zone: str) -> None:
-        lookup_failure = f'Failed to lookup zone file for zone "{zone}"'
-        zone_file: str | None = self.__lookup(zone, lookup_failure)
-        if not zone_file:
-            raise InvokeError(lookup_failure)
+    def _render(self, zone: str) -> Iterator[str]:
+        zone_file = self.__lookup(zone, "files", ZONE_FILE_TTL)
 
         command = (
             "/usr/bin/named-compilezone",
@@ -65,27 +159,19 @@ class BindCommand(SshZoneCommand):
         )
 
         run_failure = f'Failed to dump content of zone "{zone}"'
-        result: CompletedProcess[str] = self._runner(command, run_failure)
-        zone_content = result.stdout.rstrip()
+        return self._streamer(command, run_failure)
 
-        print(zone_content)
+    @staticmethod
+    def _log_zones(line: str) -> Iterator[str]:
+        for matched in LOG_ZONE_PATTERN.finditer(line):
+            yield matched.group(matched.lastindex or 0)
 
     @staticmethod
-    def _filter_logs(log_lines: list[str], zones: list[str]) -> Iterator[str]:
-        for line in log_lines:
-            for zone in zones:
-                if (
-                    f"zone {zone}/IN" in line
-                    or f"'retransfer {zone}'" in line
-                    or f"'{zone}/AXFR/IN'" in line
-                    or f"'{zone}/IN'" in line
-                    or f"'{zone}'" in line
-                ):
-                    yield line
+    def _journal_grep() -> str:
+        return JOURNAL_GREP
 
     def _retransfer(self, zone: str) -> None:
         failure = f'Failed to trigger retransfer of zone "{zone}"'
-        command = self.rndc_prefix + ("retransfer", zone)
-
-        self._runner(command, failure)
-        print(f'Triggering retransfer of zone "{zone}"')
+        self.__rndc(("retransfer", zone), failure)
+        self._invalidate(f"serial:{zone}")
+        self.__status.pop(zone, None)
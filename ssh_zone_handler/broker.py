@@ -0,0 +1,220 @@
+"""Long-running command broker, and the wrapper's client side of it"""
+
+import logging
+import os
+import socket
+import struct
+import sys
+from collections.abc import Callable, Collection
+from pathlib import Path
+from socketserver import BaseRequestHandler, ForkingMixIn, UnixStreamServer
+from typing import Any, Final, cast
+
+from .base import InvokeError, SshZoneCommand
+from .metrics import Invocation, report
+from .profiling import profiled
+from .snapshot import ConfigSnapshot, ConfigStat, config_stat
+
+CONNECT_TIMEOUT: Final[int] = 5
+REQUEST_TIMEOUT: Final[int] = 10
+MAX_REQUEST_SIZE: Final[int] = 64 * 1024
+MAX_CHILDREN: Final[int] = 64
+SD_LISTEN_FDS_START: Final[int] = 3
+
+# Exit status sent back to a client the broker won't serve, for it to
+# run the command itself, as if no broker were running
+REJECTED_STATUS: Final[int] = 255
+
+
+class BrokerError(Exception):
+    """Failure to talk to the broker"""
+
+
+def peer_uid(sock: socket.socket) -> int:
+    """The uid of the process at the other end of a UNIX socket"""
+
+    peer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", peer)
+    return int(uid)
+
+
+def invoke_via_broker(socket_path: Path, ssh_command: str, username: str) -> int | None:
+    """
+    Have the broker run the command, straight off our stdin/stdout/stderr
+
+    Rather than relaying any input or output, all three file descriptors
+    get passed along with the request. Only the exit status comes back. Returns
+    None when the broker isn't running, or rejects our uid or user, nothing
+    having been run yet.
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(os.fspath(socket_path))
+    except OSError as err:
+        logging.debug("Unable to reach broker: %s", str(err))
+        sock.close()
+        return None
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        request = f"{username}\0{ssh_command}".encode()
+        fds = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+        socket.send_fds(sock, [request], fds)
+        sock.shutdown(socket.SHUT_WR)
+
+        # Dumps of big zones take as long as they take
+        sock.settimeout(None)
+        status = sock.recv(1)
+    except OSError as err:
+        raise BrokerError(f"Lost connection to broker: {err}") from err
+    finally:
+        sock.close()
+
+    if not status:
+        raise BrokerError("Broker closed the connection early")
+    if status[0] == REJECTED_STATUS:
+        logging.debug("Rejected by broker, running the command locally")
+        return None
+    return status[0]
+
+
+class SshZoneBroker(ForkingMixIn, UnixStreamServer):
+    """
+    Runs wrapper requests in forked children, of an already loaded config
+
+    The config gets reloaded whenever the config file changes, in the
+    parent process, keeping every child a cheap fork away from running
+    the actual command.
+    """
+
+    max_children = MAX_CHILDREN
+
+    def __init__(
+        self,
+        listen: Path | int,
+        config_file: Path,
+        load_config: Callable[[], ConfigSnapshot],
+        command_class: Callable[[ConfigSnapshot], type[SshZoneCommand]],
+        allowed_uids: Collection[int],
+    ) -> None:
+        """
+        :param listen: Socket path, or an already listening socket as set up by systemd
+        """
+
+        self.config_file: Final[Path] = config_file
+        self.load_config: Final[Callable[[], ConfigSnapshot]] = load_config
+        self.command_class: Final[Callable[[ConfigSnapshot], type[SshZoneCommand]]] = (
+            command_class
+        )
+        self.allowed_uids: Final[Collection[int]] = allowed_uids
+
+        self.config: ConfigSnapshot = load_config()
+        self.handler_class: type[SshZoneCommand] = command_class(self.config)
+        self.__config_stat: ConfigStat = config_stat(config_file)
+
+        if isinstance(listen, int):
+            super().__init__("", SshZoneBrokerHandler, bind_and_activate=False)
+            self.socket.close()
+            self.socket = socket.socket(fileno=listen)
+            self.server_address = self.socket.getsockname()
+        else:
+            listen.unlink(missing_ok=True)
+            super().__init__(os.fspath(listen), SshZoneBrokerHandler)
+            listen.chmod(0o666)
+
+    def refresh(self) -> None:
+        """Reload the config, if any of the config files changed"""
+
+        stats = config_stat(self.config_file)
+        if stats == self.__config_stat:
+            return
+
+        try:
+            config = self.load_config()
+            handler_class = self.command_class(config)
+        except Exception as err:
+            logging.error("Keeping the previous config: %s", str(err))
+            return
+
+        self.config, self.handler_class = config, handler_class
+        self.__config_stat = stats
+        logging.info("Reloaded %s", self.config_file)
+
+    def verify_request(
+        self,
+        request: socket.socket | tuple[bytes, socket.socket],
+        client_address: Any,  # noqa: ANN401
+    ) -> bool:
+        """Pick up config changes, before forking off the child"""
+
+        self.refresh()
+        return super().verify_request(request, client_address)
+
+
+class SshZoneBrokerHandler(BaseRequestHandler):
+    """A single wrapper request, in its own forked child"""
+
+    def handle(self) -> None:
+        """Take over the client's stdin/stdout/stderr, then invoke the command"""
+
+        server = cast("SshZoneBroker", self.server)
+        self.request.settimeout(REQUEST_TIMEOUT)
+        try:
+            message, fds, _, _ = socket.recv_fds(self.request, MAX_REQUEST_SIZE, 3)
+        except OSError as err:
+            logging.warning("Broker request failed: %s", str(err))
+            return
+
+        # Only reply once the request got read, never resetting the connection
+        uid = peer_uid(self.request)
+        if uid not in server.allowed_uids:
+            logging.warning("Rejected broker client uid %d", uid)
+            for fd in fds:
+                os.close(fd)
+            self.__reply(REJECTED_STATUS)
+            return
+        if len(fds) != 3 or b"\0" not in message:  # noqa: PLR2004
+            logging.warning("Rejected malformed broker request")
+            for fd in fds:
+                os.close(fd)
+            return
+
+        username, _, ssh_command = message.decode(errors="replace").partition("\0")
+        if username not in server.config.users:
+            # Possibly just added, have the wrapper go by its own config
+            logging.warning('Unknown user "%s"', username)
+            for fd in fds:
+                os.close(fd)
+            self.__reply(REJECTED_STATUS)
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, target in zip(fds, (0, 1, 2), strict=True):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        status = 1
+        invocation = Invocation.start(username, server.config.system.server_type)
+        try:
+            with profiled(server.config, "broker", username):
+                server.handler_class(server.config).invoke(ssh_command, username)
+            status = 0
+        except InvokeError as error:
+            logging.critical(str(error))
+        except Exception:
+            logging.exception("Broker command failed")
+        report(
+            invocation, "error" if status else "ok", server.config.system.metrics_dir
+        )
+        self.__reply(status)
+
+    def __reply(self, status: int) -> None:
+        try:
+            sys.stdout.flush()
+            self.request.sendall(bytes((status,)))
+        except OSError:
+            pass
@@ -0,0 +1,295 @@
+"""On-disk caches of command output"""
+
+import hashlib
+import logging
+import marshal
+import os
+import stat
+import time
+from collections.abc import Iterable, Iterator
+from itertools import chain
+from pathlib import Path
+from typing import Any, Final
+
+READ_CHUNK_SIZE: Final[int] = 64 * 1024
+DELTA_HISTORY: Final[int] = 3
+
+META_MAX_ENTRIES: Final[int] = 4096
+ZONE_FILE_TTL: Final[int] = 60 * 60
+SERIAL_TTL: Final[int] = 10
+ZONE_LIST_TTL: Final[int] = 60
+
+
+def trusted_dir(path: Path) -> bool:
+    """
+    Create the directory if need be, then check it's owned by, and only
+    writable by, the current user
+    """
+
+    try:
+        path.mkdir(mode=0o700, exist_ok=True)
+        dir_stat = path.stat()
+    except OSError:
+        return False
+
+    trusted = dir_stat.st_uid == os.geteuid() and not (
+        dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+    if not trusted:
+        logging.debug("Ignoring untrusted %s", path)
+    return trusted
+
+
+def soa_serial(line: str) -> int | None:
+    """The serial of a zone file line, if it's an SOA record"""
+
+    fields = line.split()
+    try:
+        position = [field.upper() for field in fields].index("SOA")
+        return int(fields[position + 3])
+    except (ValueError, IndexError):
+        return None
+
+
+class DumpCache:
+    """
+    Rendered zone content, keyed by zone and SOA serial
+
+    The serial gets taken from the SOA record leading the rendered content
+    itself, never from an earlier, possibly outdated, lookup. Each entry is a single file, with its mtime refreshed on every hit.
+    Once the total size exceeds the limit the least recently used
+    entries get evicted. A few earlier serials of each zone are retained,
+    for delta dumps. Only a cache directory owned by, and only writable
+    by, the current user is trusted, otherwise nothing gets cached.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int) -> None:
+        self.cache_dir: Final[Path] = cache_dir
+        self.max_bytes: Final[int] = max_bytes
+        self.__usable: bool | None = None
+
+    def __entry(self, zone: str, serial: int) -> Path:
+        # Classless in-addr.arpa zones contain a slash, never an underscore
+        return self.cache_dir / f"{zone.replace('/', '_')}@{serial}.zone"
+
+    def __trusted(self) -> bool:
+        if self.__usable is None:
+            self.__usable = trusted_dir(self.cache_dir)
+        return self.__usable
+
+    def lookup(self, zone: str, serial: int) -> Iterator[str] | None:
+        """The cached content in chunks, or None on a cache miss"""
+
+        if not self.__trusted():
+            return None
+        entry = self.__entry(zone, serial)
+        try:
+            fin = entry.open(encoding="utf-8")
+        except OSError:
+            return None
+
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        def chunks() -> Iterator[str]:
+            with fin:
+                while chunk := fin.read(READ_CHUNK_SIZE):
+                    yield chunk
+
+        return chunks()
+
+    def store(self, zone: str, chunks: Iterable[str]) -> Iterator[str]:
+        """
+        Pass the chunks through, while writing them to the cache
+
+        The entry only gets put in place once every chunk got through,
+        never on a partial dump, keyed by the serial of its leading SOA
+        record. Failing to write is not an error.
+        """
+
+        if not self.__trusted():
+            yield from chunks
+            return
+
+        tmp_file = self.cache_dir / f".{zone.replace('/', '_')}.{os.getpid()}"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except OSError as err:
+            logging.debug("Unable to cache zone dump: %s", str(err))
+            yield from chunks
+            return
+
+        first_line = ""
+        complete = False
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fout:
+                for chunk in chunks:
+                    yield chunk
+                    fout.write(chunk)
+                    if "\n" not in first_line:
+                        first_line += chunk
+            complete = True
+        except OSError as err:
+            logging.debug("Unable to cache zone dump: %s", str(err))
+            yield from chunks
+        finally:
+            serial = soa_serial(first_line.partition("\n")[0])
+            if not complete or serial is None:
+                tmp_file.unlink(missing_ok=True)
+
+        if complete and serial is None:
+            logging.debug('No SOA record leading the dump of zone "%s"', zone)
+        elif complete and serial is not None:
+            entry = self.__entry(zone, serial)
+            try:
+                os.replace(tmp_file, entry)
+                self.evict(keep=entry)
+            except OSError as err:
+                logging.debug("Unable to cache zone dump: %s", str(err))
+
+    def delta(
+        self, zone: str, old_serial: int, lines: Iterable[str]
+    ) -> Iterator[str] | None:
+        """
+        The records added (+) and removed (-) since an earlier serial
+
+        Returns None when the earlier serial is no longer retained.
+
+        :param lines: The current zone content, line by line, SOA first
+        """
+
+        if not self.__trusted():
+            return None
+        try:
+            with self.__entry(zone, old_serial).open(encoding="utf-8") as fin:
+                # An insertion ordered set, to list removals in zone order
+                removed = dict.fromkeys(line.rstrip("\n") for line in fin)
+        except OSError:
+            return None
+        removed.pop("", None)
+
+        def changes() -> Iterator[str]:
+            current = iter(lines)
+            first_line = next(current, "")
+            new_serial = soa_serial(first_line)
+            yield f"; {zone} changes from serial {old_serial} to {new_serial}\n"
+            for line in chain((first_line,), current):
+                if line in removed:
+                    del removed[line]
+                elif line:
+                    yield f"+{line}\n"
+            for line in removed:
+                yield f"-{line}\n"
+
+        return changes()
+
+    def evict(self, keep: Path | None = None) -> None:
+        """Drop old serials, and the least recently used beyond the limit"""
+
+        entries: list[tuple[float, int, Path]] = []
+        history: list[tuple[float, Path]] = []
+        keep_prefix = keep.name.rpartition("@")[0] + "@" if keep else None
+        for path in self.cache_dir.glob("*.zone"):
+            try:
+                file_stat = path.stat()
+            except OSError:
+                continue
+            if keep_prefix and path != keep and path.name.startswith(keep_prefix):
+                history.append((file_stat.st_mtime, path))
+            entries.append((file_stat.st_mtime, file_stat.st_size, path))
+
+        # Beyond the most recent few, earlier serials are of no use
+        outdated = {path for _, path in sorted(history)[:-DELTA_HISTORY]}
+        for path in outdated:
+            path.unlink(missing_ok=True)
+        entries = [entry for entry in entries if entry[2] not in outdated]
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                path.unlink(missing_ok=True)
+                total -= size
+
+
+class MetaCache:
+    """
+    Small results of backend queries, shared between concurrent sessions
+
+    Every entry is a single marshalled file, named after a digest of its
+    key, and with its own expiry time. Only a cache directory owned by,
+    and only writable by, the current user is trusted.
+    """
+
+    def __init__(self, cache_dir: Path, max_entries: int = META_MAX_ENTRIES) -> None:
+        self.cache_dir: Final[Path] = cache_dir
+        self.max_entries: Final[int] = max_entries
+        self.__usable: bool | None = None
+
+    def __entry(self, key: str) -> Path:
+        return self.cache_dir / hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def __trusted(self) -> bool:
+        if self.__usable is None:
+            self.__usable = trusted_dir(self.cache_dir)
+        return self.__usable
+
+    def get(self, key: str) -> Any:  # noqa: ANN401
+        """The cached value, or None if missing or expired"""
+
+        if not self.__trusted():
+            return None
+        try:
+            expires, stored_key, value = marshal.loads(  # noqa: S302
+                self.__entry(key).read_bytes()
+            )
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if stored_key != key or expires < time.time():
+            return None
+        return value
+
+    def put(self, key: str, value: Any, ttl: int) -> None:  # noqa: ANN401
+        """Atomically store a marshallable value, for ttl seconds"""
+
+        if not self.__trusted():
+            return
+
+        entry = self.__entry(key)
+        tmp_file = self.cache_dir / f".{entry.name}.{os.getpid()}"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(marshal.dumps((time.time() + ttl, key, value)))
+            os.replace(tmp_file, entry)
+            self.evict()
+        except (OSError, ValueError) as err:
+            logging.debug("Unable to cache %s: %s", key, str(err))
+            tmp_file.unlink(missing_ok=True)
+
+    def delete(self, key: str) -> None:
+        """Drop an entry known to be outdated"""
+
+        if self.__trusted():
+            self.__entry(key).unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        """Drop the least recently stored entries beyond the limit"""
+
+        entries: list[tuple[float, Path]] = []
+        with os.scandir(self.cache_dir) as scan:
+            for dir_entry in scan:
+                if dir_entry.name.startswith("."):
+                    continue
+                try:
+                    entries.append((dir_entry.stat().st_mtime, Path(dir_entry.path)))
+                except OSError:
+                    continue
+
+        if len(entries) > self.max_entries:
+            for _, path in sorted(entries)[: len(entries) - self.max_entries]:
+                path.unlink(missing_ok=True)
@@ -1,41 +1,101 @@
 """CLI scripts entry points"""
 
+import binascii
 import logging
-import logging.config
 import os
 import sys
+from contextlib import AbstractContextManager, nullcontext
 from pathlib import Path
-from typing import Final, Literal
-
-import yaml
-from pydantic import ValidationError
-
-from .base import InvokeError, SshZoneAuthorizedKeys
-from .bind import BindCommand, BindSudoers
-from .knot import KnotCommand, KnotSudoers
-from .static import LOGCONF
-from .types import ZoneHandlerConf
+from typing import TYPE_CHECKING, Any, Final, Literal
+
+from .base import InvokeError, SshZoneAuthorizedKeys, SshZoneCommand, SshZoneSudoers
+from .snapshot import (
+    ConfigSnapshot,
+    SnapshotCache,
+    compile_config,
+    config_diff,
+    ssh_key_fingerprint,
+    tenant_dir,
+)
+from .static import CONSOLE_LOGCONF, LOGCONF
+
+if TYPE_CHECKING:
+    from .types import ZoneHandlerConf
 
 CONFIG_FILE: Final[Path] = Path("/etc/zone-handler.yaml")
-
-logging.config.dictConfig(LOGCONF)
+SNAPSHOT_DIR: Final[Path] = Path("/var/cache/ssh-zone-handler")
 
 
 class ConfigFileError(Exception):
     """Summarizes config file parsing exceptions"""
 
 
+def _setup_logging(logconf: dict[str, Any]) -> None:
+    # Like logging.basicConfig(), leave already configured logging alone
+    if logging.getLogger().handlers:
+        return
+
+    from logging.config import dictConfig  # noqa: PLC0415
+
+    dictConfig(logconf)
+
+
 def _error_out(message: str) -> None:
     logging.critical(message)
     sys.exit(1)
 
 
+def _user_files(config_file: Path, user: str | None) -> list[Path]:
+    user_dir = tenant_dir(config_file)
+    if user is None:
+        return sorted(user_dir.glob("*.yaml"))
+    if Path(user).name != user or user.startswith("."):
+        return []
+    return [user_dir / f"{user}.yaml"]
+
+
 def _read_config(
-    config_file: Path, errors: Literal["default", "verbose"] = "default"
-) -> ZoneHandlerConf:
+    config_file: Path,
+    errors: Literal["default", "verbose"] = "default",
+    reference: ConfigSnapshot | None = None,
+    user: str | None = None,
+) -> "ZoneHandlerConf":
+    """
+    :param reference: An earlier config, to skip revalidating unchanged users
+    :param user: Only read, and validate, the config of this single user
+    """
+
+    # Kept local, as a fresh snapshot spares most callers these imports
+    import yaml  # noqa: PLC0415
+    from pydantic import ValidationError  # noqa: PLC0415
+
+    from .types import ZoneHandlerConf, reuse_validated_users  # noqa: PLC0415
+
+    # The libyaml based loader, when available, is an order of magnitude faster
+    loader = yaml.CSafeLoader if yaml.__with_libyaml__ else yaml.SafeLoader
     try:
         with open(config_file, encoding="utf-8") as fin:
-            config = ZoneHandlerConf(**yaml.safe_load(fin))
+            content = yaml.load(fin, Loader=loader)  # noqa: S506
+
+        if isinstance(content, dict) and isinstance(content.get("users", {}), dict):
+            users = content.setdefault("users", {})
+            if user is not None:
+                content["users"] = users = {user: users[user]} if user in users else {}
+            for user_file in _user_files(config_file, user):
+                try:
+                    with open(user_file, encoding="utf-8") as fin:
+                        user_conf = yaml.load(fin, Loader=loader)  # noqa: S506
+                except FileNotFoundError:
+                    continue
+                if user_file.stem in users:
+                    raise ConfigFileError(
+                        f'User "{user_file.stem}" configured more than once'
+                    )
+                users[user_file.stem] = user_conf
+
+        if reference and isinstance(content, dict) and "users" in content:
+            content["users"] = reuse_validated_users(content["users"], reference)
+        config = ZoneHandlerConf(**content)
     except (FileNotFoundError, PermissionError) as fae:
         msg_fae = "Unable to access server side config file"
         raise ConfigFileError(msg_fae) from fae
@@ -51,48 +111,173 @@ def _read_config(
     return config
 
 
+def _snapshot_dir() -> Path:
+    """
+    The running user's own subdirectory, as szh-sshkeys and szh-wrapper
+    each run as a different user
+    """
+
+    import pwd  # noqa: PLC0415
+
+    try:
+        return SNAPSHOT_DIR / pwd.getpwuid(os.geteuid()).pw_name
+    except KeyError:
+        return SNAPSHOT_DIR / str(os.geteuid())
+
+
+def _load_config(
+    config_file: Path,
+    errors: Literal["default", "verbose"] = "default",
+    user: str | None = None,
+    fingerprint: str | None = None,
+) -> ConfigSnapshot:
+    """
+    :param user: Only load the config of this single user, along with system
+    :param fingerprint: Only load the key_index entry of this single ssh key,
+        along with system, when stored on its own
+    """
+
+    snapshot_cache = SnapshotCache(config_file, _snapshot_dir(), user)
+
+    config: ConfigSnapshot | None = None
+    if fingerprint is not None:
+        config = snapshot_cache.load_key(fingerprint)
+        if config is not None:
+            return config
+
+    config = snapshot_cache.load()
+    if config is None:
+        config = compile_config(_read_config(config_file, errors, user=user))
+        snapshot_cache.store(config)
+        if fingerprint is not None:
+            snapshot_cache.store_keys(config)
+    elif fingerprint is not None:
+        snapshot_cache.store_keys(config, fingerprint)
+
+    return config
+
+
+def _profiled(
+    config: ConfigSnapshot, name: str, user: str | None = None
+) -> AbstractContextManager[None]:
+    """profiled(), only imported when there's a profile_dir to write to"""
+
+    if not config.system.profile_dir:
+        return nullcontext()
+
+    from .profiling import profiled  # noqa: PLC0415
+
+    return profiled(config, name, user)
+
+
+def _command_class(config: ConfigSnapshot) -> type[SshZoneCommand]:
+    # Only import the one backend actually configured
+    if config.system.server_type == "bind":
+        from .bind import BindCommand  # noqa: PLC0415
+
+        return BindCommand
+    if config.system.server_type == "knot":
+        from .knot import KnotCommand  # noqa: PLC0415
+
+        return KnotCommand
+    raise ConfigFileError("Unsupported server configured")
+
+
 def verifier() -> None:
     """
     Entry point for the szh-verify script
 
-    Verifies the syntax of a not-yet-installed config file
+    Verifies the syntax of a not-yet-installed config file. Compared
+    against the currently installed config, only the users that changed
+    get revalidated, and a summary of the changes gets output.
 
-    Usage: /path/to/szh-verify /new/zone-handler.yaml
+    Usage: /path/to/szh-verify /new/zone-handler.yaml [--against /etc/zone-handler.yaml]
     """
 
-    try:
-        config_file = Path(sys.argv[1])
-    except IndexError:
-        _error_out(f"Usage: {sys.argv[0]} /path/to/zone-handler.yaml")
+    _setup_logging(CONSOLE_LOGCONF)
+
+    reference_file: Path | None = None
+    match sys.argv[1:]:
+        case [config_path]:
+            config_file = Path(config_path)
+        case [config_path, "--against", reference_path]:
+            config_file, reference_file = Path(config_path), Path(reference_path)
+        case _:
+            _error_out(
+                f"Usage: {sys.argv[0]} /path/to/zone-handler.yaml "
+                + "[--against /etc/zone-handler.yaml]"
+            )
+            return
+
+    reference: ConfigSnapshot | None = None
+    if reference_file:
+        try:
+            reference = _load_config(reference_file)
+        except ConfigFileError as cfe:
+            _error_out(f"{cfe} {reference_file}")
 
     try:
-        _read_config(config_file, errors="verbose")
+        config = _read_config(config_file, errors="verbose", reference=reference)
     except ConfigFileError as cfe:
         _error_out(str(cfe))
 
+    from .types import shared_zones  # noqa: PLC0415
+
+    for zone, users in shared_zones(config.users).items():
+        logging.warning('Zone "%s" shared by: %s', zone, ", ".join(users))
+
+    if reference:
+        for change in config_diff(reference, compile_config(config)):
+            print(change)
+
 
 def ssh_keys(config_file: Path = CONFIG_FILE) -> None:
     """
     Entry point for the szh-sshkeys script
 
-    Used as an AuthorizedKeysCommand command
+    Used as an AuthorizedKeysCommand command. Without arguments every
+    configured key gets output. Provided with the sshd %u user and
+    either the %f fingerprint, or the %t type and %k key, only the
+    single matching key gets output.
 
     Match User zones
          AuthorizedKeysFile none
          AuthorizedKeysCommandUser szh-sshdcmd
-         AuthorizedKeysCommand /path/to/szh-sshkeys
+         AuthorizedKeysCommand /path/to/szh-sshkeys %u %t %k
          DisableForwarding yes
          PermitTTY no
     """
 
+    _setup_logging(LOGCONF)
+
+    offered: tuple[str, str, str | None] | None = None
+    match sys.argv[1:]:
+        case []:
+            pass
+        case [login_user, fingerprint]:
+            offered = (login_user, fingerprint, None)
+        case [login_user, key_type, key_blob]:
+            try:
+                offered = (login_user, ssh_key_fingerprint(key_blob), key_type)
+            except binascii.Error:
+                return
+        case _:
+            _error_out(f"Usage: {sys.argv[0]} [%u %f | %u %t %k]")
+
     try:
-        config: ZoneHandlerConf = _read_config(config_file)
+        config: ConfigSnapshot = _load_config(
+            config_file, fingerprint=offered[1] if offered else None
+        )
     except ConfigFileError as cfe:
         logging.debug(str(cfe))
         sys.exit(1)
 
-    szh_authorized_keys = SshZoneAuthorizedKeys(config)
-    szh_authorized_keys.output()
+    with _profiled(config, "sshkeys"):
+        szh_authorized_keys = SshZoneAuthorizedKeys(config)
+        if offered:
+            szh_authorized_keys.output_matching(*offered)
+        else:
+            szh_authorized_keys.output()
 
 
 def sudoers(config_file: Path = CONFIG_FILE) -> None:
@@ -104,15 +289,22 @@ def sudoers(config_file: Path = CONFIG_FILE) -> None:
     Usage: /path/to/szh-sudoers | EDITOR="tee" visudo -f /etc/sudoers.d/zone-handler
     """
 
+    _setup_logging(LOGCONF)
+
     try:
-        config: ZoneHandlerConf = _read_config(config_file, errors="verbose")
+        config: ConfigSnapshot = _load_config(config_file, errors="verbose")
     except ConfigFileError as cfe:
         _error_out(str(cfe))
 
-    szh_sudoers: BindSudoers | KnotSudoers
+    # Only import the one backend actually configured
+    szh_sudoers: SshZoneSudoers
     if config.system.server_type == "bind":
+        from .bind import BindSudoers  # noqa: PLC0415
+
         szh_sudoers = BindSudoers(config)
     elif config.system.server_type == "knot":
+        from .knot import KnotSudoers  # noqa: PLC0415
+
         szh_sudoers = KnotSudoers(config)
     else:
         _error_out("Unsupported server configured")
@@ -129,31 +321,186 @@ def wrapper(config_file: Path = CONFIG_FILE) -> None:
     command="/path/to/szh-wrapper alice@example.com",restrict ssh-ed25519 AAAAC3NzaC1lZDI1NTE5...
     """
 
+    _setup_logging(LOGCONF)
+
     try:
         username = sys.argv[1]
     except IndexError:
         _error_out(f"Usage: {sys.argv[0]} username")
 
-    try:
-        config: ZoneHandlerConf = _read_config(config_file)
-    except ConfigFileError as cfe:
-        _error_out(str(cfe))
-
     ssh_command = "help"
     try:
         ssh_command = os.environ["SSH_ORIGINAL_COMMAND"]
     except KeyError:
         pass
 
-    szh_command: BindCommand | KnotCommand
-    if config.system.server_type == "bind":
-        szh_command = BindCommand(config)
-    elif config.system.server_type == "knot":
-        szh_command = KnotCommand(config)
-    else:
-        _error_out("Unsupported server configured")
+    from .metrics import Invocation, report  # noqa: PLC0415
 
+    invocation = Invocation.start(username)
     try:
-        szh_command.invoke(ssh_command, username)
+        with invocation.phase("config"):
+            config: ConfigSnapshot = _load_config(config_file, user=username)
+    except ConfigFileError as cfe:
+        invocation.finish("error")
+        _error_out(str(cfe))
+    invocation.backend = config.system.server_type
+
+    if config.system.broker_socket:
+        from .broker import BrokerError, invoke_via_broker  # noqa: PLC0415
+
+        try:
+            status = invoke_via_broker(
+                Path(config.system.broker_socket), ssh_command, username
+            )
+        except BrokerError as error:
+            _error_out(str(error))
+        if status is not None:
+            sys.exit(status)
+
+    try:
+        command_class: type[SshZoneCommand] = _command_class(config)
+    except ConfigFileError as cfe:
+        _error_out(str(cfe))
+
+    szh_command = command_class(config)
+    try:
+        with _profiled(config, "wrapper", username):
+            szh_command.invoke(ssh_command, username)
     except InvokeError as error:
+        report(invocation, "error", config.system.metrics_dir)
         _error_out(str(error))
+    report(invocation, "ok", config.system.metrics_dir)
+
+
+def broker(config_file: Path = CONFIG_FILE) -> None:
+    """
+    Entry point for the szh-broker script
+
+    Keeps the config loaded, running the commands handed over by
+    szh-wrapper. Meant to be run as a service, as the login_user,
+    either listening on broker_socket itself or socket activated.
+    """
+
+    _setup_logging(LOGCONF)
+
+    try:
+        config: ConfigSnapshot = _load_config(config_file, errors="verbose")
+        _command_class(config)
+    except ConfigFileError as cfe:
+        _error_out(str(cfe))
+
+    if not config.system.broker_socket:
+        _error_out("No broker_socket configured")
+        return
+
+    import pwd  # noqa: PLC0415
+
+    from .broker import SD_LISTEN_FDS_START, SshZoneBroker  # noqa: PLC0415
+
+    try:
+        login_uid = pwd.getpwnam(config.system.login_user).pw_uid
+    except KeyError:
+        _error_out(f'No such login user "{config.system.login_user}"')
+        return
+
+    listen: Path | int = Path(config.system.broker_socket)
+    if os.environ.get("LISTEN_PID") == str(os.getpid()):
+        if os.environ.get("LISTEN_FDS") != "1":
+            _error_out("Expected a single socket to be passed")
+        listen = SD_LISTEN_FDS_START
+
+    with SshZoneBroker(
+        listen,
+        config_file,
+        lambda: _load_config(config_file),
+        _command_class,
+        allowed_uids={login_uid},
+    ) as server:
+        logging.info("Serving on %s", config.system.broker_socket)
+        server.serve_forever()
+
+
+def knot_proxy(config_file: Path = CONFIG_FILE) -> None:
+    """
+    Entry point for the szh-knot-proxy script
+
+    Relays the dump and retransfer requests of the login user to the
+    Knot control socket, sparing every such request a sudo knotc call.
+    Meant to be run as a service, as the knot user.
+    """
+
+    _setup_logging(LOGCONF)
+
+    try:
+        config: ConfigSnapshot = _load_config(config_file, errors="verbose")
+    except ConfigFileError as cfe:
+        _error_out(str(cfe))
+
+    if not config.system.knot_proxy_socket:
+        _error_out("No knot_proxy_socket configured")
+        return
+
+    import pwd  # noqa: PLC0415
+
+    from .knotctl import KnotCtlProxy  # noqa: PLC0415
+    from .zones import ZoneGrants  # noqa: PLC0415
+
+    try:
+        login_uid = pwd.getpwnam(config.system.login_user).pw_uid
+    except KeyError:
+        _error_out(f'No such login user "{config.system.login_user}"')
+        return
+
+    def load_zones() -> ZoneGrants:
+        users = _load_config(config_file).users
+        return ZoneGrants(zone for conf in users.values() for zone in conf.zones)
+
+    with KnotCtlProxy(
+        Path(config.system.knot_proxy_socket),
+        Path(config.system.knot_control_socket),
+        config_file,
+        load_zones,
+        allowed_uids={login_uid},
+    ) as proxy:
+        logging.info("Relaying to %s", config.system.knot_control_socket)
+        proxy.serve_forever()
+
+
+def indexer(config_file: Path = CONFIG_FILE) -> None:
+    """
+    Entry point for the szh-indexer script
+
+    Follows the DNS server's journal, maintaining the per-zone log index
+    which the logs command then prefers over scanning the journal. Meant
+    to be run as a service, as the journalctl_user.
+    """
+
+    _setup_logging(LOGCONF)
+
+    try:
+        config: ConfigSnapshot = _load_config(config_file, errors="verbose")
+        command_class: type[SshZoneCommand] = _command_class(config)
+    except ConfigFileError as cfe:
+        _error_out(str(cfe))
+
+    if not config.system.log_index_dir:
+        _error_out("No log_index_dir configured")
+        return
+
+    import pwd  # noqa: PLC0415
+
+    from .logindex import LogIndex, LogIndexer  # noqa: PLC0415
+
+    try:
+        login_gid = pwd.getpwnam(config.system.login_user).pw_gid
+    except KeyError:
+        _error_out(f'No such login user "{config.system.login_user}"')
+        return
+
+    index = LogIndex(
+        Path(config.system.log_index_dir),
+        config.system.log_index_max_bytes,
+        group=login_gid,
+    )
+    LogIndexer(index, command_class, lambda: _load_config(config_file)).run()
+    _error_out("Stopped following the journal")
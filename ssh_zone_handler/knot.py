@@ -1,20 +1,36 @@
 """Knot specific subclasses"""
 
-from collections.abc import Iterator
+import logging
+import re
+from collections.abc import Iterable, Iterator
+from pathlib import Path
 from subprocess import CompletedProcess
 from typing import Final
 
-from .base import SshZoneCommand, SshZoneSudoers
-from .types import ZoneHandlerConf
+from .base import InvokeError, SshZoneCommand, SshZoneSudoers, ZoneStatus
+from .cache import SERIAL_TTL
+from .metrics import phase
+from .snapshot import ConfigSnapshot
+
+# Knot prefixes every zone related log message with "[zone.] "
+LOG_ZONE_PATTERN: Final[re.Pattern[str]] = re.compile(r"\[([^\]\s]+)\.\]")
+# For journalctl --grep, matching at least every line LOG_ZONE_PATTERN does
+JOURNAL_GREP: Final[str] = "[.]]"
+SERIAL_PATTERN: Final[re.Pattern[str]] = re.compile(r"\bserial: (\d+)")
+ZONE_STATUS_PATTERN: Final[re.Pattern[str]] = re.compile(r"^\[([^\]\s]+)\.\] (.+)$")
 
 
 class KnotSudoers(SshZoneSudoers):
     """Pre-generate needed Knot sudoers rules"""
 
+    @staticmethod
+    def _journal_grep() -> str:
+        return JOURNAL_GREP
+
     def _server_command_rules(self) -> list[str]:
         rules: list[str] = []
 
-        for cmd in ["zone-read", "zone-retransfer"]:
+        for cmd in ["zone-read", "zone-retransfer", "zone-status"]:
             rule = (
                 f"{self.login_user}\tALL=({self.service_user}) NOPASSWD: "
                 + f"/usr/sbin/knotc {cmd} *"
@@ -26,48 +42,140 @@ class KnotSudoers(SshZoneSudoers):
 class KnotCommand(SshZoneCommand):
     """Runs the actual commands, for Knot"""
 
-    def __init__(self, config: ZoneHandlerConf) -> None:
+    def __init__(self, config: ConfigSnapshot) -> None:
         super().__init__(config)
 
         self.knotc_prefix: Final[tuple[str, ...]] = self.sudo_prefix + (
             "/usr/sbin/knotc",
         )
 
+        # Talk to knotd directly through the proxy, rather than sudo knotc
+        self.ctl_socket: Final[Path | None] = (
+            Path(config.system.knot_proxy_socket)
+            if config.system.knot_proxy_socket
+            else None
+        )
+
     @staticmethod
-    def __filter_dump(content: str, zone: str) -> str:
-        prefix = f"[{zone}.] "
-        offset = len(prefix)
-        lines = content.split("\n")
-        filtered: list[str] = []
+    def __filter_dump(chunks: Iterable[str], zone: str) -> Iterator[str]:
+        """Strip the "[zone.] " line prefixes, a chunk of full lines at a time"""
+
+        prefix = re.compile(rf"^\[{re.escape(zone)}\.\] ", re.MULTILINE)
+        pending = ""
+        for chunk in chunks:
+            lines, newline, pending = (pending + chunk).rpartition("\n")
+            if newline:
+                yield prefix.sub("", lines + newline)
+        if pending:
+            yield prefix.sub("", pending)
+
+    def __zone_status_serial(self, zone: str) -> int:
+        failure = f'Failed to lookup serial of zone "{zone}"'
+        command = self.knotc_prefix + ("zone-status", zone, "+serial")
+
+        result: CompletedProcess[str] = self._runner(command, failure)
+        matched = SERIAL_PATTERN.search(result.stdout)
+        if not matched:
+            raise InvokeError(failure)
+        return int(matched.group(1))
+
+    def _server_zones(self) -> Iterator[str]:
+        # Without any zone, zone-status covers every configured zone
+        failure = "Failed to list the zones of the server"
+        command = self.knotc_prefix + ("zone-status", "+role")
+        result: CompletedProcess[str] = self._runner(command, failure)
+        for line in result.stdout.split("\n"):
+            matched = ZONE_STATUS_PATTERN.match(line)
+            if matched:
+                yield matched.group(1).lower()
+
+    def _zone_serial(self, zone: str) -> int:
+        return self._cached(
+            f"serial:{zone}", SERIAL_TTL, lambda: self.__zone_status_serial(zone)
+        )
+
+    def _zone_statuses(
+        self, zones: list[str]
+    ) -> Iterator[tuple[str, ZoneStatus | InvokeError]]:
+        """A single knotc call, covering every zone"""
 
-        for line in lines:
-            no_prefix = line
-            if line.startswith(prefix):
-                no_prefix = line[offset:]
-            filtered.append(no_prefix)
+        # Without any zone, zone-status would cover every configured zone
+        if not zones:
+            return
 
-        return "\n".join(filtered)
+        failure = "Failed to lookup zone status"
+        command = self.knotc_prefix + ("zone-status", *zones, "+serial", "+events")
+        try:
+            result: CompletedProcess[str] = self._runner(command, failure)
+        except InvokeError as err:
+            for zone in zones:
+                yield zone, err
+            return
+
+        statuses: dict[str, dict[str, str]] = {}
+        for line in result.stdout.split("\n"):
+            matched = ZONE_STATUS_PATTERN.match(line)
+            if matched:
+                fields = statuses.setdefault(matched.group(1), {})
+                for field in matched.group(2).split(" | "):
+                    name, _, value = field.partition(": ")
+                    fields[name.strip()] = value.strip()
+
+        for zone in zones:
+            status = statuses.get(zone)
+            if not status or "serial" not in status:
+                yield zone, InvokeError(f'Failed to lookup status of zone "{zone}"')
+                continue
+            yield (
+                zone,
+                ZoneStatus(
+                    serial=status["serial"],
+                    refresh=status.get("refresh", "-"),
+                    expires=status.get("expiration", "-"),
+                ),
+            )
+
+    def __ctl_read(self, socket_path: Path, zone: str, failure: str) -> Iterator[str]:
+        from .knotctl import KnotCtlError, zone_read  # noqa: PLC0415
+
+        try:
+            yield from zone_read(socket_path, zone)
+        except KnotCtlError as err:
+            logging.debug("KnotCtlError: %s", str(err))
+            raise InvokeError(failure) from err
 
-    def _dump(self, zone: str) -> None:
+    def _render(self, zone: str) -> Iterator[str]:
         command = self.knotc_prefix + ("zone-read", zone)
         run_failure = f'Failed to dump content of zone "{zone}"'
 
-        result: CompletedProcess[str] = self._runner(command, run_failure)
-        zone_content = result.stdout.rstrip()
-        zone_content = self.__filter_dump(zone_content, zone)
+        if self.ctl_socket:
+            return self.__ctl_read(self.ctl_socket, zone, run_failure)
 
-        print(zone_content)
+        chunks = self._streamer(command, run_failure)
+        return self.__filter_dump(chunks, zone)
 
     @staticmethod
-    def _filter_logs(log_lines: list[str], zones: list[str]) -> Iterator[str]:
-        for line in log_lines:
-            for zone in zones:
-                if f"[{zone}.]" in line:
-                    yield line
+    def _log_zones(line: str) -> Iterator[str]:
+        for matched in LOG_ZONE_PATTERN.finditer(line):
+            yield matched.group(1)
+
+    @staticmethod
+    def _journal_grep() -> str:
+        return JOURNAL_GREP
 
     def _retransfer(self, zone: str) -> None:
         failure = f'Failed to trigger retransfer of zone "{zone}"'
         command = self.knotc_prefix + ("zone-retransfer", zone)
 
-        self._runner(command, failure)
-        print(f'Triggering retransfer of zone "{zone}"')
+        if self.ctl_socket:
+            from .knotctl import KnotCtlError, zone_retransfer  # noqa: PLC0415
+
+            try:
+                with phase("knot_control"):
+                    zone_retransfer(self.ctl_socket, zone)
+            except KnotCtlError as err:
+                logging.debug("KnotCtlError: %s", str(err))
+                raise InvokeError(failure) from err
+        else:
+            self._runner(command, failure)
+        self._invalidate(f"serial:{zone}")
@@ -0,0 +1,293 @@
+"""Knot DNS control protocol client, and its restricted proxy"""
+
+import logging
+import os
+import socket
+import struct
+from collections.abc import Callable, Collection, Container, Iterator
+from pathlib import Path
+from socketserver import BaseRequestHandler, ThreadingUnixStreamServer
+from typing import Any, BinaryIO, Final, cast
+
+from .snapshot import ConfigStat, config_stat
+
+# Unit types, each unit being followed by any number of data items
+CTL_END: Final[int] = 0
+CTL_DATA: Final[int] = 1
+CTL_EXTRA: Final[int] = 2
+CTL_BLOCK: Final[int] = 3
+
+# Data item indexes, as item codes offset by DATA_CODE_OFFSET
+IDX_CMD: Final[int] = 0
+IDX_FLAGS: Final[int] = 1
+IDX_ERROR: Final[int] = 2
+IDX_ZONE: Final[int] = 6
+IDX_OWNER: Final[int] = 7
+IDX_TTL: Final[int] = 8
+IDX_TYPE: Final[int] = 9
+IDX_DATA: Final[int] = 10
+IDX_FILTER: Final[int] = 11
+DATA_CODE_OFFSET: Final[int] = 0x10
+MAX_ITEM_CODE: Final[int] = DATA_CODE_OFFSET + 0x20
+
+CTL_TIMEOUT: Final[int] = 30
+PROXY_COMMANDS: Final[frozenset[str]] = frozenset(
+    {"zone-read", "zone-retransfer", "zone-status"}
+)
+PROXY_ITEMS: Final[frozenset[int]] = frozenset(
+    {IDX_CMD, IDX_FLAGS, IDX_ZONE, IDX_FILTER}
+)
+
+Unit = tuple[int, dict[int, str]]
+
+
+class KnotCtlError(Exception):
+    """Failure to talk to, or reported by, the Knot control socket"""
+
+
+class KnotCtl:
+    """
+    Minimal implementation of libknot's control protocol
+
+    A request is a DATA unit followed by a BLOCK unit. The response is
+    any number of DATA/EXTRA units, terminated by a BLOCK unit. Every
+    data item is a code byte, a big-endian uint16 length and the value.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock: Final[socket.socket] = sock
+        self.rfile: Final[BinaryIO] = sock.makefile("rb")
+        self.__next_type: int | None = None
+
+    @classmethod
+    def connect(cls, socket_path: Path, timeout: int = CTL_TIMEOUT) -> "KnotCtl":
+        """Connect to knotd's, or the proxy's, control socket"""
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(os.fspath(socket_path))
+        except OSError as err:
+            sock.close()
+            raise KnotCtlError(f"Unable to connect to {socket_path}: {err}") from err
+        return cls(sock)
+
+    def close(self) -> None:
+        """Politely end the session"""
+
+        try:
+            self.send(CTL_END)
+        except KnotCtlError:
+            pass
+        self.rfile.close()
+        self.sock.close()
+
+    @staticmethod
+    def encode(unit_type: int, items: dict[int, str] | None = None) -> bytes:
+        """A single unit, in wire format"""
+
+        wire = bytearray((unit_type,))
+        for idx, value in sorted((items or {}).items()):
+            data = value.encode()
+            wire += struct.pack("!BH", DATA_CODE_OFFSET + idx, len(data)) + data
+        return bytes(wire)
+
+    def send(self, unit_type: int, items: dict[int, str] | None = None) -> None:
+        """Send a single unit"""
+
+        try:
+            self.sock.sendall(self.encode(unit_type, items))
+        except OSError as err:
+            raise KnotCtlError(f"Unable to send to control socket: {err}") from err
+
+    def __read(self, size: int) -> bytes:
+        data = self.rfile.read(size)
+        if len(data) != size:
+            raise KnotCtlError("Control socket connection closed unexpectedly")
+        return data
+
+    def receive(self) -> Unit:
+        """Receive a single unit, along with its data items"""
+
+        try:
+            unit_type = self.__next_type
+            if unit_type is None:
+                unit_type = self.__read(1)[0]
+            self.__next_type = None
+            if unit_type >= DATA_CODE_OFFSET:
+                raise KnotCtlError(f"Unexpected control item code {unit_type}")
+
+            items: dict[int, str] = {}
+            if unit_type in (CTL_DATA, CTL_EXTRA):
+                while code := self.rfile.read(1):
+                    if code[0] < DATA_CODE_OFFSET:
+                        self.__next_type = code[0]
+                        break
+                    if code[0] >= MAX_ITEM_CODE:
+                        raise KnotCtlError(f"Unexpected control item code {code[0]}")
+                    (length,) = struct.unpack("!H", self.__read(2))
+                    value = self.__read(length).decode(errors="replace")
+                    items[code[0] - DATA_CODE_OFFSET] = value
+        except OSError as err:
+            raise KnotCtlError(f"Unable to read from control socket: {err}") from err
+
+        return unit_type, items
+
+    def request(self, command: str, zone: str | None = None) -> Iterator[Unit]:
+        """Send a request, and yield the response's DATA and EXTRA units"""
+
+        items = {IDX_CMD: command}
+        if zone:
+            items[IDX_ZONE] = zone.rstrip(".") + "."
+        self.send(CTL_DATA, items)
+        self.send(CTL_BLOCK)
+
+        while True:
+            unit_type, items = self.receive()
+            if unit_type == CTL_BLOCK:
+                return
+            if unit_type == CTL_END:
+                raise KnotCtlError("Control socket session ended unexpectedly")
+            if IDX_ERROR in items:
+                raise KnotCtlError(items[IDX_ERROR])
+            yield unit_type, items
+
+
+def zone_read(socket_path: Path, zone: str) -> Iterator[str]:
+    """Zone content, one knotc style record line at a time"""
+
+    ctl = KnotCtl.connect(socket_path)
+    try:
+        # EXTRA units only carry what differs from the preceding unit
+        record: dict[int, str] = {}
+        for unit_type, items in ctl.request("zone-read", zone):
+            record = {**record, **items} if unit_type == CTL_EXTRA else items
+            if IDX_DATA in record:
+                owner, ttl, rrtype = (
+                    record.get(idx, "") for idx in (IDX_OWNER, IDX_TTL, IDX_TYPE)
+                )
+                yield f"{owner} {ttl} {rrtype} {record[IDX_DATA]}\n"
+    finally:
+        ctl.close()
+
+
+def zone_retransfer(socket_path: Path, zone: str) -> None:
+    """Trigger a full retransfer of the zone"""
+
+    ctl = KnotCtl.connect(socket_path)
+    try:
+        for _ in ctl.request("zone-retransfer", zone):
+            pass
+    finally:
+        ctl.close()
+
+
+class KnotCtlProxy(ThreadingUnixStreamServer):
+    """
+    Relays a small subset of control requests to knotd's control socket
+
+    Meant to run as the knot user, making the control socket reachable
+    by the login user without handing it every control command. The
+    allowed zones get reloaded whenever any of the config files change.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        listen_path: Path,
+        target_path: Path,
+        config_file: Path,
+        load_zones: Callable[[], Container[str]],
+        allowed_uids: Collection[int],
+    ) -> None:
+        self.target_path: Final[Path] = target_path
+        self.config_file: Final[Path] = config_file
+        self.load_zones: Final[Callable[[], Container[str]]] = load_zones
+        self.allowed_uids: Final[Collection[int]] = allowed_uids
+
+        self.__config_stat: ConfigStat = config_stat(config_file)
+        self.allowed_zones: Container[str] = load_zones()
+
+        listen_path.unlink(missing_ok=True)
+        super().__init__(os.fspath(listen_path), KnotCtlProxyHandler)
+        listen_path.chmod(0o666)
+
+    def refresh(self) -> None:
+        """Reload the allowed zones, if any of the config files changed"""
+
+        stats = config_stat(self.config_file)
+        if stats == self.__config_stat:
+            return
+
+        try:
+            allowed_zones = self.load_zones()
+        except Exception as err:
+            logging.error("Keeping the previous zones: %s", str(err))
+            return
+
+        self.allowed_zones = allowed_zones
+        self.__config_stat = stats
+        logging.info("Reloaded %s", self.config_file)
+
+    def verify_request(
+        self,
+        request: socket.socket | tuple[bytes, socket.socket],
+        client_address: Any,  # noqa: ANN401
+    ) -> bool:
+        """Pick up config changes, before handing off the request"""
+
+        self.refresh()
+        return super().verify_request(request, client_address)
+
+    def permitted(self, request: dict[int, str]) -> bool:
+        """Only allow-listed commands, with nothing but a configured zone"""
+
+        return (
+            request.get(IDX_CMD) in PROXY_COMMANDS
+            and request.get(IDX_ZONE, "").rstrip(".") in self.allowed_zones
+            and request.keys() <= PROXY_ITEMS
+        )
+
+
+class KnotCtlProxyHandler(BaseRequestHandler):
+    """A single proxied request, per client connection"""
+
+    def handle(self) -> None:
+        """Validate the client's request, then relay the response unit by unit"""
+
+        server = cast("KnotCtlProxy", self.server)
+        client = KnotCtl(self.request)
+        peer = self.request.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", peer)
+        if uid not in server.allowed_uids:
+            logging.warning("Rejected control socket client uid %d", uid)
+            return
+
+        try:
+            unit_type, request = client.receive()
+            if unit_type != CTL_DATA or not server.permitted(request):
+                logging.warning("Rejected control request %s", request)
+                client.send(CTL_DATA, {IDX_ERROR: "operation not permitted"})
+                client.send(CTL_BLOCK)
+                return
+            if client.receive()[0] != CTL_BLOCK:
+                return
+
+            knotd = KnotCtl.connect(server.target_path)
+            try:
+                knotd.send(CTL_DATA, request)
+                knotd.send(CTL_BLOCK)
+                while True:
+                    unit_type, items = knotd.receive()
+                    if unit_type == CTL_END:
+                        break
+                    client.send(unit_type, items)
+                    if unit_type == CTL_BLOCK:
+                        break
+            finally:
+                knotd.close()
+        except KnotCtlError as err:
+            logging.warning("Control request failed: %s", str(err))
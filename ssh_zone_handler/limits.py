@@ -0,0 +1,183 @@
+"""Host-wide limits, shared between concurrent sessions"""
+
+import fcntl
+import logging
+import os
+import time
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Final, NamedTuple
+
+from .cache import trusted_dir
+
+
+class LimitError(Exception):
+    """A request beyond the configured limits"""
+
+
+class CommandLimit(NamedTuple):
+    """Effective per-user limits of a single command"""
+
+    per_minute: int | None = None
+    burst: int | None = None
+    concurrent: int | None = None
+
+    @classmethod
+    def merge(cls, *limits: dict[str, int | None]) -> "CommandLimit":
+        """Later set limits take precedence over earlier ones"""
+
+        merged = cls()
+        for limit in limits:
+            merged = merged._replace(
+                **{name: value for name, value in limit.items() if value is not None}
+            )
+        return merged
+
+
+class CommandLimiter:
+    """
+    Token bucket rate limits, and concurrency caps, per user and command
+
+    Each bucket is a small state file, updated under an exclusive flock().
+    Each concurrency slot is a file, flock()ed for as long as the command
+    runs, and so released by the kernel however the process ends.
+    """
+
+    def __init__(self, state_dir: Path) -> None:
+        self.state_dir: Final[Path] = state_dir
+        self.__usable: bool | None = None
+
+    def __take_token(self, name: str, per_minute: int, burst: int) -> float:
+        """Zero on success, otherwise the seconds until a token is available"""
+
+        rate = per_minute / 60
+        fd = os.open(self.state_dir / f"{name}.bucket", os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+b") as fstate:
+            fcntl.flock(fstate, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, updated = (float(value) for value in fstate.read().split())
+            except ValueError:
+                tokens, updated = burst, now
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+
+            fstate.seek(0)
+            fstate.truncate()
+            fstate.write(f"{tokens - 1!r} {now!r}".encode())
+        return 0
+
+    def __claim_slot(self, name: str, concurrent: int) -> int | None:
+        for slot in range(concurrent):
+            fd = os.open(
+                self.state_dir / f"{name}.slot{slot}", os.O_RDWR | os.O_CREAT, 0o600
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    @contextmanager
+    def acquire(
+        self, username: str, command: str, limit: CommandLimit
+    ) -> Generator[None, None, None]:
+        """
+        Hold a concurrency slot and spend a token, or raise LimitError
+
+        Limits that can't be enforced reject the request, rather than
+        letting anyone past them.
+        """
+
+        if self.__usable is None:
+            self.__usable = trusted_dir(self.state_dir)
+        if not self.__usable:
+            logging.error(
+                "Unable to enforce limits, without a usable %s", self.state_dir
+            )
+            raise LimitError(f'Unable to enforce the "{command}" limits, try later')
+
+        name = f"{username}.{command}"
+        slot_fd: int | None = None
+        if limit.concurrent:
+            slot_fd = self.__claim_slot(name, limit.concurrent)
+            if slot_fd is None:
+                raise LimitError(
+                    f'Too many concurrent "{command}" requests, '
+                    + f"at most {limit.concurrent} allowed"
+                )
+
+        try:
+            if limit.per_minute:
+                burst = limit.burst or limit.per_minute
+                wait = self.__take_token(name, limit.per_minute, burst)
+                if wait:
+                    raise LimitError(
+                        f'Too many "{command}" requests, '
+                        + f"try again in {int(wait) + 1} seconds"
+                    )
+            yield
+        finally:
+            if slot_fd is not None:
+                os.close(slot_fd)
+
+
+class RetransferCooldown:
+    """
+    Coalesces retransfer requests of the same zone
+
+    Every zone gets a state file holding when a retransfer got last
+    triggered. It is locked for as long as triggering takes, so
+    concurrent requests wait for the first one, then find it recorded.
+    Any further request within the cooldown only gets told so.
+    """
+
+    def __init__(self, state_dir: Path, cooldown: int) -> None:
+        self.state_dir: Final[Path] = state_dir
+        self.cooldown: Final[int] = cooldown
+        self.__usable: bool | None = None
+
+    def __state_file(self, zone: str) -> Path:
+        # Classless in-addr.arpa zones contain a slash, never an underscore
+        return self.state_dir / f"{zone.replace('/', '_')}.retransfer"
+
+    def trigger(self, zone: str, retransfer: Callable[[str], None]) -> float | None:
+        """
+        Run the retransfer, unless one got triggered within the cooldown
+
+        :return: None if triggered now, otherwise when the pending one was
+        """
+
+        if self.__usable is None:
+            self.__usable = trusted_dir(self.state_dir)
+
+        fd: int | None = None
+        if self.__usable:
+            try:
+                fd = os.open(self.__state_file(zone), os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError as err:
+                logging.debug("Unable to track retransfer: %s", str(err))
+        if fd is None:
+            retransfer(zone)
+            return None
+
+        with os.fdopen(fd, "r+b") as fstate:
+            fcntl.flock(fstate, fcntl.LOCK_EX)
+            try:
+                last = float(fstate.read() or 0)
+            except ValueError:
+                last = 0.0
+
+            now = time.time()
+            if 0 <= now - last < self.cooldown:
+                return last
+
+            retransfer(zone)
+            fstate.seek(0)
+            fstate.truncate()
+            fstate.write(repr(now).encode())
+        return None
@@ -0,0 +1,315 @@
+"""Per-zone log index, fed by a background journal follower"""
+
+import heapq
+import logging
+import marshal
+import math
+import os
+import time
+from collections.abc import Callable, Iterable, Iterator
+from pathlib import Path
+from selectors import EVENT_READ, DefaultSelector
+from subprocess import Popen
+from typing import TYPE_CHECKING, Any, Final
+
+from .snapshot import ConfigSnapshot
+from .zones import PATTERN_PREFIX, ZoneGrants, is_pattern
+
+if TYPE_CHECKING:
+    from .base import SshZoneCommand
+
+INDEX_WINDOW: Final[int] = 5 * 24 * 60 * 60
+STALE_AFTER: Final[int] = 60
+FLUSH_INTERVAL: Final[int] = 1
+HEARTBEAT_INTERVAL: Final[int] = 10
+RELOAD_INTERVAL: Final[int] = 60
+MAX_PENDING: Final[int] = 10000
+
+
+def _microseconds(seconds: float) -> int:
+    return int(seconds * 1_000_000)
+
+
+def _covered_since(coverage: dict[str, int], zone: str) -> float:
+    """
+    Since when a zone is covered, either by itself, or as matched by any
+    "*.suffix" pattern, every zone below which gets indexed
+    """
+
+    covered: list[float] = [coverage.get(zone, math.inf)]
+    covered += [
+        since_us
+        for grant, since_us in coverage.items()
+        if is_pattern(grant) and zone.endswith(f".{grant.removeprefix(PATTERN_PREFIX)}")
+    ]
+    return min(covered)
+
+
+def _open_shared(path: Path, flags: int, group: int | None) -> int:
+    """Owner writable, and only readable by the group, if any, it's handed to"""
+
+    fd = os.open(path, flags | os.O_WRONLY | os.O_CREAT, 0o640)
+    try:
+        if group is not None and os.fstat(fd).st_gid != group:
+            os.fchown(fd, -1, group)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _atomic_write(path: Path, content: bytes, group: int | None) -> None:
+    tmp_file = path.with_name(f".{path.name}.{os.getpid()}")
+    fd = _open_shared(tmp_file, os.O_TRUNC, group)
+    with os.fdopen(fd, "wb") as fout:
+        fout.write(content)
+    os.replace(tmp_file, path)
+
+
+class LogIndex:
+    """
+    On-disk per-zone ring buffers of already classified log lines
+
+    Every zone gets its own file, of "<microseconds>\\t<log line>" entries,
+    bounded both by age and size. The state file tracks the journal
+    cursor, since when each zone has been indexed, and doubles as the
+    indexer's heartbeat.
+    """
+
+    def __init__(
+        self, index_dir: Path, max_bytes: int, group: int | None = None
+    ) -> None:
+        """
+        :param group: Of the written files, the login user's, to read them
+        """
+
+        self.index_dir: Final[Path] = index_dir
+        self.max_bytes: Final[int] = max_bytes
+        self.group: Final[int | None] = group
+        self.state_file: Final[Path] = index_dir / "state"
+
+    def zone_file(self, zone: str) -> Path:
+        """Classless in-addr.arpa zones contain a slash, never an underscore"""
+        return self.index_dir / f"{zone.replace('/', '_')}.log"
+
+    def load_state(self) -> tuple[str | None, dict[str, int]]:
+        """The last indexed journal cursor, and since when each zone is covered"""
+
+        try:
+            cursor, coverage = marshal.loads(self.state_file.read_bytes())  # noqa: S302
+        except (OSError, EOFError, ValueError, TypeError):
+            return None, {}
+        return cursor, coverage
+
+    def store_state(self, cursor: str | None, coverage: dict[str, int]) -> None:
+        """Atomically replace the state file, which also refreshes the heartbeat"""
+        _atomic_write(self.state_file, marshal.dumps((cursor, coverage)), self.group)
+
+    def covers(self, zones: Iterable[str], since_us: int) -> bool:
+        """Whether the index is fresh, and covers the zones for the whole window"""
+
+        try:
+            heartbeat = self.state_file.stat().st_mtime
+        except OSError:
+            return False
+        if heartbeat < time.time() - STALE_AFTER:
+            return False
+
+        _, coverage = self.load_state()
+        return all(_covered_since(coverage, zone) <= since_us for zone in zones)
+
+    def __entries(
+        self, zone: str, since_us: int, until_us: int | None = None
+    ) -> Iterator[tuple[int, str]]:
+        try:
+            content = self.zone_file(zone).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return
+
+        # A concurrently appended last line might not be complete yet
+        for entry in content.split("\n")[:-1]:
+            timestamp, _, line = entry.partition("\t")
+            if since_us <= int(timestamp) and (
+                until_us is None or int(timestamp) < until_us
+            ):
+                yield int(timestamp), line
+
+    def read(
+        self, zones: Iterable[str], since_us: int, until_us: int | None = None
+    ) -> Iterator[str]:
+        """Chronologically merged log lines of the zones, each line once"""
+
+        streams = [self.__entries(zone, since_us, until_us) for zone in zones]
+        previous: tuple[int, str] | None = None
+        for entry in heapq.merge(*streams):
+            if entry != previous:
+                yield entry[1]
+            previous = entry
+
+    def append(self, zone: str, entries: list[tuple[int, str]]) -> None:
+        """Append the entries, compacting the zone file once it grows too big"""
+
+        zone_file = self.zone_file(zone)
+        content = "".join(f"{timestamp}\t{line}\n" for timestamp, line in entries)
+        fd = _open_shared(zone_file, os.O_APPEND, self.group)
+        with os.fdopen(fd, "a", encoding="utf-8") as fout:
+            fout.write(content)
+            size = fout.tell()
+
+        if size > self.max_bytes:
+            self.compact(zone)
+
+    def compact(self, zone: str) -> None:
+        """Drop expired entries, and the oldest ones beyond half the size limit"""
+
+        zone_file = self.zone_file(zone)
+        since_us = _microseconds(time.time() - INDEX_WINDOW)
+
+        kept: list[str] = []
+        size = 0
+        for timestamp, line in reversed(list(self.__entries(zone, since_us))):
+            entry = f"{timestamp}\t{line}\n"
+            size += len(entry.encode())
+            if size > self.max_bytes // 2:
+                break
+            kept.append(entry)
+
+        _atomic_write(zone_file, "".join(reversed(kept)).encode(), self.group)
+
+
+class LogIndexer:
+    """Follows the journal, classifying each line the same way logs does"""
+
+    def __init__(
+        self,
+        index: LogIndex,
+        command_class: "type[SshZoneCommand]",
+        load_config: Callable[[], ConfigSnapshot],
+    ) -> None:
+        self.index: Final[LogIndex] = index
+        self.command_class: Final[type[SshZoneCommand]] = command_class
+        self.load_config: Final[Callable[[], ConfigSnapshot]] = load_config
+
+        self.unit: str = ""
+        self.cursor: str | None = None
+        self.coverage: dict[str, int] = {}
+        self.grants: ZoneGrants = ZoneGrants(())
+        self.pending: dict[str, list[tuple[int, str]]] = {}
+        self.pending_count: int = 0
+
+    def reload(self) -> None:
+        """Pick up the systemd unit, and any added or removed zones"""
+
+        try:
+            config = self.load_config()
+        except Exception as err:
+            logging.error("Keeping the previous config: %s", str(err))
+            return
+        self.unit = config.system.systemd_unit
+
+        # Patterns stay patterns, covering whichever zones below them get logged
+        zones = {zone for conf in config.users.values() for zone in conf.zones}
+        self.grants = ZoneGrants(zones)
+        now_us = _microseconds(time.time())
+        for zone in zones - self.coverage.keys():
+            self.coverage[zone] = now_us
+        for zone in self.coverage.keys() - zones:
+            del self.coverage[zone]
+
+    @staticmethod
+    def _format(entry: dict[str, Any]) -> tuple[int, str]:
+        """Mimic journalctl's default short output, in UTC"""
+
+        timestamp = int(entry["__REALTIME_TIMESTAMP"])
+        when = time.strftime("%b %d %H:%M:%S", time.gmtime(timestamp / 1_000_000))
+        host = entry.get("_HOSTNAME", "localhost")
+        ident = entry.get("SYSLOG_IDENTIFIER") or entry.get("_COMM", "unknown")
+        pid = entry.get("SYSLOG_PID") or entry.get("_PID")
+
+        message = entry.get("MESSAGE") or ""
+        if isinstance(message, list):
+            message = bytes(message).decode(errors="replace")
+
+        source = f"{ident}[{pid}]" if pid else ident
+        return timestamp, f"{when} {host} {source}: {message}"
+
+    def ingest(self, entry: dict[str, Any]) -> None:
+        """Classify a single journal entry, as output by journalctl --output=json"""
+
+        self.cursor = entry["__CURSOR"]
+        timestamp, line = self._format(entry)
+
+        for zone in set(self.command_class._log_zones(line)):
+            if zone in self.grants:
+                self.pending.setdefault(zone, []).append((timestamp, line))
+                self.pending_count += 1
+
+    def flush(self) -> None:
+        """Write out pending entries, before recording the new cursor"""
+
+        for zone, entries in self.pending.items():
+            self.index.append(zone, entries)
+        self.pending = {}
+        self.pending_count = 0
+
+        self.index.store_state(self.cursor, self.coverage)
+
+    def run(self) -> None:
+        """Follow the journal until journalctl exits, or gets killed"""
+
+        import json  # noqa: PLC0415
+
+        self.cursor, self.coverage = self.index.load_state()
+        self.reload()
+
+        command = [
+            "/usr/bin/journalctl",
+            f"--unit={self.unit}",
+            "--output=json",
+            "--follow",
+        ]
+        if self.cursor:
+            command.append(f"--after-cursor={self.cursor}")
+        else:
+            backfill = _microseconds(time.time() - INDEX_WINDOW)
+            self.coverage = dict.fromkeys(self.coverage, backfill)
+            command.append(f"--since=-{INDEX_WINDOW}s")
+
+        logging.info("Following the %s journal", self.unit)
+        stdout_r, stdout_w = os.pipe()
+        try:
+            process = Popen(command, stdout=stdout_w)
+        finally:
+            os.close(stdout_w)
+
+        last_flush = last_reload = time.monotonic()
+        pending_data = b""
+        try:
+            with DefaultSelector() as selector:
+                selector.register(stdout_r, EVENT_READ)
+                while True:
+                    if selector.select(timeout=FLUSH_INTERVAL):
+                        data = os.read(stdout_r, 64 * 1024)
+                        if not data:
+                            break
+                        *lines, pending_data = (pending_data + data).split(b"\n")
+                        for line in lines:
+                            self.ingest(json.loads(line))
+
+                    now = time.monotonic()
+                    if self.pending_count >= MAX_PENDING or (
+                        now - last_flush >= FLUSH_INTERVAL
+                        and (self.pending or now - last_flush >= HEARTBEAT_INTERVAL)
+                    ):
+                        self.flush()
+                        last_flush = now
+                    if now - last_reload >= RELOAD_INTERVAL:
+                        self.reload()
+                        last_reload = now
+        finally:
+            os.close(stdout_r)
+            if process.poll() is None:
+                process.kill()
+
+        self.flush()
+        logging.warning("journalctl exited with status %s", process.wait())
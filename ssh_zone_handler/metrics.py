@@ -0,0 +1,330 @@
+"""Per-invocation performance metrics, for syslog and node_exporter"""
+
+import fcntl
+import io
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from collections.abc import Generator, Sequence
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, ClassVar, Final
+
+from .cache import trusted_dir
+
+TEXTFILE_NAME: Final[str] = "ssh-zone-handler.prom"
+STATE_NAME: Final[str] = ".ssh-zone-handler.state"
+STATE_VERSION: Final[int] = 1
+
+# Upper bounds, in seconds, of the duration histograms' buckets
+DURATION_BUCKETS: Final[tuple[float, ...]] = (
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# Name, type and help text of every exported metric
+METRICS: Final[dict[str, tuple[str, str]]] = {
+    "szh_invocations_total": ("counter", "Invocations, by exit status"),
+    "szh_invocation_duration_seconds": ("histogram", "Wall time of invocations"),
+    "szh_phase_seconds_total": ("counter", "Time spent per invocation phase"),
+    "szh_subprocess_duration_seconds": ("histogram", "Wall time of subprocesses"),
+    "szh_subprocess_failures_total": ("counter", "Subprocesses exiting non-zero"),
+    "szh_output_bytes_total": ("counter", "Bytes written to stdout"),
+    "szh_log_lines_scanned_total": ("counter", "Journal lines scanned by logs"),
+    "szh_log_lines_matched_total": ("counter", "Journal lines output by logs"),
+}
+
+Labels = tuple[tuple[str, str], ...]
+State = dict[str, dict[Labels, list[float]]]
+
+
+def _program(command: Sequence[str]) -> str:
+    """The name of whatever actually gets run, sudo or not"""
+
+    for arg in command:
+        if arg.startswith("/") and not arg.endswith("/sudo"):
+            return Path(arg).name
+    return Path(command[0]).name if command else "-"
+
+
+class _CountingWriter(io.RawIOBase):
+    """Passes writes on to the real stdout, counting the bytes"""
+
+    def __init__(self, target: IO[bytes], invocation: "Invocation") -> None:
+        super().__init__()
+        self.target: Final[IO[bytes]] = target
+        self.invocation: Final[Invocation] = invocation
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:  # noqa: ANN401
+        size = len(data)
+        self.target.write(data)
+        self.target.flush()
+        self.invocation.count("output_bytes", size)
+        return size
+
+
+class Invocation:
+    """
+    Where a single invocation spent its time, and how much it output
+
+    While active, every subprocess run, log filter pass and stdout write
+    gets recorded against it, from whichever thread. Once finished, its
+    fields get logged as key=value pairs.
+    """
+
+    active: ClassVar["Invocation | None"] = None
+
+    def __init__(self, user: str, backend: str = "-") -> None:
+        self.user: Final[str] = user
+        self.backend: str = backend
+        self.command: str = "-"
+        self.status: str = "ok"
+        self.started: Final[float] = time.perf_counter()
+        self.duration: float = 0.0
+        self.phases: dict[str, float] = {}
+        self.programs: dict[str, list[tuple[float, int]]] = {}
+        self.counters: dict[str, int] = {}
+        self.__lock: Final[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def start(cls, user: str, backend: str = "-") -> "Invocation":
+        """Begin recording, replacing any previously active invocation"""
+
+        cls.active = cls(user, backend)
+        return cls.active
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        """Time a phase of the invocation, adding up repeated phases"""
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.__lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def subprocess(
+        self, command: Sequence[str], seconds: float, returncode: int
+    ) -> None:
+        """Record a finished subprocess"""
+
+        with self.__lock:
+            self.programs.setdefault(_program(command), []).append(
+                (seconds, returncode)
+            )
+
+    def count(self, name: str, amount: int) -> None:
+        """Add to one of the invocation's counters"""
+
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def counted_output(self) -> Generator[None, None, None]:
+        """Count whatever gets written to stdout, gzip compressed or not"""
+
+        original = sys.stdout
+        sys.stdout.flush()
+        counted = io.TextIOWrapper(
+            io.BufferedWriter(_CountingWriter(original.buffer, self)),
+            encoding=original.encoding,
+            errors=original.errors,
+            line_buffering=bool(original.line_buffering),
+        )
+        sys.stdout = counted
+        try:
+            yield
+        finally:
+            try:
+                counted.flush()
+            finally:
+                counted.detach()
+                sys.stdout = original
+
+    def finish(self, status: str | None = None) -> None:
+        """Stop recording, and log the outcome"""
+
+        self.duration = time.perf_counter() - self.started
+        if status:
+            self.status = status
+        if Invocation.active is self:
+            Invocation.active = None
+        logging.info("metrics %s", " ".join(self.fields()))
+
+    def fields(self) -> list[str]:
+        """The invocation as key=value pairs, with durations in milliseconds"""
+
+        fields = [
+            f"user={self.user}",
+            f"command={self.command}",
+            f"backend={self.backend}",
+            f"status={self.status}",
+            f"duration_ms={self.duration * 1000:.1f}",
+        ]
+        fields += [
+            f"{name}_ms={seconds * 1000:.1f}" for name, seconds in self.phases.items()
+        ]
+        for program, runs in self.programs.items():
+            exit_codes = sorted({returncode for _, returncode in runs})
+            fields += [
+                f"{program}_runs={len(runs)}",
+                f"{program}_ms={sum(seconds for seconds, _ in runs) * 1000:.1f}",
+                f"{program}_exit={','.join(map(str, exit_codes))}",
+            ]
+        fields += [f"{name}={value}" for name, value in self.counters.items()]
+        return fields
+
+
+@contextmanager
+def phase(name: str) -> Generator[None, None, None]:
+    """Time a phase of the active invocation, if any"""
+
+    if Invocation.active is None:
+        yield
+        return
+    with Invocation.active.phase(name):
+        yield
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _observe(state: State, name: str, labels: Labels, seconds: float) -> None:
+    series = state.setdefault(name, {}).setdefault(
+        labels, [0.0] * (len(DURATION_BUCKETS) + 2)
+    )
+    for pos, bound in enumerate(DURATION_BUCKETS):
+        if seconds <= bound:
+            series[pos] += 1
+    series[-2] += seconds
+    series[-1] += 1
+
+
+def _add(state: State, name: str, labels: Labels, amount: float) -> None:
+    series = state.setdefault(name, {}).setdefault(labels, [0.0])
+    series[0] += amount
+
+
+class MetricsTextfile:
+    """
+    Aggregated metrics of every invocation, for node_exporter's textfile collector
+
+    The running totals live in a state file next to the exported one,
+    updated under an exclusive flock(). The exported file then gets
+    replaced atomically, never to be read half written.
+    """
+
+    def __init__(self, metrics_dir: Path) -> None:
+        self.metrics_dir: Final[Path] = metrics_dir
+
+    def __load(self, fstate: IO[bytes]) -> State:
+        try:
+            version, state = marshal.loads(fstate.read())  # noqa: S302
+        except (EOFError, ValueError, TypeError):
+            return {}
+        return state if version == STATE_VERSION else {}
+
+    @staticmethod
+    def __update(state: State, invocation: Invocation) -> None:
+        labels: Labels = (
+            ("backend", invocation.backend),
+            ("command", invocation.command),
+            ("user", invocation.user),
+        )
+        _add(
+            state, "szh_invocations_total", (*labels, ("status", invocation.status)), 1
+        )
+        _observe(state, "szh_invocation_duration_seconds", labels, invocation.duration)
+        for phase, seconds in invocation.phases.items():
+            _add(state, "szh_phase_seconds_total", (*labels, ("phase", phase)), seconds)
+
+        for program, runs in invocation.programs.items():
+            program_labels = (("backend", invocation.backend), ("program", program))
+            for seconds, returncode in runs:
+                _observe(
+                    state, "szh_subprocess_duration_seconds", program_labels, seconds
+                )
+                if returncode:
+                    _add(state, "szh_subprocess_failures_total", program_labels, 1)
+
+        for counter, value in invocation.counters.items():
+            _add(state, f"szh_{counter}_total", labels, value)
+
+    @staticmethod
+    def __render(state: State) -> str:
+        lines: list[str] = []
+        for name, (metric_type, description) in METRICS.items():
+            if name not in state:
+                continue
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            for labels, series in sorted(state[name].items()):
+                pairs = [
+                    f'{label}="{_escape(value)}"' for label, value in sorted(labels)
+                ]
+                if metric_type != "histogram":
+                    lines.append(f"{name}{{{','.join(pairs)}}} {series[0]:g}")
+                    continue
+                bounds = [f"{bound:g}" for bound in DURATION_BUCKETS] + ["+Inf"]
+                for bound, count in zip(
+                    bounds, series[:-2] + [series[-1]], strict=True
+                ):
+                    bucket = ",".join([*pairs, f'le="{bound}"'])
+                    lines.append(f"{name}_bucket{{{bucket}}} {count:g}")
+                lines.append(f"{name}_sum{{{','.join(pairs)}}} {series[-2]!r}")
+                lines.append(f"{name}_count{{{','.join(pairs)}}} {series[-1]:g}")
+        return "\n".join(lines) + "\n"
+
+    def update(self, invocation: Invocation) -> None:
+        """Add a finished invocation to the totals, and export them"""
+
+        if not trusted_dir(self.metrics_dir):
+            logging.warning(
+                "Not exporting metrics, without a usable %s", self.metrics_dir
+            )
+            return
+
+        fd = os.open(self.metrics_dir / STATE_NAME, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+b") as fstate:
+            fcntl.flock(fstate, fcntl.LOCK_EX)
+            state = self.__load(fstate)
+            self.__update(state, invocation)
+
+            textfile = self.metrics_dir / TEXTFILE_NAME
+            partial = textfile.with_name(f".{TEXTFILE_NAME}.{os.getpid()}")
+            partial.write_text(self.__render(state), encoding="utf-8")
+            partial.chmod(0o644)
+            partial.replace(textfile)
+
+            fstate.seek(0)
+            fstate.truncate()
+            fstate.write(marshal.dumps((STATE_VERSION, state)))
+
+
+def report(invocation: Invocation, status: str, metrics_dir: str | None) -> None:
+    """Finish the invocation, then export it, if so configured"""
+
+    invocation.finish(status)
+    if not metrics_dir:
+        return
+    try:
+        MetricsTextfile(Path(metrics_dir)).update(invocation)
+    except OSError as err:
+        logging.warning("Unable to export metrics: %s", str(err))
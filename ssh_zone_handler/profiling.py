@@ -0,0 +1,118 @@
+"""Opt-in, sampled, profiling of single invocations"""
+
+import logging
+import marshal
+import os
+import random
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Final
+
+from .cache import trusted_dir
+from .snapshot import ConfigSnapshot
+
+MEMORY_REPORT_LINES: Final[int] = 25
+
+
+def _write_private(path: Path, content: bytes) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as fout:
+        fout.write(content)
+
+
+def _rotate(profile_dir: Path, max_profiles: int) -> None:
+    """Drop the oldest profiles, along with their memory reports"""
+
+    profiles = sorted(
+        profile_dir.glob("*.prof"), key=lambda path: path.stat().st_mtime_ns
+    )
+    for profile in profiles[: max(0, len(profiles) - max_profiles)]:
+        profile.unlink(missing_ok=True)
+        profile.with_suffix(".txt").unlink(missing_ok=True)
+
+
+def _profile_dir(base_dir: str) -> Path | None:
+    """
+    The running user's own subdirectory, as both szh-wrapper and
+    szh-sshkeys get profiled, each as a different user
+
+    Profiles of every zone handler user share the login user's one.
+    """
+
+    import pwd  # noqa: PLC0415
+
+    try:
+        profile_dir = Path(base_dir) / pwd.getpwuid(os.geteuid()).pw_name
+    except KeyError:
+        return None
+    return profile_dir if trusted_dir(profile_dir) else None
+
+
+@contextmanager
+def profiled(
+    config: ConfigSnapshot, name: str, user: str | None = None
+) -> Generator[None, None, None]:
+    """
+    Run the block under cProfile and tracemalloc, for a sample of invocations
+
+    The user's profile_rate, if any, takes precedence over the system's.
+    Both a cProfile stats file, for pstats or snakeviz, and a peak memory
+    report get written to the profile_dir, keeping profile_max_files.
+    Only the calling thread gets profiled.
+
+    :param name: Of the entry point, as part of the file names
+    :param user: Of the invocation, if any
+    """
+
+    rate = config.system.profile_rate
+    user_conf = config.users.get(user) if user else None
+    if user_conf and user_conf.profile_rate is not None:
+        rate = user_conf.profile_rate
+    if not config.system.profile_dir or random.random() >= rate:  # noqa: S311
+        yield
+        return
+
+    import cProfile  # noqa: PLC0415
+    import tracemalloc  # noqa: PLC0415
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        allocations = tracemalloc.take_snapshot().statistics("lineno")
+        tracemalloc.stop()
+
+        profile_dir = _profile_dir(config.system.profile_dir)
+        if profile_dir:
+            stem = "-".join(
+                (time.strftime("%Y%m%dT%H%M%S"), name, user or "-", str(os.getpid()))
+            )
+            profiler.create_stats()
+            report = [
+                f"elapsed_seconds={elapsed:.6f}",
+                f"peak_bytes={peak}",
+                f"current_bytes={current}",
+                "",
+                *(str(stat) for stat in allocations[:MEMORY_REPORT_LINES]),
+            ]
+            try:
+                _write_private(
+                    profile_dir / f"{stem}.txt", "\n".join(report).encode() + b"\n"
+                )
+                _write_private(
+                    profile_dir / f"{stem}.prof",
+                    marshal.dumps(profiler.stats),
+                )
+                _rotate(profile_dir, config.system.profile_max_files)
+            except OSError as err:
+                logging.warning("Unable to store profile: %s", str(err))
+        else:
+            logging.warning("Not storing profile, without a usable profile_dir")
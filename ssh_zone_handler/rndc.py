@@ -0,0 +1,291 @@
+"""BIND rndc control channel client"""
+
+import base64
+import hmac
+import re
+import secrets
+import socket
+import struct
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, Final, NamedTuple
+
+# Wire value types, every leaf value being sent as binary data
+MSGTYPE_STRING: Final[int] = 0x00
+MSGTYPE_BINARYDATA: Final[int] = 0x01
+MSGTYPE_TABLE: Final[int] = 0x02
+MSGTYPE_LIST: Final[int] = 0x03
+
+PROTOCOL_VERSION: Final[int] = 1
+MESSAGE_TTL: Final[int] = 60
+RNDC_TIMEOUT: Final[int] = 30
+HSHA_LENGTH: Final[int] = 88
+HMD5_LENGTH: Final[int] = 22
+
+# rndc.key algorithm name, to its hashlib name and control channel number
+ALGORITHMS: Final[dict[str, tuple[str, int]]] = {
+    "hmac-md5": ("md5", 157),
+    "hmac-sha1": ("sha1", 161),
+    "hmac-sha224": ("sha224", 162),
+    "hmac-sha256": ("sha256", 163),
+    "hmac-sha384": ("sha384", 164),
+    "hmac-sha512": ("sha512", 165),
+}
+
+KEY_ALGORITHM_PATTERN: Final[re.Pattern[str]] = re.compile(r"\balgorithm\s+\"?([\w-]+)")
+KEY_SECRET_PATTERN: Final[re.Pattern[str]] = re.compile(r"\bsecret\s+\"([^\"]+)\"")
+
+Table = dict[str, Any]
+
+
+class RndcError(Exception):
+    """Failure to talk to, or reported through, the control channel"""
+
+
+class RndcCommandError(RndcError):
+    """A command failure, as reported by the server"""
+
+
+class RndcKey(NamedTuple):
+    """A shared control channel secret, as found in rndc.key"""
+
+    algorithm: str
+    secret: bytes
+
+
+def read_rndc_key(key_file: Path) -> RndcKey:
+    """Parse the first key of an rndc.key style file"""
+
+    try:
+        content = key_file.read_text(encoding="utf-8")
+    except OSError as err:
+        raise RndcError(f"Unable to read {key_file}: {err}") from err
+
+    algorithm = KEY_ALGORITHM_PATTERN.search(content)
+    secret = KEY_SECRET_PATTERN.search(content)
+    if not algorithm or not secret or algorithm.group(1) not in ALGORITHMS:
+        raise RndcError(f"No usable key found in {key_file}")
+
+    try:
+        decoded = base64.b64decode(secret.group(1), validate=True)
+    except ValueError as err:
+        raise RndcError(f"Malformed secret in {key_file}") from err
+    return RndcKey(algorithm.group(1), decoded)
+
+
+def _encode_table(table: Table) -> bytes:
+    wire = bytearray()
+    for name, value in table.items():
+        if isinstance(value, dict):
+            value_type, payload = MSGTYPE_TABLE, _encode_table(value)
+        else:
+            value_type = MSGTYPE_BINARYDATA
+            payload = value if isinstance(value, bytes) else str(value).encode()
+        encoded = name.encode()
+        wire += struct.pack("!B", len(encoded)) + encoded
+        wire += struct.pack("!BI", value_type, len(payload)) + payload
+    return bytes(wire)
+
+
+def _decode_entry(wire: bytes, pos: int) -> tuple[str, Any, int]:
+    try:
+        name_length = wire[pos]
+        name = wire[pos + 1 : pos + 1 + name_length].decode()
+        pos += 1 + name_length
+        value_type, length = struct.unpack_from("!BI", wire, pos)
+    except (IndexError, UnicodeDecodeError, struct.error) as err:
+        raise RndcError("Malformed control channel message") from err
+
+    pos += 5
+    payload = wire[pos : pos + length]
+    if len(payload) != length:
+        raise RndcError("Truncated control channel message")
+
+    value: Any = payload
+    if value_type == MSGTYPE_TABLE:
+        value = _decode_table(payload)
+    elif value_type == MSGTYPE_LIST:
+        raise RndcError("Unsupported control channel list value")
+    return name, value, pos + length
+
+
+def _decode_table(wire: bytes) -> Table:
+    table: Table = {}
+    pos = 0
+    while pos < len(wire):
+        name, value, pos = _decode_entry(wire, pos)
+        table[name] = value
+    return table
+
+
+def _signature(key: RndcKey, signed: bytes) -> Table:
+    digestmod, number = ALGORITHMS[key.algorithm]
+    digest = hmac.new(key.secret, signed, digestmod).digest()
+    encoded = base64.b64encode(digest)
+    if key.algorithm == "hmac-md5":
+        return {"hmd5": encoded.rstrip(b"=")[:HMD5_LENGTH]}
+    return {"hsha": bytes((number,)) + encoded.ljust(HSHA_LENGTH, b"\0")}
+
+
+def encode_message(key: RndcKey, ctrl: Table, data: Table) -> bytes:
+    """A signed, length prefixed, control channel message"""
+
+    signed = _encode_table({"_ctrl": ctrl, "_data": data})
+    auth = _encode_table({"_auth": _signature(key, signed)})
+    message = struct.pack("!I", PROTOCOL_VERSION) + auth + signed
+    return struct.pack("!I", len(message)) + message
+
+
+def decode_message(key: RndcKey, message: bytes) -> Table:
+    """Verify and decode a control channel message, minus its length prefix"""
+
+    if message[:4] != struct.pack("!I", PROTOCOL_VERSION):
+        raise RndcError("Unsupported control channel protocol version")
+
+    name, auth, pos = _decode_entry(message, 4)
+    if name != "_auth" or not isinstance(auth, dict):
+        raise RndcError("Unsigned control channel message")
+
+    signed = message[pos:]
+    if not hmac.compare_digest(
+        _encode_table(_signature(key, signed)), _encode_table(auth)
+    ):
+        raise RndcError("Bad control channel message signature")
+
+    return _decode_table(signed)
+
+
+def read_message(recv: Callable[[int], bytes], key: RndcKey) -> Table:
+    """Read a single complete message"""
+
+    def recv_exactly(size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("Control channel connection closed")
+            data += chunk
+        return data
+
+    (length,) = struct.unpack("!I", recv_exactly(4))
+    return decode_message(key, recv_exactly(length))
+
+
+def _text(table: Table, name: str) -> str:
+    value = table.get(name, b"")
+    return value.decode(errors="replace") if isinstance(value, bytes) else ""
+
+
+class RndcClient:
+    """
+    A control channel session, reused for any number of commands
+
+    The session starts out with a null command, to learn the server's
+    nonce. Any later command then includes that nonce. Should the server
+    have closed the connection, a new session gets set up once.
+    """
+
+    def __init__(self, control: str, key: RndcKey) -> None:
+        """
+        :param control: Either the path of a UNIX socket, or host:port
+        :param key: The shared secret, as configured in named.conf
+        """
+
+        self.control: Final[str] = control
+        self.key: Final[RndcKey] = key
+        self.__sock: socket.socket | None = None
+        self.__nonce: bytes | None = None
+        self.__lock: Final[threading.Lock] = threading.Lock()
+
+    def __connect(self) -> socket.socket:
+        if self.control.startswith("/"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address: Any = self.control
+        else:
+            host, _, port = self.control.rpartition(":")
+            host = host.strip("[]")
+            family = socket.AF_INET6 if ":" in host else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            address = (host, int(port))
+
+        sock.settimeout(RNDC_TIMEOUT)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def __exchange(self, sock: socket.socket, data: Table) -> Table:
+        now = int(time.time())
+        ctrl: Table = {
+            "_ser": secrets.randbelow(2**32),
+            "_tim": now,
+            "_exp": now + MESSAGE_TTL,
+        }
+        if self.__nonce is not None:
+            ctrl["_nonce"] = self.__nonce
+
+        sock.sendall(encode_message(self.key, ctrl, data))
+        response = read_message(sock.recv, self.key)
+
+        reply = response.get("_data")
+        if not isinstance(reply, dict):
+            raise RndcError("Control channel response lacks data")
+        if _text(reply, "result") not in ("", "0"):
+            raise RndcCommandError(_text(reply, "err") or "Command failed")
+
+        response_ctrl = response.get("_ctrl")
+        if isinstance(response_ctrl, dict) and "_nonce" in response_ctrl:
+            self.__nonce = response_ctrl["_nonce"]
+        return reply
+
+    def __session(self) -> socket.socket:
+        if self.__sock is None:
+            sock = self.__connect()
+            self.__nonce = None
+            try:
+                self.__exchange(sock, {"type": "null"})
+            except BaseException:
+                sock.close()
+                raise
+            self.__sock = sock
+        return self.__sock
+
+    def command(self, command: str) -> str:
+        """Run a single rndc command, returning its text output"""
+
+        with self.__lock:
+            reused = self.__sock is not None
+            try:
+                try:
+                    reply = self.__exchange(self.__session(), {"type": command})
+                except ConnectionError:
+                    if not reused:
+                        raise
+                    # The server might simply have closed an idle session
+                    self.close()
+                    reply = self.__exchange(self.__session(), {"type": command})
+            except RndcCommandError:
+                raise
+            except RndcError:
+                self.close()
+                raise
+            except OSError as err:
+                self.close()
+                raise RndcError(f"Control channel failure: {err}") from err
+
+        return _text(reply, "text")
+
+    def close(self) -> None:
+        """End the session, if any"""
+
+        if self.__sock is not None:
+            try:
+                self.__sock.close()
+            except OSError:
+                pass
+        self.__sock = None
+        self.__nonce = None
@@ -0,0 +1,460 @@
+"""Precompiled config snapshots"""
+
+import binascii
+import hashlib
+import logging
+import marshal
+import os
+import stat
+from collections.abc import Iterator
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Final, NamedTuple
+
+if TYPE_CHECKING:
+    from .types import ZoneHandlerConf
+
+SNAPSHOT_MAGIC: Final[str] = "ssh-zone-handler snapshot"
+SNAPSHOT_VERSION: Final[int] = 2
+
+# Name, mtime, size and inode of every config file
+ConfigStat = list[tuple[str, int, int, int]]
+
+
+class SystemSnapshot(NamedTuple):
+    """
+    Validated SystemConf, free of any pydantic dependency
+    """
+
+    journalctl_user: str
+    login_user: str
+    server_type: str
+    server_user: str
+    systemd_unit: str
+    journalctl_grep: bool
+    log_index_dir: str | None
+    log_index_max_bytes: int
+    dump_cache_dir: str | None
+    dump_cache_max_bytes: int
+    runtime_dir: str | None
+    max_workers: int
+    knot_control_socket: str
+    knot_proxy_socket: str | None
+    rndc_control: str | None
+    rndc_key_file: str
+    broker_socket: str | None
+    retransfer_cooldown: int
+    limits: dict[str, dict[str, int | None]]
+    metrics_dir: str | None
+    profile_dir: str | None
+    profile_rate: float
+    profile_max_files: int
+
+
+class UserSnapshot(NamedTuple):
+    """
+    Validated UserConf, free of any pydantic dependency
+    """
+
+    ssh_keys: tuple[str, ...]
+    zones: tuple[str, ...]
+    limits: dict[str, dict[str, int | None]]
+    profile_rate: float | None
+
+
+class ConfigSnapshot(NamedTuple):
+    """
+    Validated ZoneHandlerConf, free of any pydantic dependency
+    """
+
+    system: SystemSnapshot
+    users: dict[str, UserSnapshot]
+    key_index: dict[str, tuple[str, str]]
+
+
+class SourceKey(NamedTuple):
+    """Identifies the exact config file content a snapshot got compiled from"""
+
+    mtime_ns: int
+    size: int
+    inode: int
+    digest: str
+
+
+def ssh_key_fingerprint(key_blob: str) -> str:
+    """
+    OpenSSH style SHA256 fingerprint, as provided by sshd's %f token
+
+    :param key_blob: The base64 encoded public key, as provided by sshd's %k token
+    """
+
+    digest = hashlib.sha256(binascii.a2b_base64(key_blob)).digest()
+    return "SHA256:" + binascii.b2a_base64(digest, newline=False).decode().rstrip("=")
+
+
+def compile_config(config: "ZoneHandlerConf") -> ConfigSnapshot:
+    """Turn an already validated config into its snapshot form"""
+
+    system = SystemSnapshot(**config.system.model_dump())
+    users: dict[str, UserSnapshot] = {}
+    key_index: dict[str, tuple[str, str]] = {}
+    for user, user_conf in config.users.items():
+        users[user] = UserSnapshot(
+            ssh_keys=tuple(user_conf.ssh_keys),
+            zones=tuple(user_conf.zones),
+            limits={
+                command: limit.model_dump()
+                for command, limit in user_conf.limits.items()
+            },
+            profile_rate=user_conf.profile_rate,
+        )
+        for ssh_key in user_conf.ssh_keys:
+            try:
+                fingerprint = ssh_key_fingerprint(ssh_key.split()[1])
+            except binascii.Error:
+                continue
+            key_index[fingerprint] = (user, ssh_key)
+
+    return ConfigSnapshot(system=system, users=users, key_index=key_index)
+
+
+def config_diff(old: ConfigSnapshot, new: ConfigSnapshot) -> Iterator[str]:
+    """A compact, line per changed user, summary of the differences"""
+
+    if old.system != new.system:
+        changed = [
+            name
+            for name, old_value, new_value in zip(
+                SystemSnapshot._fields, old.system, new.system, strict=True
+            )
+            if old_value != new_value
+        ]
+        yield f"~ system: {', '.join(changed)}"
+
+    for user in old.users:
+        if user not in new.users:
+            yield f"- {user}"
+
+    for user, conf in new.users.items():
+        old_conf = old.users.get(user)
+        if old_conf is None:
+            yield f"+ {user}: {len(conf.zones)} zone(s), {len(conf.ssh_keys)} key(s)"
+            continue
+        if old_conf == conf:
+            continue
+
+        old_zones, zones = set(old_conf.zones), set(conf.zones)
+        changes = [f"+{zone}" for zone in conf.zones if zone not in old_zones]
+        changes += [f"-{zone}" for zone in old_conf.zones if zone not in zones]
+        added_keys = len(set(conf.ssh_keys) - set(old_conf.ssh_keys))
+        removed_keys = len(set(old_conf.ssh_keys) - set(conf.ssh_keys))
+        if added_keys or removed_keys:
+            changes.append(f"key(s) +{added_keys} -{removed_keys}")
+        if old_conf.limits != conf.limits:
+            changes.append("limits")
+        if old_conf.profile_rate != conf.profile_rate:
+            changes.append("profile_rate")
+        yield f"~ {user}: {' '.join(changes) or 'reordered'}"
+
+
+def tenant_dir(config_file: Path) -> Path:
+    """Where per-user config files go, e.g. /etc/zone-handler.d/alice.yaml"""
+    return config_file.with_suffix(".d")
+
+
+def config_stat(config_file: Path) -> ConfigStat:
+    """
+    The main config file, along with every per-user config file, for
+    long running services to tell when to reload
+    """
+
+    stats: ConfigStat = []
+    for path in (config_file, *sorted(tenant_dir(config_file).glob("*.yaml"))):
+        try:
+            file_stat = path.stat()
+        except OSError:
+            continue
+        stats.append(
+            (path.name, file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+        )
+    return stats
+
+
+class SnapshotCache:
+    """
+    Stores a marshalled ConfigSnapshot next to a fingerprint of the
+    config files it was compiled from.
+
+    The cheap stat() fingerprint is checked first, only falling back to
+    hashing the config files' content when the stat() results differ.
+    Either every per-user config file is covered, or only the one of a
+    single user.
+
+    Next to it, each key_index entry can be stored as a small file of its
+    own, as szh-sshkeys only ever looks up the single offered key.
+    """
+
+    def __init__(
+        self, config_file: Path, cache_dir: Path, user: str | None = None
+    ) -> None:
+        self.config_file: Final[Path] = config_file
+        self.cache_dir: Final[Path] = cache_dir
+        self.user: Final[str | None] = user
+
+        path_digest = hashlib.sha256(os.fsencode(config_file.absolute()))
+        if user is not None:
+            path_digest.update(b"\0" + user.encode())
+        name = f"{config_file.stem}-{path_digest.hexdigest()[:16]}.snapshot"
+        self.snapshot_file: Final[Path] = cache_dir / name
+        self.keys_dir: Final[Path] = (
+            cache_dir / f"{name.removesuffix('.snapshot')}.keys"
+        )
+
+        self.__source: dict[str, SourceKey] | None = None
+
+    @staticmethod
+    def __header() -> tuple[Any, ...]:
+        return (
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION,
+            marshal.version,
+            ConfigSnapshot._fields,
+            SystemSnapshot._fields,
+            UserSnapshot._fields,
+        )
+
+    def __stats(self) -> dict[str, os.stat_result]:
+        """Every source file, the main config file being required"""
+
+        stats = {os.fspath(self.config_file): self.config_file.stat()}
+
+        user_dir = tenant_dir(self.config_file)
+        if self.user is not None:
+            user_files = [user_dir / f"{self.user}.yaml"]
+        else:
+            user_files = sorted(user_dir.glob("*.yaml"))
+        for user_file in user_files:
+            try:
+                stats[os.fspath(user_file)] = user_file.stat()
+            except FileNotFoundError:
+                continue
+        return stats
+
+    @staticmethod
+    def __source_key(path: str, file_stat: os.stat_result) -> SourceKey:
+        content = Path(path).read_bytes()
+        return SourceKey(
+            mtime_ns=file_stat.st_mtime_ns,
+            size=file_stat.st_size,
+            inode=file_stat.st_ino,
+            digest=hashlib.sha256(content).hexdigest(),
+        )
+
+    def __key_file(self, fingerprint: str) -> Path | None:
+        if not fingerprint.startswith("SHA256:"):
+            return None
+        name = fingerprint[7:].replace("+", "-").replace("/", "_")
+        if not name or name.startswith("."):
+            return None
+        return self.keys_dir / name
+
+    def __trusted(self, *paths: Path) -> bool:
+        # Set up by root, or written by whichever user runs this
+        for path in (self.cache_dir, *(paths or (self.snapshot_file,))):
+            path_stat = path.stat()
+            if path_stat.st_uid not in (0, os.geteuid()):
+                logging.debug("Ignoring %s, owned by another user", path)
+                return False
+            if path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                logging.debug("Ignoring group/world writable %s", path)
+                return False
+        return True
+
+    def __read(self) -> tuple[dict[str, SourceKey], ConfigSnapshot] | None:
+        try:
+            if not self.__trusted():
+                return None
+            header, sources, system, users, key_index = marshal.loads(  # noqa: S302
+                self.snapshot_file.read_bytes()
+            )
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if header != self.__header():
+            return None
+
+        config = ConfigSnapshot(
+            system=SystemSnapshot(*system),
+            users={user: UserSnapshot(*conf) for user, conf in users.items()},
+            key_index=key_index,
+        )
+        return {path: SourceKey(*key) for path, key in sources.items()}, config
+
+    def load(self) -> ConfigSnapshot | None:
+        """
+        Return the snapshot if it matches the current config files.
+
+        On a cache miss the config files' fingerprint is retained, so that
+        a later store() records what was there before they got parsed.
+        """
+
+        try:
+            stats = self.__stats()
+        except OSError:
+            return None
+
+        cached = self.__read()
+        if cached:
+            sources, config = cached
+            if {path: key[:3] for path, key in sources.items()} == {
+                path: (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+                for path, file_stat in stats.items()
+            }:
+                self.__source = sources
+                return config
+
+        try:
+            self.__source = {
+                path: self.__source_key(path, file_stat)
+                for path, file_stat in stats.items()
+            }
+        except OSError:
+            return None
+
+        if cached and {path: key.digest for path, key in cached[0].items()} == {
+            path: key.digest for path, key in self.__source.items()
+        }:
+            # Same content, only touched. Refresh the stat() fingerprint.
+            self.store(cached[1])
+            return cached[1]
+
+        return None
+
+    def store(self, config: ConfigSnapshot) -> None:
+        """Atomically (re)write the snapshot, if the cache dir is present"""
+
+        if not self.__source or not self.cache_dir.is_dir():
+            return
+
+        users = {user: tuple(conf) for user, conf in config.users.items()}
+        content = marshal.dumps(
+            (
+                self.__header(),
+                {path: tuple(key) for path, key in self.__source.items()},
+                tuple(config.system),
+                users,
+                config.key_index,
+            )
+        )
+        self.__write(self.snapshot_file, content)
+
+    @staticmethod
+    def __write(path: Path, content: bytes) -> None:
+        tmp_file = path.parent / f".{path.name}.{os.getpid()}"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(content)
+            os.replace(tmp_file, path)
+        except OSError as err:
+            logging.debug("Unable to store config snapshot: %s", str(err))
+            try:
+                tmp_file.unlink()
+            except OSError:
+                pass
+
+    @staticmethod
+    def __unchanged(sources: dict[str, tuple[int, int, int] | None]) -> bool:
+        """Whether each file is as recorded, None recording it didn't exist"""
+
+        for path, key in sources.items():
+            try:
+                file_stat = os.stat(path)
+            except FileNotFoundError:
+                if key is not None:
+                    return False
+                continue
+            except OSError:
+                return False
+            if key != (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino):
+                return False
+        return True
+
+    def load_key(self, fingerprint: str) -> ConfigSnapshot | None:
+        """
+        Return system along with only the key_index entry of fingerprint
+
+        Only the stored entry, the main config file and the owning user's
+        config file get read or stat()ed. Keys without a current entry
+        return None, to be looked up in the full snapshot instead.
+        """
+
+        key_file = self.__key_file(fingerprint)
+        if key_file is None:
+            return None
+        try:
+            if not self.__trusted(self.keys_dir, key_file):
+                return None
+            header, sources, system, entry = marshal.loads(  # noqa: S302
+                key_file.read_bytes()
+            )
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if header != self.__header() or not self.__unchanged(sources):
+            return None
+
+        return ConfigSnapshot(
+            system=SystemSnapshot(*system),
+            users={},
+            key_index={fingerprint: entry},
+        )
+
+    def store_keys(
+        self, config: ConfigSnapshot, fingerprint: str | None = None
+    ) -> None:
+        """
+        (Re)write the key_index entries load_key() reads, if the cache dir
+        is present
+
+        :param fingerprint: Only write this single entry, rather than all
+        """
+
+        if not self.__source or not self.cache_dir.is_dir():
+            return
+        try:
+            self.keys_dir.mkdir(mode=0o755, exist_ok=True)
+        except OSError as err:
+            logging.debug("Unable to store config snapshot: %s", str(err))
+            return
+
+        main_file = os.fspath(self.config_file)
+        if fingerprint is None:
+            fingerprints: list[str] = list(config.key_index)
+        else:
+            fingerprints = [fingerprint] if fingerprint in config.key_index else []
+
+        names: set[str] = set()
+        for key_fingerprint in fingerprints:
+            key_file = self.__key_file(key_fingerprint)
+            if key_file is None:
+                continue
+            names.add(key_file.name)
+            user, ssh_key = config.key_index[key_fingerprint]
+            user_file = os.fspath(tenant_dir(self.config_file) / f"{user}.yaml")
+            user_source = self.__source.get(user_file)
+            sources = {
+                main_file: tuple(self.__source[main_file][:3]),
+                user_file: tuple(user_source[:3]) if user_source else None,
+            }
+            self.__write(
+                key_file,
+                marshal.dumps(
+                    (self.__header(), sources, tuple(config.system), (user, ssh_key))
+                ),
+            )
+
+        if fingerprint is None:
+            # Drop the entries of keys no longer configured
+            for key_file in self.keys_dir.iterdir():
+                if key_file.name not in names and not key_file.name.startswith("."):
+                    key_file.unlink(missing_ok=True)
@@ -34,3 +34,10 @@ LOGCONF: Final[dict[str, Any]] = {
         },
     },
 }
+
+# For interactive use, where there's no point in also logging to syslog
+CONSOLE_LOGCONF: Final[dict[str, Any]] = {
+    **LOGCONF,
+    "handlers": {"console": LOGCONF["handlers"]["console"]},
+    "loggers": {"": {**LOGCONF["loggers"][""], "handlers": ["console"]}},
+}
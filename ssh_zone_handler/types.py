@@ -1,17 +1,34 @@
 """Custom types"""
 
-from typing import Annotated, Final, Literal, TypedDict
+import binascii
+import sys
+from collections.abc import Mapping
+from typing import TYPE_CHECKING, Annotated, Any, Final, Literal, TypedDict
 
 from pydantic import BaseModel, Field, ValidationInfo, field_validator, model_validator
-from typing_extensions import Self
+
+if sys.version_info >= (3, 11):
+    from typing import Self
+else:
+    from typing_extensions import Self
+
+from .snapshot import ssh_key_fingerprint
+
+if TYPE_CHECKING:
+    from .snapshot import ConfigSnapshot, UserSnapshot
 
 InternalUser = Annotated[str, Field(pattern=r"^[a-z][a-z0-9.@_-]*[a-z0-9]$")]
 SystemUser = Annotated[str, Field(pattern=r"^[a-z_][a-z0-9_-]*[a-z0-9]$")]
+AbsolutePath = Annotated[str, Field(pattern=r"^/\S*$")]
+ControlAddress = Annotated[
+    str, Field(pattern=r"^(/\S+|\[[0-9a-fA-F:]+\]:[0-9]+|[0-9.]+:[0-9]+)$")
+]
 ServiceUnit = Annotated[str, Field(pattern=r"^[a-z][a-z0-9_-]*[a-z0-9]\.service$")]
 FwdZone = Annotated[str, Field(pattern=r"^([a-z0-9][a-z0-9-]+[a-z0-9]\.)+[a-z]+$")]
 Ptr4Zone = Annotated[str, Field(pattern=r"^[0-9/]+\.([0-9]+\.)+in-addr\.arpa$")]
 Ptr6Zone = Annotated[str, Field(pattern=r"^([a-f0-9]\.)+ip6\.arpa$")]
 Zone = FwdZone | Ptr4Zone | Ptr6Zone
+ZonePattern = Annotated[str, Field(pattern=r"^\*\.([a-z0-9/-]+\.)+[a-z]+$")]
 ServiceDefault = TypedDict("ServiceDefault", {"unit": ServiceUnit, "user": SystemUser})
 
 SSHKey = Annotated[str, Field(pattern=r"^(ecdsa-sha2-nistp256 AAAAE2VjZHNhLXNoYTItbmlzdHAyNT|ecdsa-sha2-nistp384 AAAAE2VjZHNhLXNoYTItbmlzdHAzOD|ecdsa-sha2-nistp521 AAAAE2VjZHNhLXNoYTItbmlzdHA1Mj|sk-ecdsa-sha2-nistp256@openssh.com AAAAInNrLWVjZHNhLXNoYTItbmlzdHAyNTZAb3BlbnNzaC5jb2|ssh-ed25519 AAAAC3NzaC1lZDI1NTE5|sk-ssh-ed25519@openssh.com AAAAGnNrLXNzaC1lZDI1NTE5QG9wZW5zc2guY29t|ssh-rsa AAAAB3NzaC1yc2)[0-9A-Za-z+/]+[=]{0,3}(\s.*)?$")]  # fmt: skip
@@ -28,6 +45,19 @@ SERVICE_DEFAULTS: Final[dict[str, ServiceDefault]] = {
 }
 
 
+LimitedCommand = Literal["status", "dump", "logs", "retransfer"]
+
+
+class CommandLimit(BaseModel, extra="forbid", frozen=True):
+    """
+    Per-user limits of a single command
+    """
+
+    per_minute: int | None = Field(default=None, gt=0)
+    burst: int | None = Field(default=None, gt=0)
+    concurrent: int | None = Field(default=None, gt=0)
+
+
 class SystemConf(BaseModel, extra="forbid", frozen=True):
     """
     Subset of ZoneHandlerConf
@@ -38,6 +68,24 @@ class SystemConf(BaseModel, extra="forbid", frozen=True):
     server_type: Literal["bind", "knot"]
     server_user: SystemUser = Field(default="", validate_default=True)
     systemd_unit: ServiceUnit = Field(default="", validate_default=True)
+    journalctl_grep: bool = False
+    log_index_dir: AbsolutePath | None = None
+    log_index_max_bytes: int = Field(default=1024 * 1024, gt=0)
+    dump_cache_dir: AbsolutePath | None = None
+    dump_cache_max_bytes: int = Field(default=256 * 1024 * 1024, gt=0)
+    runtime_dir: AbsolutePath | None = None
+    max_workers: int = Field(default=4, gt=0, le=32)
+    knot_control_socket: AbsolutePath = "/run/knot/knot.sock"
+    knot_proxy_socket: AbsolutePath | None = None
+    rndc_control: ControlAddress | None = None
+    rndc_key_file: AbsolutePath = "/etc/bind/rndc.key"
+    broker_socket: AbsolutePath | None = None
+    retransfer_cooldown: int = Field(default=60, ge=0)
+    limits: dict[LimitedCommand, CommandLimit] = {}
+    metrics_dir: AbsolutePath | None = None
+    profile_dir: AbsolutePath | None = None
+    profile_rate: float = Field(default=0.0, ge=0, le=1)
+    profile_max_files: int = Field(default=100, gt=0)
 
     @field_validator("server_user", mode="before")
     @classmethod
@@ -66,16 +114,125 @@ class UserConf(BaseModel, extra="forbid", frozen=True):
     """
 
     ssh_keys: list[SSHKey] = []
-    zones: list[Zone]
+    zones: list[Zone | ZonePattern]
+    limits: dict[LimitedCommand, CommandLimit] = {}
+    profile_rate: float | None = Field(default=None, ge=0, le=1)
 
     @field_validator("ssh_keys", mode="after")
     @classmethod
     def _clean_ssh_keys(cls, ssh_keys: list[SSHKey]) -> list[SSHKey]:
         cleaned_keys: list[SSHKey] = []
         for ssh_key in ssh_keys:
-            cleaned_keys.append(" ".join(ssh_key.split()[:2]))
+            key_type, key_blob = ssh_key.split()[:2]
+            try:
+                ssh_key_fingerprint(key_blob)
+            except binascii.Error as err:
+                raise ValueError(f"Malformed {key_type} key") from err
+            cleaned_keys.append(f"{key_type} {key_blob}")
         return cleaned_keys
 
+    @field_validator("zones", mode="after")
+    @classmethod
+    def _check_duplicate_zones(
+        cls, zones: list[Zone | ZonePattern]
+    ) -> list[Zone | ZonePattern]:
+        seen: set[str] = set()
+        for zone in zones:
+            if zone in seen:
+                raise ValueError(f"Duplicate zone {zone}")
+            seen.add(zone)
+        return zones
+
+
+def duplicate_keys(users: Mapping[str, UserConf]) -> list[str]:
+    """Fingerprints of the ssh keys configured more than once"""
+
+    seen: set[str] = set()
+    duplicates: dict[str, None] = {}
+    for user_conf in users.values():
+        for ssh_key in user_conf.ssh_keys:
+            if ssh_key in seen:
+                duplicates[ssh_key_fingerprint(ssh_key.split()[1])] = None
+            seen.add(ssh_key)
+    return list(duplicates)
+
+
+def shared_zones(users: Mapping[str, UserConf]) -> dict[str, list[str]]:
+    """
+    Zones configured for more than a single user, along with those users
+
+    A "*.suffix" pattern counts as shared with every user granted any zone
+    below that suffix, whether through an exact zone or another pattern.
+    """
+
+    from .zones import shared_grants  # noqa: PLC0415
+
+    return shared_grants({user: user_conf.zones for user, user_conf in users.items()})
+
+
+def _unchanged_key(ssh_key: Any, reference: str) -> bool:  # noqa: ANN401
+    if not isinstance(ssh_key, str) or "\n" in ssh_key:
+        return False
+    comment = ssh_key.removeprefix(reference)
+    return comment != ssh_key and (not comment or comment[0].isspace())
+
+
+def _unchanged_user(user_conf: Any, reference: "UserSnapshot") -> bool:  # noqa: ANN401
+    if not isinstance(user_conf, dict) or not user_conf.keys() <= {
+        "ssh_keys",
+        "zones",
+        "limits",
+        "profile_rate",
+    }:
+        return False
+
+    ssh_keys = user_conf.get("ssh_keys", [])
+    limits = {
+        command: {name: value for name, value in limit.items() if value is not None}
+        for command, limit in reference.limits.items()
+    }
+    return (
+        user_conf.get("zones") == list(reference.zones)
+        and user_conf.get("limits", {}) == limits
+        and user_conf.get("profile_rate") == reference.profile_rate
+        and isinstance(ssh_keys, list)
+        and len(ssh_keys) == len(reference.ssh_keys)
+        and all(map(_unchanged_key, ssh_keys, reference.ssh_keys))
+    )
+
+
+def reuse_validated_users(users: Any, reference: "ConfigSnapshot") -> Any:  # noqa: ANN401
+    """
+    Swap in already validated UserConf, of users unchanged since the reference
+
+    Only the other users then get validated, along with the checks
+    spanning every user.
+
+    :param users: The users section, as loaded from YAML
+    :param reference: A snapshot of an earlier, validated, config
+    """
+
+    if not isinstance(users, dict):
+        return users
+
+    reused: dict[Any, Any] = {}
+    for user, user_conf in users.items():
+        known = reference.users.get(user)
+        if known is None or not _unchanged_user(user_conf, known):
+            reused[user] = user_conf
+            continue
+
+        reused[user] = UserConf.model_construct(
+            ssh_keys=list(known.ssh_keys),
+            zones=list(known.zones),
+            limits={
+                command: CommandLimit(**limit)
+                for command, limit in known.limits.items()
+            },
+            profile_rate=known.profile_rate,
+        )
+    return reused
+
 
 class ZoneHandlerConf(BaseModel, extra="forbid", frozen=True):
     """
@@ -83,15 +240,22 @@ class ZoneHandlerConf(BaseModel, extra="forbid", frozen=True):
     """
 
     system: SystemConf
-    users: dict[InternalUser, UserConf]
+    users: dict[InternalUser, UserConf] = {}
 
     @model_validator(mode="after")
     def _check_duplicate_keys(self) -> Self:
-        all_the_keys: list[SSHKey] = []
-        for user_conf in self.users.values():
-            all_the_keys.extend(user_conf.ssh_keys)
+        duplicates = duplicate_keys(self.users)
+        if duplicates:
+            raise ValueError("Duplicate ssh keys not allowed: " + ", ".join(duplicates))
 
-        if sorted(all_the_keys) != sorted(set(all_the_keys)):
-            raise ValueError("Duplicate ssh keys not allowed")
+        return self
+
+    @model_validator(mode="after")
+    def _check_limits_state(self) -> Self:
+        limited = bool(self.system.limits) or any(
+            user_conf.limits for user_conf in self.users.values()
+        )
+        if limited and not self.system.runtime_dir:
+            raise ValueError("Command limits require a runtime_dir")
 
         return self
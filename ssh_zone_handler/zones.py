@@ -0,0 +1,175 @@
+"""Zone ownership, as granted through exact zone names and suffix patterns"""
+
+import re
+from collections.abc import Container, Iterable, Mapping
+from typing import Final
+
+PATTERN_PREFIX: Final[str] = "*."
+
+# What a zone below a pattern's suffix has to look like, never passing
+# anything resembling a command line option on to the server's tools
+ZONE_NAME_PATTERN: Final[re.Pattern[str]] = re.compile(
+    r"^([a-z0-9_][a-z0-9/_-]*\.)+[a-z0-9-]+$"
+)
+
+# Labels are never empty, leaving the empty string free to mark a pattern's end
+PATTERN_END: Final[str] = ""
+
+Trie = dict[str, "Trie"]
+
+
+def is_pattern(grant: str) -> bool:
+    """Whether a configured zone is a "*.suffix" pattern"""
+
+    return grant.startswith(PATTERN_PREFIX)
+
+
+class ZoneGrants(Container[str]):
+    """
+    The zones a single user may act upon
+
+    Exact zone names go into a set. Every "*.suffix" pattern, granting
+    any zone below that suffix, goes into a trie of labels, from the top
+    level label down. Checking a zone then costs one set lookup, plus a
+    walk of at most as many trie nodes as the zone has labels, regardless
+    of the number of grants.
+    """
+
+    def __init__(self, grants: Iterable[str]) -> None:
+        exact: list[str] = []
+        patterns: list[str] = []
+        self.__trie: Final[Trie] = {}
+
+        for grant in grants:
+            if not is_pattern(grant):
+                exact.append(grant)
+                continue
+            patterns.append(grant)
+            node = self.__trie
+            for label in reversed(grant.removeprefix(PATTERN_PREFIX).split(".")):
+                node = node.setdefault(label, {})
+            node[PATTERN_END] = {}
+
+        self.zones: Final[tuple[str, ...]] = tuple(exact)
+        self.patterns: Final[tuple[str, ...]] = tuple(patterns)
+        self.__exact: Final[frozenset[str]] = frozenset(exact)
+
+    def __contains__(self, zone: object) -> bool:
+        if not isinstance(zone, str):
+            return False
+        if zone in self.__exact:
+            return True
+        if not self.patterns or not ZONE_NAME_PATTERN.match(zone):
+            return False
+
+        # A pattern only grants zones below its suffix, never the suffix itself
+        node = self.__trie
+        for label in reversed(zone.split(".")[1:]):
+            if label not in node:
+                return False
+            node = node[label]
+            if PATTERN_END in node:
+                return True
+        return False
+
+    def expand(self, server_zones: Iterable[str]) -> list[str]:
+        """
+        Exact zones as configured, followed by the server's pattern matches
+
+        :param server_zones: Every zone configured on the DNS server
+        """
+
+        matched = {
+            zone for zone in server_zones if zone not in self.__exact and zone in self
+        }
+        return list(self.zones) + sorted(matched)
+
+
+class _PatternNode:
+    """A label of the shared pattern trie, along with whose grants are below"""
+
+    __slots__ = ("below", "children", "exact_below", "holders")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _PatternNode] = {}
+        self.holders: set[int] = set()
+        self.below: set[int] = set()
+        self.exact_below: set[int] = set()
+
+
+def _labels(grant: str) -> list[str]:
+    """Of a zone, or a pattern's suffix, from the top level label down"""
+
+    return grant.removeprefix(PATTERN_PREFIX).split(".")[::-1]
+
+
+def _add_pattern(root: _PatternNode, pattern: str, number: int) -> None:
+    node = root
+    for label in _labels(pattern):
+        node.below.add(number)
+        node = node.children.setdefault(label, _PatternNode())
+    node.holders.add(number)
+
+
+def _exact_owners(root: _PatternNode, zone: str, numbers: list[int]) -> set[int]:
+    """Also marking the zone's users as below every pattern granting it"""
+
+    node = root
+    owners = set(numbers)
+    # A pattern only grants zones below its suffix, never the suffix itself
+    for label in _labels(zone)[:-1]:
+        if label not in node.children:
+            break
+        node = node.children[label]
+        if node.holders:
+            owners |= node.holders
+            node.exact_below.update(numbers)
+    return owners
+
+
+def _pattern_owners(root: _PatternNode, pattern: str) -> set[int]:
+    node = root
+    owners: set[int] = set()
+    for label in _labels(pattern):
+        node = node.children[label]
+        owners |= node.holders
+    return owners | node.below | node.exact_below
+
+
+def shared_grants(grants: Mapping[str, Iterable[str]]) -> dict[str, list[str]]:
+    """
+    Grants overlapping those of any other user, along with all their users
+
+    Exact zones get indexed by name, every pattern goes into a single trie
+    shared by all users. Each grant then gets resolved by walking only its
+    own labels, keeping the whole check linear in the number of grants.
+    A "*.suffix" pattern overlaps any zone or pattern below that suffix,
+    as well as any pattern of that same suffix, or one above it.
+
+    :param grants: Every user's configured zones, exact or pattern
+    """
+
+    users = list(grants)
+    exact: dict[str, list[int]] = {}
+    root = _PatternNode()
+    for number, user in enumerate(users):
+        for grant in grants[user]:
+            if is_pattern(grant):
+                _add_pattern(root, grant, number)
+            else:
+                exact.setdefault(grant, []).append(number)
+
+    owners: dict[str, set[int]] = {}
+    for zone, numbers in exact.items():
+        owners[zone] = _exact_owners(root, zone, numbers)
+
+    shared: dict[str, list[str]] = {}
+    for user in users:
+        for grant in grants[user]:
+            if grant in shared:
+                continue
+            if grant not in owners:
+                owners[grant] = _pattern_owners(root, grant)
+            if len(owners[grant]) > 1:
+                shared[grant] = [users[number] for number in sorted(owners[grant])]
+    return shared
@@ -1,21 +1,64 @@
 # ruff: noqa: ANN001, ANN201, S101
 """Testing top level functionality"""
 
+import calendar
+import gzip
+import io
+import logging
 import os
+import pstats
+import pwd
+import re
+import socket
+import subprocess
 import sys
+import threading
+import time
+from collections.abc import Iterator
 from pathlib import Path
 
 import pytest
 
+import ssh_zone_handler.cli
+from ssh_zone_handler.base import InvokeError, SshZoneCommand, ZoneStatus
 from ssh_zone_handler.bind import BindCommand
+from ssh_zone_handler.broker import SshZoneBroker, invoke_via_broker
+from ssh_zone_handler.cache import DumpCache, MetaCache
 from ssh_zone_handler.cli import (
     ConfigFileError,
+    _command_class,
+    _load_config,
     _read_config,
     ssh_keys,
     sudoers,
+    verifier,
     wrapper,
 )
 from ssh_zone_handler.knot import KnotCommand
+from ssh_zone_handler.knotctl import (
+    CTL_BLOCK,
+    CTL_DATA,
+    IDX_CMD,
+    IDX_ZONE,
+    KnotCtl,
+    KnotCtlError,
+    KnotCtlProxy,
+)
+from ssh_zone_handler.limits import CommandLimit, CommandLimiter, RetransferCooldown
+from ssh_zone_handler.logindex import LogIndex, LogIndexer
+from ssh_zone_handler.metrics import Invocation
+from ssh_zone_handler.rndc import (
+    RndcClient,
+    RndcError,
+    RndcKey,
+    decode_message,
+    encode_message,
+    read_message,
+    read_rndc_key,
+)
+from ssh_zone_handler.snapshot import SnapshotCache
+from ssh_zone_handler.types import UserConf, reuse_validated_users, shared_zones
+from ssh_zone_handler.zones import ZoneGrants
 
 
 def test_cli_read_config():
@@ -27,6 +70,24 @@ def test_cli_read_config():
             "server_type": "bind",
             "server_user": "bind",
             "systemd_unit": "named.service",
+            "journalctl_grep": False,
+            "log_index_dir": None,
+            "log_index_max_bytes": 1048576,
+            "dump_cache_dir": None,
+            "dump_cache_max_bytes": 268435456,
+            "runtime_dir": None,
+            "max_workers": 4,
+            "knot_control_socket": "/run/knot/knot.sock",
+            "knot_proxy_socket": None,
+            "rndc_control": None,
+            "rndc_key_file": "/etc/bind/rndc.key",
+            "broker_socket": None,
+            "retransfer_cooldown": 60,
+            "limits": {},
+            "metrics_dir": None,
+            "profile_dir": None,
+            "profile_rate": 0.0,
+            "profile_max_files": 100,
         },
         "users": {
             "alice": {
@@ -35,12 +96,16 @@ def test_cli_read_config():
                     "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIIOy9uTo12niUl2JCWUebyzr/5pMa64BuFc/0nGjtQad",
                 ],
                 "zones": ["example.com", "example.net"],
+                "limits": {},
+                "profile_rate": None,
             },
             "bob": {
                 "ssh_keys": [
                     "sk-ecdsa-sha2-nistp256@openssh.com AAAAInNrLWVjZHNhLXNoYTItbmlzdHAyNTZAb3BlbnNzaC5jb20AAAAIbmlzdHAyNTYAAABBBPnGjVz9axrV3stm+5onXYSO/MIOdggKBw5Y5jYJReqwnkIuQ+OMME6oQUuvev+hCURpnKBlfC8zcHRKWUYFF1IAAAAEc3NoOg==",
                 ],
                 "zones": ["example.org"],
+                "limits": {},
+                "profile_rate": None,
             },
         },
     }
@@ -53,11 +118,31 @@ def test_cli_read_config():
             "server_type": "bind",
             "server_user": "named",
             "systemd_unit": "bind9.service",
+            "journalctl_grep": False,
+            "log_index_dir": None,
+            "log_index_max_bytes": 1048576,
+            "dump_cache_dir": None,
+            "dump_cache_max_bytes": 268435456,
+            "runtime_dir": None,
+            "max_workers": 4,
+            "knot_control_socket": "/run/knot/knot.sock",
+            "knot_proxy_socket": None,
+            "rndc_control": None,
+            "rndc_key_file": "/etc/bind/rndc.key",
+            "broker_socket": None,
+            "retransfer_cooldown": 60,
+            "limits": {},
+            "metrics_dir": None,
+            "profile_dir": None,
+            "profile_rate": 0.0,
+            "profile_max_files": 100,
         },
         "users": {
             "bob": {
                 "ssh_keys": [],
                 "zones": [],
+                "limits": {},
+                "profile_rate": None,
             },
         },
     }
@@ -70,6 +155,24 @@ def test_cli_read_config():
             "server_type": "knot",
             "server_user": "knot",
             "systemd_unit": "knot.service",
+            "journalctl_grep": False,
+            "log_index_dir": None,
+            "log_index_max_bytes": 1048576,
+            "dump_cache_dir": None,
+            "dump_cache_max_bytes": 268435456,
+            "runtime_dir": None,
+            "max_workers": 4,
+            "knot_control_socket": "/run/knot/knot.sock",
+            "knot_proxy_socket": None,
+            "rndc_control": None,
+            "rndc_key_file": "/etc/bind/rndc.key",
+            "broker_socket": None,
+            "retransfer_cooldown": 60,
+            "limits": {},
+            "metrics_dir": None,
+            "profile_dir": None,
+            "profile_rate": 0.0,
+            "profile_max_files": 100,
         },
         "users": {
             "alice": {
@@ -78,12 +181,16 @@ def test_cli_read_config():
                     "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIIOy9uTo12niUl2JCWUebyzr/5pMa64BuFc/0nGjtQad",
                 ],
                 "zones": ["example.com", "example.net"],
+                "limits": {},
+                "profile_rate": None,
             },
             "bob": {
                 "ssh_keys": [
                     "sk-ecdsa-sha2-nistp256@openssh.com AAAAInNrLWVjZHNhLXNoYTItbmlzdHAyNTZAb3BlbnNzaC5jb20AAAAIbmlzdHAyNTYAAABBBPnGjVz9axrV3stm+5onXYSO/MIOdggKBw5Y5jYJReqwnkIuQ+OMME6oQUuvev+hCURpnKBlfC8zcHRKWUYFF1IAAAAEc3NoOg==",
                 ],
                 "zones": ["example.org"],
+                "limits": {},
+                "profile_rate": None,
             },
         },
     }
@@ -92,7 +199,73 @@ def test_cli_read_config():
         _read_config(Path("./tests/data/outdated-config.yaml"))
 
 
-def test_cli_zone_ssh_keys(caplog, capsys):
+def test_cli_verify(caplog, capsys, mocker, tmp_path):
+    example = Path("./tests/data/bind-example-config.yaml")
+    mocker.patch("sys.argv", ["_", str(example)])
+    verifier()
+    assert capsys.readouterr().out == ""
+
+    content = example.read_text(encoding="utf-8")
+    config_file = tmp_path / "zone-handler.yaml"
+    for broken, error in [
+        ("      - example.com\n", "Duplicate zone example.com"),
+        ("AAAAC3NzaC1lZDI1NTE5AAAAIIOy9", "Malformed ssh-ed25519 key"),
+    ]:
+        config_file.write_text(content.replace(broken, broken * 2), encoding="utf-8")
+        mocker.patch("sys.argv", ["_", str(config_file)])
+        caplog.clear()
+        with pytest.raises(SystemExit):
+            verifier()
+        assert error in caplog.text
+
+    mocker.patch("sys.argv", ["_", "./tests/data/duplicate-ssh-keys-config.yaml"])
+    caplog.clear()
+    with pytest.raises(SystemExit):
+        verifier()
+    assert (
+        "Duplicate ssh keys not allowed: "
+        + "SHA256:l1C6ejW6aOGAnlbxUHaSWsPTluulpOryWCmQRDeHSYQ"
+    ) in caplog.text
+
+    # Alice gets another zone, shared with Bob, and Carol gets added
+    carol = "  carol:\n    zones:\n      - example.info\n"
+    config_file.write_text(
+        content.replace(
+            "      - example.net\n", "      - example.net\n      - example.org\n"
+        )
+        + carol,
+        encoding="utf-8",
+    )
+    mocker.patch(
+        "sys.argv", ["_", str(config_file), "--against", str(example.absolute())]
+    )
+    caplog.clear()
+    verifier()
+    assert (
+        capsys.readouterr().out
+        == "~ alice: +example.org\n+ carol: 1 zone(s), 0 key(s)\n"
+    )
+    assert caplog.text == 'Zone "example.org" shared by: alice, bob\n'
+
+    reference = _load_config(example)
+    reused = reuse_validated_users(
+        {
+            "alice": {
+                "ssh_keys": [
+                    key + " with a comment" for key in reference.users["alice"].ssh_keys
+                ],
+                "zones": ["example.com", "example.net"],
+            },
+            "bob": {"zones": ["example.org"], "ssh_keys": ["changed"]},
+        },
+        reference,
+    )
+    assert isinstance(reused["alice"], UserConf)
+    assert reused["bob"] == {"zones": ["example.org"], "ssh_keys": ["changed"]}
+
+
+def test_cli_zone_ssh_keys(caplog, capsys, mocker):
+    mocker.patch("sys.argv", sys.argv[:1])
     wrapper = Path(sys.argv[0]).absolute().parent / "szh-wrapper"
 
     ssh_keys(Path("./tests/data/bind-example-config.yaml"))
@@ -117,36 +290,79 @@ def test_cli_zone_ssh_keys(caplog, capsys):
         sudoers(Path("./tests/data/duplicate-ssh-keys-config.yaml"))
 
 
+def test_cli_zone_ssh_keys_lookup(capsys, mocker):
+    wrapper = Path(sys.argv[0]).absolute().parent / "szh-wrapper"
+    config_file = Path("./tests/data/bind-example-config.yaml")
+    alice_key = "AAAAC3NzaC1lZDI1NTE5AAAAIIOy9uTo12niUl2JCWUebyzr/5pMa64BuFc/0nGjtQad"
+    alice_entry = f'command="{wrapper} alice",restrict ssh-ed25519 {alice_key}\n'
+
+    mocker.patch("sys.argv", [sys.argv[0], "zones", "ssh-ed25519", alice_key])
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == alice_entry
+
+    fingerprint = "SHA256:l1C6ejW6aOGAnlbxUHaSWsPTluulpOryWCmQRDeHSYQ"
+    mocker.patch("sys.argv", [sys.argv[0], "zones", fingerprint])
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == alice_entry
+
+    mocker.patch("sys.argv", [sys.argv[0], "root", fingerprint])
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == ""
+
+    mocker.patch("sys.argv", [sys.argv[0], "zones", "ssh-rsa", alice_key])
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == ""
+
+    mocker.patch("sys.argv", [sys.argv[0], "zones", "ssh-ed25519", "AAAA"])
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == ""
+
+
 def test_cli_zone_sudoers(caplog, capsys):
     sudoers(Path("./tests/data/bind-example-config.yaml"))
     captured_expected = capsys.readouterr()
 
-    assert captured_expected.out == "\n".join(
-        [
-            "zones\tALL=(szh-logviewer) NOPASSWD: /usr/bin/journalctl --unit=named.service --since=-5days --utc",
-            "zones\tALL=(bind) NOPASSWD: /usr/sbin/rndc retransfer *",
-            "zones\tALL=(bind) NOPASSWD: /usr/sbin/rndc zonestatus *\n",
-        ]
+    rules_expected = captured_expected.out.split("\n")
+    assert rules_expected[0] == (
+        "zones\tALL=(szh-logviewer) NOPASSWD: /usr/bin/journalctl --unit=named.service --since=-5days --utc"
+    )
+    assert (
+        "zones\tALL=(szh-logviewer) NOPASSWD: /usr/bin/journalctl --unit=named.service --since=-1day --until=-6h --utc --reverse"
+        in rules_expected
     )
+    # Five since windows, each with every shorter until window, and reversed
+    window_combinations = 5 + 4 + 3 + 2 + 1
+    journal_rules = [rule for rule in rules_expected if "journalctl" in rule]
+    assert len(journal_rules) == 2 * window_combinations
+    assert not [rule for rule in rules_expected if "journalctl" in rule and "*" in rule]
+    assert rules_expected[-4:] == [
+        "zones\tALL=(bind) NOPASSWD: /usr/sbin/rndc retransfer *",
+        "zones\tALL=(bind) NOPASSWD: /usr/sbin/rndc zonestatus *",
+        "zones\tALL=(bind) NOPASSWD: /usr/bin/named-checkconf -l",
+        "",
+    ]
 
     caplog.clear()
     sudoers(Path("./tests/data/knot-example-config.yaml"))
     captured_knot_expected = capsys.readouterr()
 
-    assert captured_knot_expected.out == "\n".join(
-        [
-            "zones\tALL=(szh-logviewer) NOPASSWD: /usr/bin/journalctl --unit=knot.service --since=-5days --utc",
-            "zones\tALL=(knot) NOPASSWD: /usr/sbin/knotc zone-read *",
-            "zones\tALL=(knot) NOPASSWD: /usr/sbin/knotc zone-retransfer *\n",
-        ]
+    rules_knot_expected = captured_knot_expected.out.split("\n")
+    assert rules_knot_expected[0] == (
+        "zones\tALL=(szh-logviewer) NOPASSWD: /usr/bin/journalctl --unit=knot.service --since=-5days --utc"
     )
+    assert rules_knot_expected[-4:] == [
+        "zones\tALL=(knot) NOPASSWD: /usr/sbin/knotc zone-read *",
+        "zones\tALL=(knot) NOPASSWD: /usr/sbin/knotc zone-retransfer *",
+        "zones\tALL=(knot) NOPASSWD: /usr/sbin/knotc zone-status *",
+        "",
+    ]
 
     caplog.clear()
     with pytest.raises(SystemExit):
         sudoers(Path("./tests/data/outdated-config.yaml"))
     captured_outdated = caplog.text
     assert (
-        "Invalid server side config file\n\n5 validation errors for ZoneHandlerConf"
+        "Invalid server side config file\n\n4 validation errors for ZoneHandlerConf"
         in captured_outdated
     )
 
@@ -218,6 +434,20 @@ def test_bind_log_filtering():
         filtered.append(line)
     assert filtered == filtered_data_com_net.split("\n")
 
+    # Classless reverse zones, RFC 2317 style, contain a "/" of their own
+    classless = "0/26.2.0.192.in-addr.arpa"
+    classless_lines = [
+        f"named[1]: zone {classless}/IN: Transfer started.",
+        f"named[1]: transfer of '{classless}/IN' from 192.0.2.1#53: connected",
+        f"named[1]: transfer of '{classless}/AXFR/IN' from 192.0.2.1#53: failed",
+        f"named[1]: received control channel command 'retransfer {classless}'",
+        "named[1]: zone 64/26.2.0.192.in-addr.arpa/IN: Transfer started.",
+    ]
+    assert (
+        list(BindCommand._filter_logs(classless_lines, [classless]))
+        == (classless_lines[:-1])
+    )
+
 
 def test_knot_log_filtering():
     filtered_file_net = Path("./tests/data/filtered-knot-example-net.txt")
@@ -241,3 +471,1468 @@ def test_knot_log_filtering():
     for line in KnotCommand._filter_logs(log_lines, zones):
         filtered.append(line)
     assert filtered == filtered_data_com_net.split("\n")
+
+
+def test_cli_config_snapshot(capsys, mocker, tmp_path):
+    mocker.patch("sys.argv", sys.argv[:1])
+    snapshot_dir = tmp_path / "cache"
+    snapshot_dir.mkdir(mode=0o755)
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", snapshot_dir)
+
+    # szh-sshkeys and szh-wrapper run as different users, each with its own dir
+    user_dirs = {name: snapshot_dir / name for name in ("szh-sshdcmd", "zones")}
+    for user_dir in user_dirs.values():
+        user_dir.mkdir(mode=0o700)
+    running_as = mocker.patch("pwd.getpwuid")
+    running_as.return_value.pw_name = "szh-sshdcmd"
+
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_bytes(Path("./tests/data/bind-example-config.yaml").read_bytes())
+
+    ssh_keys(config_file)
+    captured_compiled = capsys.readouterr()
+    assert len(list(user_dirs["szh-sshdcmd"].glob("*.snapshot"))) == 1
+
+    read_config = mocker.patch(
+        "ssh_zone_handler.cli._read_config", side_effect=AssertionError
+    )
+    ssh_keys(config_file)
+    captured_snapshot = capsys.readouterr()
+    assert captured_snapshot.out == captured_compiled.out
+
+    os.utime(config_file, ns=(0, 0))
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == captured_compiled.out
+    read_config.assert_not_called()
+
+    # Neither root nor the running user wrote it
+    snapshot_file = next(user_dirs["szh-sshdcmd"].glob("*.snapshot"))
+    if os.geteuid() == 0:
+        os.chown(snapshot_file, 65534, -1)
+    else:
+        mocker.patch("os.geteuid", return_value=os.geteuid() + 1)
+    with pytest.raises(AssertionError):
+        ssh_keys(config_file)
+    snapshot_file.unlink()
+
+    config_file.write_bytes(Path("./tests/data/knot-example-config.yaml").read_bytes())
+    mocker.stopall()
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", snapshot_dir)
+    mocker.patch("pwd.getpwuid").return_value.pw_name = "zones"
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "list"
+    read_config = mocker.spy(ssh_zone_handler.cli, "_read_config")
+    for _ in range(2):
+        wrapper(config_file)
+        assert capsys.readouterr().out == "example.com\nexample.net\n"
+    read_config.assert_called_once()
+    assert len(list(user_dirs["zones"].glob("*.snapshot"))) == 1
+    assert not list(user_dirs["szh-sshdcmd"].glob("*.snapshot"))
+
+
+def test_cli_ssh_keys_key_index(capsys, mocker, tmp_path):
+    snapshot_dir = tmp_path / "cache"
+    (snapshot_dir / "szh-sshdcmd").mkdir(mode=0o700, parents=True)
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", snapshot_dir)
+    mocker.patch("pwd.getpwuid").return_value.pw_name = "szh-sshdcmd"
+
+    example = Path("./tests/data/bind-example-config.yaml").read_text(encoding="utf-8")
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(example, encoding="utf-8")
+
+    wrapper_path = Path(sys.argv[0]).absolute().parent / "szh-wrapper"
+    alice_key = "AAAAC3NzaC1lZDI1NTE5AAAAIIOy9uTo12niUl2JCWUebyzr/5pMa64BuFc/0nGjtQad"
+    alice_entry = f'command="{wrapper_path} alice",restrict ssh-ed25519 {alice_key}\n'
+    fingerprint = "SHA256:l1C6ejW6aOGAnlbxUHaSWsPTluulpOryWCmQRDeHSYQ"
+
+    mocker.patch("sys.argv", [sys.argv[0], "zones", fingerprint])
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == alice_entry
+    keys_dir = next((snapshot_dir / "szh-sshdcmd").glob("*.keys"))
+    assert len(list(keys_dir.iterdir())) == len(["alice", "alice", "bob"])
+
+    # Neither the snapshot, nor any other config file, gets looked at
+    load = mocker.patch.object(SnapshotCache, "load", side_effect=AssertionError)
+    for argv in (["zones", fingerprint], ["zones", "ssh-ed25519", alice_key]):
+        mocker.patch("sys.argv", [sys.argv[0], *argv])
+        ssh_keys(config_file)
+        assert capsys.readouterr().out == alice_entry
+    load.assert_not_called()
+
+    # Keys without an entry still get looked up in the snapshot
+    mocker.patch("sys.argv", [sys.argv[0], "zones", "SHA256:unknown"])
+    with pytest.raises(AssertionError):
+        ssh_keys(config_file)
+    mocker.stop(load)
+
+    # A changed config file makes the entry stale, until refreshed
+    os.utime(config_file, ns=(0, 0))
+    load = mocker.spy(SnapshotCache, "load")
+    mocker.patch("sys.argv", [sys.argv[0], "zones", fingerprint])
+    for _ in range(2):
+        ssh_keys(config_file)
+        assert capsys.readouterr().out == alice_entry
+    load.assert_called_once()
+
+    # Or gone, once the key got removed
+    config_file.write_text(example.replace(alice_key, "removed"), encoding="utf-8")
+    with pytest.raises(SystemExit):
+        ssh_keys(config_file)
+    config_file.write_text(
+        example.replace(f"      - ssh-ed25519 {alice_key} andreas@corrino\n", ""),
+        encoding="utf-8",
+    )
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == ""
+    assert len(list(keys_dir.iterdir())) == len(["alice", "bob"])
+
+    # The owner of a per-user config file gets it checked as well
+    user_dir = tmp_path / "zone-handler.d"
+    user_dir.mkdir()
+    system, _, users = example.partition("users:\n")
+    alice, _, bob = users.partition("  bob:\n")
+    config_file.write_text(f"{system}users:\n  bob:\n{bob}", encoding="utf-8")
+    alice_file = user_dir / "alice.yaml"
+    alice_file.write_text(alice.replace("\n    ", "\n")[9:], encoding="utf-8")
+    ssh_keys(config_file)
+    assert capsys.readouterr().out == alice_entry
+    alice_file.write_text(
+        alice_file.read_text(encoding="utf-8").replace(alice_key, "AAAA"),
+        encoding="utf-8",
+    )
+    with pytest.raises(SystemExit):
+        ssh_keys(config_file)
+
+
+def test_cli_tenant_config_dir(capsys, mocker, tmp_path):
+    snapshot_dir = tmp_path / "cache"
+    snapshot_dir.mkdir(mode=0o755)
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", snapshot_dir)
+
+    example = Path("./tests/data/bind-example-config.yaml").read_text(encoding="utf-8")
+    system, _, users = example.partition("users:\n")
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(system, encoding="utf-8")
+    user_dir = tmp_path / "zone-handler.d"
+    user_dir.mkdir()
+    alice, _, bob = users.partition("  bob:\n")
+    alice_file = user_dir / "alice.yaml"
+    alice_file.write_text(alice.replace("\n    ", "\n")[9:], encoding="utf-8")
+    bob_file = user_dir / "bob.yaml"
+    bob_file.write_text("zones: [", encoding="utf-8")
+
+    # Only the invoking user's file gets read
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "list"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "example.com\nexample.net\n"
+
+    alice_file.write_text(
+        alice_file.read_text(encoding="utf-8") + "  - example.info\n",
+        encoding="utf-8",
+    )
+    wrapper(config_file)
+    assert capsys.readouterr().out == "example.com\nexample.net\nexample.info\n"
+
+    mocker.patch("sys.argv", ["_"])
+    wrapper_path = Path("_").absolute().parent / "szh-wrapper"
+    with pytest.raises(SystemExit):
+        ssh_keys(config_file)
+
+    bob_file.write_text(bob.replace("\n    ", "\n").lstrip(), encoding="utf-8")
+    ssh_keys(config_file)
+    assert [line.split('"')[1] for line in capsys.readouterr().out.splitlines()] == [
+        f"{wrapper_path} alice",
+        f"{wrapper_path} alice",
+        f"{wrapper_path} bob",
+    ]
+
+    config_file.write_text(example, encoding="utf-8")
+    with pytest.raises(ConfigFileError, match='User "alice" configured more than once'):
+        _read_config(config_file)
+
+
+def test_cli_lazy_imports(tmp_path):
+    (tmp_path / pwd.getpwuid(os.geteuid()).pw_name).mkdir(mode=0o700)
+    script = "\n".join(
+        [
+            "import sys",
+            "from pathlib import Path",
+            "import ssh_zone_handler.cli as cli",
+            f"cli.SNAPSHOT_DIR = Path({str(tmp_path)!r})",
+            "cli.wrapper(Path('./tests/data/bind-example-config.yaml'))",
+            "print(*sorted(sys.modules), file=sys.stderr)",
+        ]
+    )
+    env = dict(os.environ, SSH_ORIGINAL_COMMAND="list")
+
+    imported = []
+    for _ in range(2):
+        result = subprocess.run(
+            [sys.executable, "-c", script, "alice"],
+            capture_output=True,
+            check=True,
+            env=env,
+            text=True,
+        )
+        assert result.stdout == "example.com\nexample.net\n"
+        imported.append(result.stderr.split("\n")[-2].split())
+
+    assert "pydantic" in imported[0]
+    assert "ssh_zone_handler.bind" in imported[1]
+    for module in ["pydantic", "yaml", "ssh_zone_handler.knot"]:
+        assert module not in imported[1]
+
+    # Nor does szh-sshkeys need any of what the commands themselves use
+    for _ in range(2):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                script.replace("cli.wrapper(", "cli.ssh_keys("),
+                "zones",
+                "SHA256:l1C6ejW6aOGAnlbxUHaSWsPTluulpOryWCmQRDeHSYQ",
+            ],
+            capture_output=True,
+            check=True,
+            env=env,
+            text=True,
+        )
+        assert "szh-wrapper alice" in result.stdout
+    imported = result.stderr.split("\n")[-2].split()
+    for module in ["cache", "limits", "logindex", "metrics", "profiling"]:
+        assert f"ssh_zone_handler.{module}" not in imported
+    assert "tempfile" not in imported
+
+
+def test_command_streaming():
+    log_file = Path("./tests/data/journald-named.txt")
+    log_data = log_file.read_text(encoding="utf-8")
+
+    chunks = list(SshZoneCommand._streamer(("/bin/cat", str(log_file)), "failure"))
+    assert "".join(chunks) == log_data
+
+    lines = list(SshZoneCommand._lines(["a\nb", "c\n", "\nd"]))
+    assert lines == ["a", "bc", "", "d"]
+
+    with pytest.raises(InvokeError):
+        list(SshZoneCommand._streamer(("/bin/false",), "failure"))
+
+    with pytest.raises(InvokeError):
+        list(SshZoneCommand._streamer(("/nonexistent/command",), "failure"))
+
+
+def test_cli_zone_wrapper_logs(capsys, mocker):
+    log_data = Path("./tests/data/journald-named.txt").read_text(encoding="utf-8")
+    filtered_file = Path("./tests/data/filtered-named-example-com-net.txt")
+    filtered_data = filtered_file.read_text(encoding="utf-8")
+
+    chunks = [log_data[pos : pos + 100] for pos in range(0, len(log_data), 100)]
+    streamer = mocker.patch.object(BindCommand, "_streamer", return_value=chunks)
+
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "logs example.com example.net"
+    wrapper(Path("./tests/data/bind-example-config.yaml"))
+
+    assert capsys.readouterr().out == filtered_data
+    assert streamer.call_args.args[0] == (
+        "/usr/bin/sudo",
+        "--user=szh-logviewer",
+        "/usr/bin/journalctl",
+        "--unit=named.service",
+        "--since=-5days",
+        "--utc",
+    )
+
+
+def test_cli_zone_wrapper_logs_window(caplog, capsys, mocker):
+    log_lines = Path("./tests/data/journald-named.txt").read_text(encoding="utf-8")
+    newest_first = "\n".join(reversed(log_lines.rstrip().split("\n")))
+    streamer = mocker.patch.object(
+        BindCommand,
+        "_streamer",
+        side_effect=lambda *_: (chunk for chunk in [newest_first]),
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = (
+        "logs example.com --since=1d --until=1h --lines=2"
+    )
+    wrapper(Path("./tests/data/bind-example-config.yaml"))
+
+    matched = list(BindCommand._filter_logs(log_lines.split("\n"), ["example.com"]))
+    assert capsys.readouterr().out == "\n".join(matched[-2:]) + "\n"
+    assert streamer.call_args.args[0][2:] == (
+        "/usr/bin/journalctl",
+        "--unit=named.service",
+        "--since=-1day",
+        "--until=-1h",
+        "--utc",
+        "--reverse",
+    )
+
+    for ssh_command, error in [
+        ("logs example.com --since=3d", "Invalid --since window"),
+        ("logs example.com --since=1h --until=1h", "The --until window must be"),
+        ("logs example.com --lines=0", "--lines must be between"),
+        ("logs example.com --follow", 'Invalid option "--follow"'),
+        ("dump example.com --lines=2", 'Invalid option "--lines=2"'),
+    ]:
+        caplog.clear()
+        os.environ["SSH_ORIGINAL_COMMAND"] = ssh_command
+        with pytest.raises(SystemExit):
+            wrapper(Path("./tests/data/bind-example-config.yaml"))
+        assert caplog.text.startswith(error)
+
+
+def test_log_filter_push_down(capsys, tmp_path):
+    twice = "named[1]: zone example.com/IN: transfer of 'example.net/IN' started"
+    assert list(BindCommand._filter_logs([twice], ["example.com", "example.net"])) == [
+        twice
+    ]
+
+    for command, journal in [
+        (BindCommand, "journald-named.txt"),
+        (KnotCommand, "journald-knot.txt"),
+    ]:
+        log_lines = Path(f"./tests/data/{journal}").read_text(encoding="utf-8")
+        log_lines = log_lines.split("\n")
+        grep = re.compile(command._journal_grep())
+
+        pushed_down = [line for line in log_lines if grep.search(line)]
+        zones = ["example.com", "example.net"]
+        assert list(command._filter_logs(pushed_down, zones)) == list(
+            command._filter_logs(log_lines, zones)
+        )
+
+    for server_type, rule in [
+        ("bind", "--unit=named.service --since=-5days --utc --grep='|/IN"),
+        ("knot", r"--unit=knot.service --since=-5days --utc --grep=\[.\]\]"),
+    ]:
+        config_file = tmp_path / f"{server_type}-zone-handler.yaml"
+        config_file.write_text(
+            Path(f"./tests/data/{server_type}-example-config.yaml")
+            .read_text(encoding="utf-8")
+            .replace(
+                f"server_type: {server_type}",
+                f"server_type: {server_type}\n  journalctl_grep: true",
+            ),
+            encoding="utf-8",
+        )
+        sudoers(config_file)
+        journal_rules = [
+            line
+            for line in capsys.readouterr().out.split("\n")
+            if "/usr/bin/journalctl" in line
+        ]
+        assert journal_rules[0] == (
+            f"zones\tALL=(szh-logviewer) NOPASSWD: /usr/bin/journalctl {rule}"
+        )
+        # Every rule pins the pattern, and no argument is left open ended
+        assert all(line.endswith(rule.rpartition(" ")[2]) for line in journal_rules)
+        assert not any(
+            re.search(r"(?<!\\)[*?]", line.partition("NOPASSWD: ")[2])
+            for line in journal_rules
+        )
+
+
+def test_log_index(caplog, mocker, tmp_path):
+    config = _load_config(Path("./tests/data/knot-example-config.yaml"))
+    # Any other group the files can be handed to
+    groups = [65534] if os.geteuid() == 0 else os.getgroups()
+    group = next((gid for gid in groups if gid != os.getgid()), os.getgid())
+    index = LogIndex(tmp_path, 1024 * 1024, group)
+    indexer = LogIndexer(index, KnotCommand, lambda: config)
+    indexer.reload()
+
+    log_lines = Path("./tests/data/journald-knot.txt").read_text(encoding="utf-8")
+    pattern = re.compile(r"^(\w+ \d+ [\d:]+) (\S+) ([\w-]+)\[(\d+)\]: (.*)$")
+    for number, line in enumerate(log_lines.rstrip().split("\n")):
+        if not (matched := pattern.match(line)):
+            continue
+        when, host, ident, pid, message = matched.groups()
+        timestamp = calendar.timegm(time.strptime(f"2025 {when}", "%Y %b %d %H:%M:%S"))
+        indexer.ingest(
+            {
+                "__CURSOR": f"cursor-{number}",
+                "__REALTIME_TIMESTAMP": str(timestamp * 1_000_000 + number),
+                "_HOSTNAME": host,
+                "SYSLOG_IDENTIFIER": ident,
+                "SYSLOG_PID": pid,
+                "MESSAGE": message,
+            }
+        )
+    indexer.flush()
+
+    filtered_file = Path("./tests/data/filtered-knot-example-com-net.txt")
+    filtered_data = filtered_file.read_text(encoding="utf-8").rstrip().split("\n")
+    zones = ["example.com", "example.net"]
+    assert list(index.read(zones, 0)) == filtered_data
+    assert index.load_state()[0] == f"cursor-{number}"
+    shared_mode = 0o640
+    assert {
+        (path.stat().st_mode & 0o777, path.stat().st_gid)
+        for path in (index.state_file, index.zone_file("example.com"))
+    } == {(shared_mode, group)}
+
+    since_us = max(indexer.coverage.values())
+    assert index.covers(zones, since_us)
+    assert not index.covers(zones, since_us - 1)
+    assert not index.covers(["example.org", "example.edu"], since_us)
+
+    # Zones below a pattern get indexed as they show up in the journal
+    pattern_config = tmp_path / "zone-handler.yaml"
+    pattern_config.write_text(
+        Path("./tests/data/knot-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace("      - example.org\n", '      - "*.example.org"\n'),
+        encoding="utf-8",
+    )
+    pattern_index = LogIndex(tmp_path / "patterns", 1024 * 1024)
+    pattern_index.index_dir.mkdir()
+    indexer = LogIndexer(
+        pattern_index, KnotCommand, lambda: _load_config(pattern_config)
+    )
+    indexer.reload()
+    assert "*.example.org" in indexer.coverage
+
+    # A broken config file leaves the indexer as it was
+    pattern_config.write_text("users: [", encoding="utf-8")
+    coverage = dict(indexer.coverage)
+    indexer.reload()
+    assert indexer.coverage == coverage
+    assert "Keeping the previous config" in caplog.text
+    for number, zone in enumerate(["www.example.org", "example.org"]):
+        indexer.ingest(
+            {
+                "__CURSOR": f"cursor-{number}",
+                "__REALTIME_TIMESTAMP": str(time.time_ns() // 1000),
+                "MESSAGE": f"[{zone}.] zone file loaded",
+            }
+        )
+    indexer.flush()
+    since_us = indexer.coverage["*.example.org"]
+    assert len(list(pattern_index.read(["www.example.org"], 0))) == 1
+    assert not list(pattern_index.read(["example.org"], 0))
+    assert pattern_index.covers(["www.example.org", "example.com"], since_us)
+    assert not pattern_index.covers(["example.org"], since_us)
+
+    mocker.patch("ssh_zone_handler.logindex.STALE_AFTER", -1)
+    assert not index.covers(zones, since_us)
+
+    max_bytes = 1024
+    small_index = LogIndex(tmp_path, max_bytes)
+    small_index.append("example.com", [(time.time_ns() // 1000, "x" * 100)] * 20)
+    assert small_index.zone_file("example.com").stat().st_size <= max_bytes // 2
+
+
+def test_zone_dump_streaming(capsys, mocker):
+    zone_content = "\n".join(
+        [
+            "[example.com.] example.com. 3600 SOA ns1.example.com. hostmaster 1 2 3 4 5",
+            "[example.com.] example.com. 3600 NS ns1.example.com.",
+            '[example.com.] www.example.com. 300 TXT "[example.com.] stays"',
+            "",
+            "",
+        ]
+    )
+    chunks = [zone_content[pos : pos + 7] for pos in range(0, len(zone_content), 7)]
+    streamer = mocker.patch.object(
+        KnotCommand, "_streamer", side_effect=lambda *_: iter(chunks)
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+    wrapper(Path("./tests/data/knot-example-config.yaml"))
+
+    assert capsys.readouterr().out == "\n".join(
+        [
+            "example.com. 3600 SOA ns1.example.com. hostmaster 1 2 3 4 5",
+            "example.com. 3600 NS ns1.example.com.",
+            'www.example.com. 300 TXT "[example.com.] stays"\n',
+        ]
+    )
+    assert streamer.call_args.args[0][2:] == (
+        "/usr/sbin/knotc",
+        "zone-read",
+        "example.com",
+    )
+
+
+def test_zone_dump_cache(capsys, mocker, tmp_path):
+    cache_dir = tmp_path / "dumps"
+    cache_dir.mkdir()
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace(
+            "server_type: bind", f"server_type: bind\n  dump_cache_dir: {cache_dir}"
+        ),
+        encoding="utf-8",
+    )
+
+    zonestatus = (
+        "name: example.com\nfiles: /var/cache/bind/example.com.db\nserial: {}\n"
+    )
+    runner = mocker.patch.object(BindCommand, "_runner")
+    soa = "example.com. 3600 IN SOA ns1.example.com. hostmaster.example.com. {} 2 3 4 5"
+    records = {serial: f"{soa.format(serial)}\nwww A 1\n" for serial in (1, 2, 3)}
+    streamer = mocker.patch.object(BindCommand, "_streamer")
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+
+    for serial, renders in [(1, 1), (1, 1), (2, 2)]:
+        runner.return_value = subprocess.CompletedProcess(
+            [], 0, zonestatus.format(serial)
+        )
+        streamer.side_effect = lambda *_, serial=serial: iter([records[serial]])
+        wrapper(config_file)
+        assert capsys.readouterr().out == records[serial]
+        assert streamer.call_count == renders
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com --since-serial=1"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "\n".join(
+        [
+            "; example.com changes from serial 1 to 2",
+            f"+{soa.format(2)}",
+            f"-{soa.format(1)}\n",
+        ]
+    )
+    assert streamer.call_count == renders
+
+    # A transfer landing after the serial got looked up
+    (cache_dir / "example.com@2.zone").unlink()
+    streamer.side_effect = lambda *_: iter([records[3]])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+    wrapper(config_file)
+    assert capsys.readouterr().out == records[3]
+    assert not (cache_dir / "example.com@2.zone").exists()
+    assert (cache_dir / "example.com@3.zone").read_text(encoding="utf-8") == records[3]
+
+    for path in cache_dir.iterdir():
+        path.unlink()
+    dump_cache = DumpCache(cache_dir, 80)
+    for zone in ["example.net", "example.org", "example.edu"]:
+        list(dump_cache.store(zone, [f"{zone}. SOA ns. host. 1 2 3 4 5\n"]))
+        os.utime(cache_dir / f"{zone}@1.zone", (0, 0))
+    assert sorted(path.name for path in cache_dir.iterdir()) == [
+        "example.edu@1.zone",
+        "example.org@1.zone",
+    ]
+    assert dump_cache.lookup("example.com", 2) is None
+
+    # Without a leading SOA record, there's no serial to key it by
+    assert list(dump_cache.store("example.com", ["www A 1\n"])) == ["www A 1\n"]
+    assert len(list(cache_dir.iterdir())) == len(["example.edu", "example.org"])
+
+    def failing() -> Iterator[str]:
+        yield f"{soa.format(3)}\n"
+        raise InvokeError("failure")
+
+    with pytest.raises(InvokeError):
+        list(dump_cache.store("example.com", failing()))
+    assert dump_cache.lookup("example.com", 3) is None
+
+    cache_dir.chmod(0o777)
+    untrusted = DumpCache(cache_dir, 80)
+    assert untrusted.lookup("example.org", 1) is None
+    assert list(untrusted.store("example.com", [records[3]])) == [records[3]]
+    assert not (cache_dir / "example.com@3.zone").exists()
+    assert untrusted.delta("example.org", 1, []) is None
+    cache_dir.chmod(0o700)
+
+
+def test_gzip_output(capsysbinary, mocker):
+    log_data = Path("./tests/data/journald-knot.txt").read_text(encoding="utf-8")
+    filtered_file = Path("./tests/data/filtered-knot-example-com-net.txt")
+    mocker.patch.object(
+        KnotCommand, "_streamer", side_effect=lambda *_: iter([log_data])
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "logs example.com example.net --gzip"
+    wrapper(Path("./tests/data/knot-example-config.yaml"))
+    assert gzip.decompress(capsysbinary.readouterr().out) == filtered_file.read_bytes()
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com --gzip=9"
+    with pytest.raises(SystemExit):
+        wrapper(Path("./tests/data/knot-example-config.yaml"))
+
+
+def test_meta_cache(capsys, mocker, tmp_path):
+    meta_cache = MetaCache(tmp_path / "meta", max_entries=2)
+    meta_cache.put("files:example.com", "/var/cache/bind/example.com.db", 60)
+    assert meta_cache.get("files:example.com") == "/var/cache/bind/example.com.db"
+
+    meta_cache.put("serial:example.com", 1, -1)
+    assert meta_cache.get("serial:example.com") is None
+
+    meta_cache.put("serial:example.net", 2, 60)
+    os.utime(next((tmp_path / "meta").iterdir()), (0, 0))
+    meta_cache.put("serial:example.org", 3, 60)
+    assert len(list((tmp_path / "meta").iterdir())) == meta_cache.max_entries
+
+    meta_cache.delete("serial:example.org")
+    assert meta_cache.get("serial:example.org") is None
+
+    (tmp_path / "meta").chmod(0o777)
+    assert MetaCache(tmp_path / "meta").get("serial:example.net") is None
+
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace("server_type: bind", f"server_type: bind\n  runtime_dir: {tmp_path}"),
+        encoding="utf-8",
+    )
+    runner = mocker.patch.object(
+        BindCommand,
+        "_runner",
+        return_value=subprocess.CompletedProcess([], 0, "files: /tmp/example.com.db"),
+    )
+    mocker.patch.object(BindCommand, "_streamer", side_effect=lambda *_: iter(["a"]))
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+
+    (tmp_path / "meta").chmod(0o700)
+    for _ in range(2):
+        wrapper(config_file)
+    assert capsys.readouterr().out == "a\na\n"
+    assert runner.call_count == 1
+
+
+def test_retransfer_cooldown(caplog, capsys, mocker, tmp_path):
+    triggered: list[str] = []
+
+    def slow_retransfer(zone: str) -> None:
+        time.sleep(0.1)
+        triggered.append(zone)
+
+    cooldown = RetransferCooldown(tmp_path / "retransfer", 60)
+    pending: list[float | None] = []
+    threads = [
+        threading.Thread(
+            target=lambda: pending.append(
+                cooldown.trigger("example.com", slow_retransfer)
+            )
+        )
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert triggered == ["example.com"]
+    assert pending.count(None) == 1
+
+    state_file = tmp_path / "retransfer" / "example.com.retransfer"
+    state_file.write_text(str(time.time() - 60), encoding="utf-8")
+    assert cooldown.trigger("example.com", triggered.append) is None
+    assert triggered == ["example.com", "example.com"]
+
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace("server_type: bind", f"server_type: bind\n  runtime_dir: {tmp_path}"),
+        encoding="utf-8",
+    )
+    runner = mocker.patch.object(
+        BindCommand,
+        "_runner",
+        side_effect=[
+            InvokeError("Failed to trigger retransfer"),
+            subprocess.CompletedProcess([], 0, ""),
+        ],
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "retransfer example.net"
+
+    # A failed attempt doesn't start the cooldown
+    with pytest.raises(SystemExit):
+        wrapper(config_file)
+    assert caplog.text == "Failed to trigger retransfer\n"
+    wrapper(config_file)
+    wrapper(config_file)
+    assert capsys.readouterr().out == "\n".join(
+        [
+            'Triggering retransfer of zone "example.net"',
+            'Retransfer of zone "example.net" already pending, triggered 0 seconds ago',
+            "",
+        ]
+    )
+    assert runner.call_count == len(["failed", "triggered"])
+
+
+def test_command_limits(caplog, capsys, mocker, tmp_path):
+    assert CommandLimit.merge(
+        {"per_minute": 10, "burst": None, "concurrent": 1},
+        {"per_minute": None, "burst": 2, "concurrent": 4},
+    ) == CommandLimit(per_minute=10, burst=2, concurrent=4)
+
+    limits = (
+        "\n  limits:\n    dump:\n      concurrent: 1\n    logs:\n      per_minute: 1"
+    )
+    user_limits = "\n    limits:\n      logs:\n        per_minute: 60\n        burst: 2"
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace("server_type: bind", f"server_type: bind{limits}")
+        .replace("      - example.net", f"      - example.net{user_limits}"),
+        encoding="utf-8",
+    )
+    with pytest.raises(ConfigFileError):
+        _read_config(config_file)
+
+    config_file.write_text(
+        config_file.read_text(encoding="utf-8").replace(
+            "server_type: bind", f"server_type: bind\n  runtime_dir: {tmp_path}"
+        ),
+        encoding="utf-8",
+    )
+    streamer = mocker.patch.object(
+        BindCommand, "_streamer", side_effect=lambda *_: iter(["a"])
+    )
+    mocker.patch.object(
+        BindCommand,
+        "_runner",
+        return_value=subprocess.CompletedProcess(
+            [], 0, "files: /tmp/zone.db\nserial: 1"
+        ),
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    # Alice's own burst of two, then the bucket is empty
+    os.environ["SSH_ORIGINAL_COMMAND"] = "logs example.com"
+    for _ in range(2):
+        wrapper(config_file)
+    with pytest.raises(SystemExit):
+        wrapper(config_file)
+    assert caplog.text == 'Too many "logs" requests, try again in 1 seconds\n'
+
+    caplog.clear()
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+    limiter = CommandLimiter(tmp_path / "limits")
+    with limiter.acquire("alice", "dump", CommandLimit(concurrent=1)):
+        with pytest.raises(SystemExit):
+            wrapper(config_file)
+        assert caplog.text == (
+            'Too many concurrent "dump" requests, at most 1 allowed\n'
+        )
+
+        # Other users have their own slots
+        mocker.patch("sys.argv", ["_", "bob"])
+        os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.org"
+        wrapper(config_file)
+
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "a\na\n"
+    assert streamer.call_count == len(["logs", "logs", "dump", "dump"])
+
+    # Limits that can't be enforced reject every limited request
+    caplog.clear()
+    (tmp_path / "limits").chmod(0o777)
+    with pytest.raises(SystemExit):
+        wrapper(config_file)
+    assert caplog.text.endswith('Unable to enforce the "dump" limits, try later\n')
+    assert streamer.call_count == len(["logs", "logs", "dump", "dump"])
+
+
+def test_multi_zone_commands(caplog, capsys, mocker):
+    def render(command: tuple[str, ...], _failure: str) -> Iterator[str]:
+        zone = command[-1]
+        if zone == "example.com":
+            time.sleep(0.1)
+        yield f"[{zone}.] {zone}. 3600 SOA ns1.{zone}. hostmaster 1 2 3 4 5\n"
+
+    mocker.patch.object(KnotCommand, "_streamer", side_effect=render)
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com example.net example.com"
+    wrapper(Path("./tests/data/knot-example-config.yaml"))
+    assert capsys.readouterr().out == "\n".join(
+        [
+            "; BEGIN zone example.com",
+            "example.com. 3600 SOA ns1.example.com. hostmaster 1 2 3 4 5",
+            "; END zone example.com",
+            "; BEGIN zone example.net",
+            "example.net. 3600 SOA ns1.example.net. hostmaster 1 2 3 4 5",
+            "; END zone example.net\n",
+        ]
+    )
+
+    def retransfer(command: tuple[str, ...], failure: str) -> None:
+        if command[-1] == "example.com":
+            raise InvokeError(failure)
+
+    mocker.patch.object(KnotCommand, "_runner", side_effect=retransfer)
+    os.environ["SSH_ORIGINAL_COMMAND"] = "retransfer example.com example.net"
+    with pytest.raises(SystemExit):
+        wrapper(Path("./tests/data/knot-example-config.yaml"))
+    assert capsys.readouterr().out == 'Triggering retransfer of zone "example.net"\n'
+    assert caplog.text.endswith(
+        "Failed to trigger retransfer of the following zone(s): example.com\n"
+    )
+
+
+def test_status_command(capsys, mocker):
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status"
+
+    zonestatus = "\n".join(
+        [
+            "name: {}",
+            "type: secondary",
+            "serial: 2024010101",
+            "last loaded: Fri, 28 Apr 2023 17:52:00 GMT",
+            "next refresh: Fri, 28 Apr 2023 18:52:00 GMT",
+            "expires: Fri, 05 May 2023 17:52:00 GMT",
+        ]
+    )
+    bind_runner = mocker.patch.object(
+        BindCommand,
+        "_runner",
+        side_effect=lambda command, _: subprocess.CompletedProcess(
+            command, 0, zonestatus.format(command[-1])
+        ),
+    )
+    wrapper(Path("./tests/data/bind-example-config.yaml"))
+    dates = "Fri, 28 Apr 2023 17:52:00 GMT\tFri, 28 Apr 2023 18:52:00 GMT\tFri, 05 May 2023 17:52:00 GMT"
+    assert capsys.readouterr().out == "\n".join(
+        [
+            "zone\tserial\tloaded\trefresh\texpires",
+            f"example.com\t2024010101\t{dates}",
+            f"example.net\t2024010101\t{dates}\n",
+        ]
+    )
+    assert bind_runner.call_count == len(["example.com", "example.net"])
+
+    # Asking for only zones not granted mustn't fall back to every zone
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status example.org"
+    with pytest.raises(SystemExit):
+        wrapper(Path("./tests/data/bind-example-config.yaml"))
+    assert capsys.readouterr().out == ""
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status"
+
+    zone_status = "\n".join(
+        [
+            "[example.com.] serial: 7 | refresh: +59m59s | expiration: +6D23h59m59s",
+            "[example.net.] (no such zone found)",
+        ]
+    )
+    knot_runner = mocker.patch.object(
+        KnotCommand,
+        "_runner",
+        return_value=subprocess.CompletedProcess([], 0, zone_status),
+    )
+    with pytest.raises(SystemExit):
+        wrapper(Path("./tests/data/knot-example-config.yaml"))
+    assert capsys.readouterr().out == "\n".join(
+        [
+            "zone\tserial\tloaded\trefresh\texpires",
+            "example.com\t7\t-\t+59m59s\t+6D23h59m59s\n",
+        ]
+    )
+    assert knot_runner.call_args.args[0][-5:] == (
+        "zone-status",
+        "example.com",
+        "example.net",
+        "+serial",
+        "+events",
+    )
+
+
+def test_zone_grants(capsys, mocker, tmp_path):
+    prefix = "8.b.d.0.1.0.0.2.ip6.arpa"
+    grants = ZoneGrants(["example.com", f"*.{prefix}", "*.example.net"])
+    assert "example.com" in grants
+    assert f"0.{prefix}" in grants
+    assert f"f.0.{prefix}" in grants
+    assert "www.example.net" in grants
+    assert prefix not in grants
+    assert "example.net" not in grants
+    assert "0.9.b.d.0.1.0.0.2.ip6.arpa" not in grants
+    assert f"-x.{prefix}" not in grants
+    assert f"0..{prefix}" not in grants
+
+    users = {
+        "alice": UserConf(zones=["example.com", "*.example.net"]),
+        "bob": UserConf(zones=["www.example.com", "www.example.net"]),
+        "carol": UserConf(zones=["*.dev.example.net", "example.net"]),
+        "dave": UserConf(zones=["*.www.example.com", "example.org"]),
+    }
+    assert shared_zones(users) == {
+        "*.example.net": ["alice", "bob", "carol"],
+        "www.example.net": ["alice", "bob"],
+        "*.dev.example.net": ["alice", "carol"],
+    }
+
+    snapshot_dir = tmp_path / "cache"
+    snapshot_dir.mkdir(mode=0o755)
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", snapshot_dir)
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace("      - example.net\n", f'      - "*.{prefix}"\n')
+        .replace("      - example.org\n", '      - "*.example.io"\n'),
+        encoding="utf-8",
+    )
+
+    checkconf = "\n".join(
+        [
+            "example.com IN default primary",
+            f"1.{prefix} IN default secondary",
+            f"0.{prefix} IN default secondary",
+            f"{prefix} IN default secondary",
+            "example.org IN default secondary\n",
+        ]
+    )
+    runner = mocker.patch.object(
+        BindCommand,
+        "_runner",
+        return_value=subprocess.CompletedProcess([], 0, checkconf),
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "list"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "\n".join(
+        ["example.com", f"0.{prefix}", f"1.{prefix}\n"]
+    )
+    assert runner.call_args.args[0][-2:] == ("/usr/bin/named-checkconf", "-l")
+
+    # Patterns matching none of the server's zones
+    mocker.patch("sys.argv", ["_", "bob"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "\t".join(("zone",) + ZoneStatus._fields) + "\n"
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    mocker.patch.object(BindCommand, "_runner")
+    os.environ["SSH_ORIGINAL_COMMAND"] = f"retransfer 2.{prefix} {prefix}"
+    wrapper(config_file)
+    assert capsys.readouterr().out == f'Triggering retransfer of zone "2.{prefix}"\n'
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = f"retransfer {prefix} -x.{prefix}"
+    with pytest.raises(SystemExit):
+        wrapper(config_file)
+
+    config_file.write_text(
+        Path("./tests/data/knot-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace("      - example.org\n", '      - "*.example.io"\n'),
+        encoding="utf-8",
+    )
+    runner = mocker.patch.object(
+        KnotCommand,
+        "_runner",
+        return_value=subprocess.CompletedProcess(
+            [], 0, "[example.com.] role: master\n"
+        ),
+    )
+    mocker.patch("sys.argv", ["_", "bob"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "\t".join(("zone",) + ZoneStatus._fields) + "\n"
+    assert runner.call_count == 1
+
+
+def test_batch_command(caplog, capsys, mocker):
+    zonestatus = "name: {}\nserial: 2024010101\nfiles: /var/cache/bind/{}.zone\n"
+    runner = mocker.patch.object(
+        BindCommand,
+        "_runner",
+        side_effect=lambda command, _: subprocess.CompletedProcess(
+            command, 0, zonestatus.format(command[-1], command[-1])
+        ),
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+    mocker.patch(
+        "sys.stdin",
+        io.StringIO(
+            "\n".join(
+                [
+                    "# Comments and empty lines get skipped",
+                    "status example.com",
+                    "",
+                    "retransfer example.com",
+                    "status example.com",
+                    "logs example.com --gzip",
+                    "batch",
+                    "status example.net\n",
+                ]
+            )
+        ),
+    )
+    os.environ["SSH_ORIGINAL_COMMAND"] = "batch"
+    with pytest.raises(SystemExit):
+        wrapper(Path("./tests/data/bind-example-config.yaml"))
+
+    status = "zone\tserial\tloaded\trefresh\texpires\n{}\t2024010101\t-\t-\t-"
+    assert capsys.readouterr().out == "\n".join(
+        [
+            "@@ szh-begin status example.com",
+            status.format("example.com"),
+            "@@ szh-end ok",
+            "@@ szh-begin retransfer example.com",
+            'Triggering retransfer of zone "example.com"',
+            "@@ szh-end ok",
+            "@@ szh-begin status example.com",
+            status.format("example.com"),
+            "@@ szh-end ok",
+            "@@ szh-begin logs example.com --gzip",
+            '@@ szh-end error "logs example.com --gzip" is not available within a batch',
+            "@@ szh-begin batch",
+            '@@ szh-end error "batch" is not available within a batch',
+            "@@ szh-begin status example.net",
+            status.format("example.net"),
+            "@@ szh-end ok\n",
+        ]
+    )
+    assert caplog.text.endswith("2 of 6 batch command(s) failed\n")
+
+    # The retransfer made the second status look the zone up again
+    zonestatus_calls = [
+        call.args[0][-2:]
+        for call in runner.call_args_list
+        if "zonestatus" in call.args[0]
+    ]
+    assert zonestatus_calls == [
+        ("zonestatus", "example.com"),
+        ("zonestatus", "example.com"),
+        ("zonestatus", "example.net"),
+    ]
+
+
+def test_invocation_metrics(caplog, capsys, mocker, tmp_path):
+    log_lines = (
+        Path("./tests/data/journald-named.txt").read_text(encoding="utf-8").split("\n")
+    )
+    invocation = Invocation.start("alice", "bind")
+    matched = list(BindCommand._filter_logs(log_lines, ["example.net"]))
+    assert invocation.counters == {
+        "log_lines_scanned": len(log_lines),
+        "log_lines_matched": len(matched),
+    }
+
+    caplog.set_level(logging.INFO)
+    snapshot_dir = tmp_path / "cache"
+    snapshot_dir.mkdir(mode=0o755)
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", snapshot_dir)
+    metrics_dir = tmp_path / "metrics"
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace(
+            "server_type: bind",
+            f"server_type: bind\n  metrics_dir: {metrics_dir}",
+        ),
+        encoding="utf-8",
+    )
+
+    run = mocker.patch(
+        "ssh_zone_handler.base.run",
+        side_effect=lambda command, **_: subprocess.CompletedProcess(
+            command, 0, f"name: {command[-1]}\nserial: 7\n"
+        ),
+    )
+    mocker.patch("sys.argv", ["_", "alice"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status example.com"
+    wrapper(config_file)
+    output = capsys.readouterr().out
+    assert output.endswith("example.com\t7\t-\t-\t-\n")
+
+    fields = caplog.records[-1].getMessage().split()
+    assert fields[:5] == [
+        "metrics",
+        "user=alice",
+        "command=status",
+        "backend=bind",
+        "status=ok",
+    ]
+    assert "rndc_runs=1" in fields
+    assert "rndc_exit=0" in fields
+    assert f"output_bytes={len(output)}" in fields
+    assert run.call_args.args[0][:3] == (
+        "/usr/bin/sudo",
+        "--user=bind",
+        "/usr/sbin/rndc",
+    )
+
+    run.side_effect = subprocess.CalledProcessError(1, "rndc")
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status example.com example.net"
+    with pytest.raises(SystemExit):
+        wrapper(config_file)
+    assert "rndc_exit=1" in caplog.records[-2].getMessage().split()
+
+    exported = (metrics_dir / "ssh-zone-handler.prom").read_text(encoding="utf-8")
+    labels = 'backend="bind",command="status"'
+    assert (
+        f'szh_invocations_total{{{labels},status="error",user="alice"}} 1\n' in exported
+    )
+    assert f'szh_invocations_total{{{labels},status="ok",user="alice"}} 1\n' in exported
+    assert (
+        f'szh_invocation_duration_seconds_count{{{labels},user="alice"}} 2\n'
+        in exported
+    )
+    assert (
+        'szh_subprocess_duration_seconds_bucket{backend="bind",program="rndc",le="+Inf"} 3\n'
+        in exported
+    )
+    assert (
+        'szh_subprocess_failures_total{backend="bind",program="rndc"} 2\n' in exported
+    )
+
+
+def test_profiling(capsys, mocker, tmp_path):
+    snapshot_dir = tmp_path / "cache"
+    snapshot_dir.mkdir(mode=0o755)
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", snapshot_dir)
+    profile_dir = tmp_path / "profiles"
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace(
+            "server_type: bind",
+            f"server_type: bind\n  profile_dir: {profile_dir}\n  profile_max_files: 1",
+        )
+        .replace("      - example.net\n", "      - example.net\n    profile_rate: 1\n"),
+        encoding="utf-8",
+    )
+
+    # Only alice gets sampled, with the system's profile_rate left at 0
+    mocker.patch("sys.argv", ["_", "bob"])
+    os.environ["SSH_ORIGINAL_COMMAND"] = "list"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "example.org\n"
+    assert not profile_dir.exists()
+
+    user_dir = profile_dir / pwd.getpwuid(os.geteuid()).pw_name
+    user_dir.mkdir(parents=True, mode=0o700)
+    stale = user_dir / "20000101T000000-wrapper-alice-1.prof"
+    stale.write_bytes(b"")
+    stale.with_suffix(".txt").write_text("", encoding="utf-8")
+    os.utime(stale, (0, 0))
+
+    mocker.patch("sys.argv", ["_", "alice"])
+    wrapper(config_file)
+    assert capsys.readouterr().out == "example.com\nexample.net\n"
+
+    (profile,) = user_dir.glob("*.prof")
+    assert profile.name.endswith(f"-wrapper-alice-{os.getpid()}.prof")
+    private_mode = 0o600
+    assert profile.stat().st_mode & 0o777 == private_mode
+    assert pstats.Stats(str(profile)).get_stats_profile().func_profiles
+    report = profile.with_suffix(".txt").read_text(encoding="utf-8")
+    assert report.startswith("elapsed_seconds=")
+    assert "\npeak_bytes=" in report
+    assert not stale.with_suffix(".txt").exists()
+
+
+def test_knot_control_socket(capsys, mocker, tmp_path):
+    recorded = Path("./tests/data/knotctl-zone-read.bin").read_bytes()
+    requests: list[dict[int, str]] = []
+
+    def fake_knotd(listener: socket.socket) -> None:
+        while True:
+            conn, _ = listener.accept()
+            with conn:
+                knotd = KnotCtl(conn)
+                unit_type, request = knotd.receive()
+                assert unit_type == CTL_DATA
+                assert knotd.receive()[0] == CTL_BLOCK
+                requests.append(request)
+                if request[IDX_CMD] == "zone-read":
+                    conn.sendall(recorded)
+                else:
+                    knotd.send(CTL_BLOCK)
+
+    knot_socket = tmp_path / "knot.sock"
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(knot_socket))
+    listener.listen()
+    threading.Thread(target=fake_knotd, args=(listener,), daemon=True).start()
+
+    proxy_socket = tmp_path / "proxy.sock"
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/knot-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace(
+            "server_type: knot",
+            f"server_type: knot\n  knot_proxy_socket: {proxy_socket}",
+        ),
+        encoding="utf-8",
+    )
+    zones = {"example.com"}
+    proxy = KnotCtlProxy(
+        proxy_socket, knot_socket, config_file, lambda: set(zones), {os.getuid()}
+    )
+    threading.Thread(target=proxy.serve_forever, daemon=True).start()
+    runner = mocker.patch.object(KnotCommand, "_runner")
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+    wrapper(config_file)
+    assert capsys.readouterr().out == "\n".join(
+        [
+            "example.com. 3600 SOA ns1.example.com. hostmaster.example.com. 2024010101 3600 900 1209600 300",
+            "example.com. 3600 NS ns1.example.com.",
+            "example.com. 3600 NS ns2.example.net.",
+            "www.example.com. 300 AAAA 2001:db8::80\n",
+        ]
+    )
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "retransfer example.com"
+    wrapper(config_file)
+    assert capsys.readouterr().out == 'Triggering retransfer of zone "example.com"\n'
+    assert [(r[IDX_CMD], r[IDX_ZONE]) for r in requests] == [
+        ("zone-read", "example.com."),
+        ("zone-retransfer", "example.com."),
+    ]
+    runner.assert_not_called()
+
+    ctl = KnotCtl.connect(proxy_socket)
+    with pytest.raises(KnotCtlError, match="operation not permitted"):
+        list(ctl.request("zone-purge", "example.com"))
+    ctl.close()
+
+    # Zones no longer configured are refused, once the config changed
+    zones.clear()
+    os.utime(config_file, ns=(0, 0))
+    ctl = KnotCtl.connect(proxy_socket)
+    with pytest.raises(KnotCtlError, match="operation not permitted"):
+        list(ctl.request("zone-retransfer", "example.com"))
+    ctl.close()
+    proxy.shutdown()
+    proxy.server_close()
+    assert len(requests) == len(["zone-read", "zone-retransfer"])
+
+
+def rndc_stub(listener: socket.socket, key: RndcKey, log: list[str]) -> None:
+    """A stub named control channel, answering from canned zonestatus output"""
+
+    zonestatus = "name: {}\nfiles: /var/cache/bind/{}.db\nserial: 2024010101"
+    while True:
+        conn, _ = listener.accept()
+        log.append("connect")
+        with conn:
+            while True:
+                try:
+                    request = read_message(conn.recv, key)
+                except ConnectionError:
+                    break
+                command = request["_data"]["type"].decode()
+                ctrl = {"_rpl": 1, "_ser": request["_ctrl"]["_ser"], "_nonce": 42}
+                if command != "null":
+                    assert request["_ctrl"]["_nonce"] == b"42"
+                    log.append(command)
+
+                data = {"type": command, "result": 0}
+                match command.split():
+                    case ["zonestatus", "example.com" | "example.net" as zone]:
+                        data["text"] = zonestatus.format(zone, zone)
+                    case ["null"] | ["retransfer", "example.com"]:
+                        pass
+                    case _:
+                        data.update({"result": 1, "err": "not found"})
+                conn.sendall(encode_message(key, ctrl, data))
+
+
+def test_rndc_control_channel(capsys, mocker, tmp_path):
+    key_file = tmp_path / "rndc.key"
+    key_file.write_text(
+        'key "rndc-key" {\n\talgorithm hmac-sha256;\n'
+        + '\tsecret "c3NoLXpvbmUtaGFuZGxlciB0ZXN0IHNlY3JldA==";\n};\n',
+        encoding="utf-8",
+    )
+    key = read_rndc_key(key_file)
+    assert key == RndcKey("hmac-sha256", b"ssh-zone-handler test secret")
+
+    for algorithm in ["hmac-md5", "hmac-sha512"]:
+        other_key = RndcKey(algorithm, key.secret)
+        message = encode_message(other_key, {"_ser": 1}, {"type": "null"})
+        assert decode_message(other_key, message[4:])["_data"] == {"type": b"null"}
+        with pytest.raises(RndcError, match="signature"):
+            decode_message(RndcKey(algorithm, b"wrong"), message[4:])
+
+    log: list[str] = []
+    control_socket = tmp_path / "control.sock"
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(control_socket))
+    listener.listen()
+    threading.Thread(target=rndc_stub, args=(listener, key, log), daemon=True).start()
+
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/bind-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace(
+            "server_type: bind",
+            f"server_type: bind\n  rndc_control: {control_socket}"
+            + f"\n  rndc_key_file: {key_file}",
+        ),
+        encoding="utf-8",
+    )
+    runner = mocker.patch.object(BindCommand, "_runner")
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    os.environ["SSH_ORIGINAL_COMMAND"] = "status"
+    wrapper(config_file)
+    assert capsys.readouterr().out.split("\n")[1:] == [
+        "example.com\t2024010101\t-\t-\t-",
+        "example.net\t2024010101\t-\t-\t-",
+        "",
+    ]
+    assert log[0] == "connect"
+    assert sorted(log[1:]) == ["zonestatus example.com", "zonestatus example.net"]
+
+    client = RndcClient(str(control_socket), key)
+    assert client.command("retransfer example.com") == ""
+    with pytest.raises(RndcError, match="not found"):
+        client.command("retransfer example.org")
+    assert client.command("zonestatus example.net").startswith("name: example.net")
+    client.close()
+    assert log[3:] == [
+        "connect",
+        "retransfer example.com",
+        "retransfer example.org",
+        "zonestatus example.net",
+    ]
+    runner.assert_not_called()
+
+
+def _start_broker(
+    tmp_path: Path, allowed_uids: set[int]
+) -> tuple[SshZoneBroker, Path, Path]:
+    broker_socket = tmp_path / "broker.sock"
+    config_file = tmp_path / "zone-handler.yaml"
+    config_file.write_text(
+        Path("./tests/data/knot-example-config.yaml")
+        .read_text(encoding="utf-8")
+        .replace(
+            "server_type: knot",
+            f"server_type: knot\n  broker_socket: {broker_socket}",
+        ),
+        encoding="utf-8",
+    )
+
+    server = SshZoneBroker(
+        broker_socket,
+        config_file,
+        lambda: _load_config(config_file),
+        _command_class,
+        allowed_uids=allowed_uids,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, broker_socket, config_file
+
+
+def test_broker(capfd, mocker, tmp_path):
+    def render(command: tuple[str, ...], _failure: str) -> Iterator[str]:
+        yield f"[{command[-1]}.] {command[-1]}. 3600 TXT pid{os.getpid()}\n"
+
+    mocker.patch.object(KnotCommand, "_streamer", side_effect=render)
+    mocker.patch("sys.argv", ["_", "alice"])
+
+    allowed_uids = {os.getuid()}
+    server, broker_socket, config_file = _start_broker(tmp_path, allowed_uids)
+
+    commands = tmp_path / "commands"
+    commands.write_text("list\ndump example.org\n", encoding="utf-8")
+    stdin = commands.open(encoding="utf-8")
+    mocker.patch("sys.stdin", stdin)
+
+    try:
+        # Run by a forked child, writing straight to our stdout
+        os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+        with pytest.raises(SystemExit) as passing:
+            wrapper(config_file)
+        assert passing.value.code == 0
+        dumped = capfd.readouterr().out
+        assert dumped.startswith("example.com. 3600 TXT pid")
+        assert dumped != f"example.com. 3600 TXT pid{os.getpid()}\n"
+
+        os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.org"
+        with pytest.raises(SystemExit) as failing:
+            wrapper(config_file)
+        assert failing.value.code == 1
+
+        assert invoke_via_broker(broker_socket, "list", "mallory") is None
+
+        # Picked up without restarting the broker
+        config_file.write_text(
+            config_file.read_text(encoding="utf-8").replace(
+                "      - example.net\n", ""
+            ),
+            encoding="utf-8",
+        )
+        capfd.readouterr()
+        os.environ["SSH_ORIGINAL_COMMAND"] = "list"
+        with pytest.raises(SystemExit):
+            wrapper(config_file)
+        assert capfd.readouterr().out == "example.com\n"
+
+        # Reading the batch straight from our stdin
+        os.environ["SSH_ORIGINAL_COMMAND"] = "batch"
+        with pytest.raises(SystemExit):
+            wrapper(config_file)
+        assert capfd.readouterr().out == "\n".join(
+            [
+                "@@ szh-begin list",
+                "example.com",
+                "@@ szh-end ok",
+                "@@ szh-begin dump example.org",
+                "@@ szh-end error No valid zone provided\n",
+            ]
+        )
+
+        # A rejected uid falls back to running the command itself
+        allowed_uids.clear()
+        os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+        wrapper(config_file)
+        assert capfd.readouterr().out == f"example.com. 3600 TXT pid{os.getpid()}\n"
+    finally:
+        server.shutdown()
+        server.server_close()
+        stdin.close()
+
+    # Without a running broker, the wrapper falls back to running the command
+    broker_socket.unlink()
+    os.environ["SSH_ORIGINAL_COMMAND"] = "dump example.com"
+    wrapper(config_file)
+    assert capfd.readouterr().out == f"example.com. 3600 TXT pid{os.getpid()}\n"
+
+
+def test_broker_reload(capfd, mocker, tmp_path):
+    mocker.patch("ssh_zone_handler.cli.SNAPSHOT_DIR", tmp_path / "cache")
+    server, broker_socket, _ = _start_broker(tmp_path, {os.getuid()})
+    user_dir = tmp_path / "zone-handler.d"
+    user_dir.mkdir()
+    try:
+        with Path(os.devnull).open(encoding="utf-8") as stdin:
+            mocker.patch("sys.stdin", stdin)
+
+            # Unknown to the broker, for szh-wrapper to run the command itself
+            assert invoke_via_broker(broker_socket, "list", "dave") is None
+
+            # Per-user config files get picked up, once added or changed
+            dave = user_dir / "dave.yaml"
+            dave.write_text("zones:\n  - example.edu\n", encoding="utf-8")
+            capfd.readouterr()
+            assert invoke_via_broker(broker_socket, "list", "dave") == 0
+            assert capfd.readouterr().out == "example.edu\n"
+
+            dave.write_text("zones:\n  - example.info\n", encoding="utf-8")
+            assert invoke_via_broker(broker_socket, "list", "dave") == 0
+            assert capfd.readouterr().out == "example.info\n"
+    finally:
+        server.shutdown()
+        server.server_close()